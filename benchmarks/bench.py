@@ -0,0 +1,334 @@
+"""Measures logins per second and latency of devpi-ldap against the
+in-process LDAP stand-in at increasing concurrency.
+
+Run with ``python -m benchmarks.bench --help`` from the repository root.
+"""
+
+from .standin import BASE_DN
+from .standin import Directory
+from .standin import Faults
+from .standin import GROUPS_DN
+from .standin import PEOPLE_DN
+from .standin import StandIn
+from concurrent.futures import ThreadPoolExecutor
+from devpi_ldap.main import LDAP
+from devpi_ldap.main import devpiserver_auth_request
+from devpi_server.auth import AuthException
+from ldap3.core.exceptions import LDAPException
+from types import SimpleNamespace
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+
+TARGETS = ("validate", "hook")
+
+
+def base_config(servers):
+    config = {
+        "user_search": {
+            "base": PEOPLE_DN,
+            "filter": "(&(objectClass=person)(uid={username}))",
+            "attribute_name": "dn",
+        },
+        "group_search": {
+            "base": GROUPS_DN,
+            "filter": "(&(objectClass=groupOfNames)(member={userdn}))",
+            "attribute_name": "cn",
+        },
+    }
+    if len(servers) == 1:
+        config["url"] = servers[0]
+    else:
+        config["server_pool"] = [{"url": url} for url in servers]
+    return config
+
+
+def percentile(values, fraction):
+    # nearest rank on sorted values
+    if not values:
+        return None
+    index = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[index]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def change(new, old):
+    # relative change, a zero baseline only compares equal to itself
+    if new == old:
+        return 0.0
+    if not old:
+        return math.inf if new > old else -math.inf
+    return new / old - 1
+
+
+def parse_faults(text):
+    """Parses ``latency=0.01,failure_rate=0.1`` into a ``Faults``."""
+    kw = {}
+    for item in filter(None, text.split(",")):
+        (key, value) = item.split("=", 1)
+        kw[key.strip()] = float(value)
+    return Faults(**kw)
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.directory = Directory(
+            users=args.users, groups=args.groups, groups_per_user=args.groups_per_user
+        )
+        default_faults = Faults(
+            latency=args.latency,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            timeout_rate=args.timeout_rate,
+        )
+        faults = {}
+        for item in args.server_faults:
+            (url, _sep, spec) = item.partition(" ")
+            faults[url] = parse_faults(spec)
+        self.standin = StandIn(self.directory, faults, default_faults)
+        config = base_config(args.server)
+        if args.config:
+            with open(args.config) as f:
+                config.update(yaml.safe_load(f).get("devpi-ldap", {}))
+        self.config = config
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="devpi-ldap-bench-")
+
+    def close(self):
+        self._tmpdir.cleanup()
+
+    def make_ldap(self):
+        # a fresh instance for each run, so caches and pools start empty
+        path = os.path.join(self._tmpdir.name, "ldap.yaml")
+        with open(path, "w") as f:
+            yaml.safe_dump({"devpi-ldap": self.config}, f)
+
+        class BenchLDAP(LDAP):
+            ldap3 = self.standin.ldap3
+
+        return BenchLDAP(path)
+
+    def login_func(self, ldap, target):
+        if target == "validate":
+            return ldap.validate
+        registry = {"devpi_ldap": ldap}
+
+        def hook(username, password):
+            # a new request each time, like separate HTTP requests
+            request = SimpleNamespace(
+                registry=registry, method="GET", matched_route=None
+            )
+            return devpiserver_auth_request(
+                request=request, userdict=None, username=username, password=password
+            )
+
+        return hook
+
+    def run(self, target, concurrency):
+        args = self.args
+        ldap = self.make_ldap()
+        login = self.login_func(ldap, target)
+        counter = itertools.count()
+        lock = threading.Lock()
+        latencies = []
+        errors = []
+        rejected = []
+
+        def worker():
+            while True:
+                i = next(counter)
+                if i >= args.logins:
+                    return
+                username = "user%d" % (i % args.users)
+                password = self.directory.password
+                wrong = args.wrong_rate and (i % 100) < args.wrong_rate * 100
+                if wrong:
+                    password = "wrong"  # noqa: S105
+                start = time.perf_counter()
+                try:
+                    result = login(username, password)
+                except (AuthException, LDAPException) as e:
+                    with lock:
+                        errors.append(e)
+                else:
+                    # the hook rejects logins when the validation failed,
+                    # with the right password that is an error as well
+                    if not result or result["status"] != "ok":
+                        with lock:
+                            (rejected if wrong else errors).append(username)
+                seconds = time.perf_counter() - start
+                with lock:
+                    latencies.append(seconds)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = [executor.submit(worker) for _ in range(concurrency)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return dict(
+            target=target,
+            concurrency=concurrency,
+            logins=len(latencies),
+            errors=len(errors),
+            rejected=len(rejected),
+            seconds=elapsed,
+            logins_per_sec=len(latencies) / elapsed if elapsed else 0.0,
+            p50_ms=milliseconds(percentile(latencies, 0.5)),
+            p99_ms=milliseconds(percentile(latencies, 0.99)),
+        )
+
+
+def compare(results, baseline, tolerance):
+    """Returns a line for each run and whether any of them regressed by
+    more than ``tolerance`` in logins per second or p99 latency.
+    """
+    old_runs = {(x["target"], x["concurrency"]): x for x in baseline["results"]}
+    lines = []
+    regressed = False
+    for result in results:
+        old = old_runs.get((result["target"], result["concurrency"]))
+        if old is None:
+            continue
+        throughput = change(result["logins_per_sec"], old["logins_per_sec"])
+        p99 = change(result["p99_ms"], old["p99_ms"])
+        failed = throughput < -tolerance or p99 > tolerance
+        regressed = regressed or failed
+        lines.append(
+            "%-8s %11d %+12.1f%% %+12.1f%%%s"
+            % (
+                result["target"],
+                result["concurrency"],
+                throughput * 100,
+                p99 * 100,
+                "  REGRESSION" if failed else "",
+            )
+        )
+    return (lines, regressed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--config",
+        help="YAML file with 'devpi-ldap' options to add, like caches or pools",
+    )
+    parser.add_argument(
+        "--server",
+        action="append",
+        default=[],
+        help="URL of a stand-in server, repeat for a server pool",
+    )
+    parser.add_argument(
+        "--server-faults",
+        action="append",
+        default=[],
+        metavar="URL SPEC",
+        help="faults of one server, like 'ldap://b latency=0.05,failure_rate=0.5'",
+    )
+    parser.add_argument("--target", choices=TARGETS, action="append")
+    parser.add_argument(
+        "--concurrency", default="1,2,4,8,16", help="comma separated levels"
+    )
+    parser.add_argument("--logins", type=int, default=1000, help="logins per run")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--groups-per-user", type=int, default=3)
+    parser.add_argument("--wrong-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative regression for --compare",
+    )
+    args = parser.parse_args(argv)
+    if not args.server:
+        args.server = ["ldap://standin"]
+    targets = args.target or list(TARGETS)
+    try:
+        levels = [int(x) for x in args.concurrency.split(",")]
+    except ValueError:
+        parser.error("--concurrency must be comma separated numbers")
+    if min(levels) < 1:
+        parser.error("--concurrency levels must be at least 1")
+    if args.logins < 1:
+        parser.error("--logins must be at least 1")
+    bench = Bench(args)
+    try:
+        run_all(bench, args, targets, levels)
+    finally:
+        bench.close()
+
+
+def run_all(bench, args, targets, levels):
+    print(
+        "%-8s %11s %7s %7s %8s %12s %9s %9s"
+        % (
+            "target",
+            "concurrency",
+            "logins",
+            "errors",
+            "rejected",
+            "logins/sec",
+            "p50 ms",
+            "p99 ms",
+        )
+    )
+    results = []
+    for target in targets:
+        for concurrency in levels:
+            result = bench.run(target, concurrency)
+            results.append(result)
+            print(
+                "%-8s %11d %7d %7d %8d %12.1f %9.2f %9.2f"
+                % (
+                    target,
+                    concurrency,
+                    result["logins"],
+                    result["errors"],
+                    result["rejected"],
+                    result["logins_per_sec"],
+                    result["p50_ms"],
+                    result["p99_ms"],
+                )
+            )
+    output = dict(
+        base_dn=BASE_DN,
+        config=bench.config,
+        options={k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        results=results,
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        (lines, regressed) = compare(results, baseline, args.tolerance)
+        print()
+        print("%-8s %11s %13s %13s" % ("target", "concurrency", "logins/sec", "p99"))
+        print("\n".join(lines))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""An in-process stand-in for an LDAP server, used in place of ``ldap3``.
+
+It provides the parts of the ``ldap3`` API used by devpi-ldap, backed by a
+generated directory of users and groups, with configurable latency,
+failures and timeouts for each server.
+"""
+
+from ldap3.core.exceptions import LDAPSocketOpenError
+from types import SimpleNamespace
+import ldap3
+import random
+import re
+import socket
+import threading
+import time
+
+
+BASE_DN = "dc=example,dc=com"
+PEOPLE_DN = "ou=people," + BASE_DN
+GROUPS_DN = "ou=groups," + BASE_DN
+
+
+class Directory:
+    """Users named ``user0`` to ``user<n>`` with the password ``secret``,
+    each a member of ``groups_per_user`` of the groups.
+    """
+
+    password = "secret"  # noqa: S105 - fake directory
+
+    def __init__(self, users=1000, groups=50, groups_per_user=3):
+        self.entries = {}
+        group_dns = ["cn=group%d,%s" % (i, GROUPS_DN) for i in range(groups)]
+        members = {dn: [] for dn in group_dns}
+        for i in range(users):
+            dn = "uid=user%d,%s" % (i, PEOPLE_DN)
+            member_of = [
+                group_dns[(i + j) % groups] for j in range(min(groups_per_user, groups))
+            ]
+            for group_dn in member_of:
+                members[group_dn].append(dn)
+            self.entries[dn.lower()] = dict(
+                dn=dn,
+                objectClass=["person"],
+                uid=["user%d" % i],
+                cn=["User %d" % i],
+                memberOf=member_of,
+                userPassword=[self.password],
+            )
+        for i, dn in enumerate(group_dns):
+            self.entries[dn.lower()] = dict(
+                dn=dn,
+                objectClass=["groupOfNames"],
+                cn=["group%d" % i],
+                member=members[dn],
+            )
+
+    def get(self, dn):
+        return self.entries.get(dn.lower())
+
+    def search(self, base, search_filter):
+        match = parse_filter(search_filter)
+        base = base.lower()
+        return [
+            entry
+            for dn, entry in self.entries.items()
+            if dn.endswith(base) and match(entry)
+        ]
+
+
+def _unescape(value):
+    # reverses ldap3.utils.conv.escape_filter_chars
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+
+def parse_filter(search_filter):
+    """Returns a function matching entries for a filter with ``&``, ``|``,
+    ``!``, equality and presence, which is enough for typical configs.
+    """
+    (match, rest) = _parse(search_filter.strip())
+    if rest.strip():
+        msg = "Unsupported filter %r" % search_filter
+        raise ValueError(msg)
+    return match
+
+
+def _parse(text):
+    if not text.startswith("("):
+        msg = "Unsupported filter %r" % text
+        raise ValueError(msg)
+    text = text[1:]
+    if text[0] in "&|!":
+        operator = text[0]
+        text = text[1:]
+        parts = []
+        while text.startswith("("):
+            (part, text) = _parse(text)
+            parts.append(part)
+        text = text[1:]
+        if operator == "&":
+            return (lambda e: all(p(e) for p in parts), text)
+        if operator == "|":
+            return (lambda e: any(p(e) for p in parts), text)
+        return (lambda e: not parts[0](e), text)
+    (item, text) = text.split(")", 1)
+    (attribute, value) = item.split("=", 1)
+    if value == "*":
+        return (lambda e: attribute in e, text)
+    value = _unescape(value).lower()
+    if attribute.lower() in ("dn", "distinguishedname"):
+        return (lambda e: e["dn"].lower() == value, text)
+    return (lambda e: value in (x.lower() for x in e.get(attribute, ())), text)
+
+
+class Faults:
+    """The behaviour of a server.
+
+    Each operation takes ``latency`` seconds plus a random ``jitter``.
+    Opening a connection fails with a probability of ``failure_rate`` and
+    doesn't get an answer with a probability of ``timeout_rate``, in that
+    case it raises ``socket.timeout`` after the connect timeout.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        timeout_rate=0.0,
+        rand=random.random,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.rand = rand
+
+    def delay(self):
+        seconds = self.latency + self.jitter * self.rand()
+        if seconds:
+            time.sleep(seconds)
+
+    def open(self, server, timeout):
+        if self.rand() < self.timeout_rate:
+            time.sleep(timeout)
+            msg = "timed out"
+            raise socket.timeout(msg)
+        if self.rand() < self.failure_rate:
+            msg = "socket connection error while opening: %s" % server
+            raise LDAPSocketOpenError(msg)
+        self.delay()
+
+
+class StandIn:
+    """Holds the directory and the faults by server URL.
+
+    The ``ldap3`` attribute can replace the ``ldap3`` module of the
+    ``LDAP`` class.
+    """
+
+    def __init__(self, directory, faults=None, default_faults=None):
+        self.directory = directory
+        self.faults = dict(faults or {})
+        self.default_faults = default_faults or Faults()
+        self.stats = Stats()
+        standin = self
+
+        class Server:
+            def __init__(self, url, tls=None, connect_timeout=None, **_kw):
+                self.name = url
+                self.tls = tls
+                self.connect_timeout = connect_timeout
+
+            def __str__(self):
+                return self.name
+
+        class Connection(StandInConnection):
+            pass
+
+        Server.standin = Connection.standin = standin
+        self.ldap3 = SimpleNamespace(
+            ANONYMOUS=ldap3.ANONYMOUS,
+            BASE=ldap3.BASE,
+            Connection=Connection,
+            FIRST=ldap3.FIRST,
+            LEVEL=ldap3.LEVEL,
+            RANDOM=ldap3.RANDOM,
+            ROUND_ROBIN=ldap3.ROUND_ROBIN,
+            SUBTREE=ldap3.SUBTREE,
+            Server=Server,
+            ServerPool=ServerPool,
+            Tls=lambda **kw: kw,
+        )
+
+    def faults_for(self, server):
+        return self.faults.get(server.name, self.default_faults)
+
+
+class Stats:
+    """Counts the operations per server."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, server, operation):
+        key = (str(server), operation)
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class ServerPool:
+    # devpi-ldap picks the servers itself, the pool only holds them
+    def __init__(self, pool_strategy=ldap3.ROUND_ROBIN, *, active=True, exhaust=False):
+        self.servers = []
+        self.pool_strategy = pool_strategy
+        self.active = active
+        self.exhaust = exhaust
+
+    def add(self, server):
+        self.servers.append(server)
+
+
+class StandInConnection:
+    standin = None
+
+    def __init__(
+        self,
+        server,
+        user=None,
+        password=None,
+        receive_timeout=None,
+        **_kw,
+    ):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.receive_timeout = receive_timeout
+        self.closed = True
+        self.bound = False
+        self.result = None
+        self.response = None
+        self.socket = None
+
+    def _faults(self):
+        return self.standin.faults_for(self.server)
+
+    def open(self):
+        server = self.server
+        timeout = server.connect_timeout or self.receive_timeout or 1
+        self.standin.stats.count(server, "open")
+        self._faults().open(server, timeout)
+        self.closed = False
+
+    def bind(self):
+        if self.closed:
+            self.open()
+        self.standin.stats.count(self.server, "bind")
+        self._faults().delay()
+        if self.user is None:
+            self.bound = True
+            self.result = dict(result=0, description="success")
+            return True
+        entry = self.standin.directory.get(self.user)
+        if entry is None:
+            self.result = dict(result=32, description="noSuchObject", message="")
+        elif self.password not in entry.get("userPassword", ()):
+            self.result = dict(result=49, description="invalidCredentials", message="")
+        else:
+            self.result = dict(result=0, description="success")
+        self.bound = self.result["result"] == 0
+        return self.bound
+
+    def rebind(
+        self,
+        user=None,
+        password=None,
+        authentication=None,  # noqa: ARG002
+        *,
+        read_server_info=True,  # noqa: ARG002
+    ):
+        if user:
+            self.user = user
+        if password is not None:
+            self.password = password
+        return self.bind()
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+    def search(self, search_base, search_filter, attributes=None, **_kw):
+        self.standin.stats.count(self.server, "search")
+        self._faults().delay()
+        entries = self.standin.directory.search(search_base, search_filter)
+        attributes = attributes or []
+        self.response = [
+            dict(
+                type="searchResEntry",
+                dn=entry["dn"],
+                # like openLDAP the DN is only at the top level
+                attributes={
+                    k: list(entry[k]) for k in attributes if k in entry and k != "dn"
+                },
+            )
+            for entry in entries
+        ]
+        self.result = dict(result=0, description="success")
+        return bool(self.response)
@@ -0,0 +1,271 @@
+from collections import OrderedDict
+from collections.abc import Sequence
+import hashlib
+import os
+import threading
+import time
+
+
+# number of PBKDF2 rounds used to derive cache keys from passwords
+HASH_ITERATIONS = 10000
+
+
+class TTLCache:
+    """A thread safe, size bounded LRU cache where entries expire after
+    ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.hits = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self.lookups += 1
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            (expires, value) = entry
+            if expires <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key, max_stale, default=None):
+        """Like ``get``, but entries which expired less than ``max_stale``
+        seconds ago are still returned.
+
+        Returns a tuple of the value and whether it is stale.
+        """
+        with self._lock:
+            self.lookups += 1
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return (default, False)
+            (expires, value) = entry
+            now = self.clock()
+            if expires + max_stale <= now:
+                del self._data[key]
+                self.misses += 1
+                return (default, False)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return (value, expires <= now)
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict(self, predicate):
+        """Removes all entries for which ``predicate(key, value)`` is true
+        and returns their number.
+        """
+        with self._lock:
+            keys = [k for (k, (_expires, v)) in self._data.items() if predicate(k, v)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class GroupIndex:
+    """A snapshot of the group memberships of all members, mapping each
+    member to the names of its groups.
+
+    The snapshot is only ever replaced as a whole, so lookups need no lock.
+    Members are compared case insensitively, as DNs usually are.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.loaded_at = None
+        self._members = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    @property
+    def age(self):
+        if self.loaded_at is None:
+            return None
+        return self.clock() - self.loaded_at
+
+    def replace(self, members):
+        self._members = {k.lower(): tuple(v) for k, v in members.items()}
+        self.loaded_at = self.clock()
+
+    def get(self, member):
+        return list(self._members.get(member.lower(), ()))
+
+
+class CredentialHasher:
+    """Derives cache keys from credentials, so passwords are never kept
+    in memory in plain text.
+
+    The salt is random per instance, so keys can't be precomputed and
+    are useless outside of the running process.
+    """
+
+    def __init__(self, iterations=HASH_ITERATIONS, salt=None):
+        self.iterations = iterations
+        self.salt = os.urandom(16) if salt is None else salt
+
+    def __call__(self, username, password):
+        digest = hashlib.pbkdf2_hmac(
+            "sha256",
+            password.encode("utf-8"),
+            self.salt + username.encode("utf-8"),
+            self.iterations,
+        )
+        return (username, digest)
+
+
+class IncompleteGroups(list):
+    """The groups of a user found before a group search failed.
+
+    They are used for the current validation, but aren't cached, so the
+    next validation searches again.
+    """
+
+
+class LazyGroups(Sequence):
+    """The names of the groups of a user, which are only looked up with
+    ``func`` when they are first used.
+
+    The result is remembered, so ``func`` is called at most once. The
+    callbacks added with ``add_callback`` get the list of groups after it
+    was looked up. If ``func`` returns ``None`` or ``IncompleteGroups``
+    because the lookup failed, the callbacks aren't called.
+    """
+
+    def __init__(self, func):
+        self._func = func
+        self._groups = None
+        self._failed = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        if self._groups is None:
+            return "<LazyGroups (unresolved)>"
+        return "<LazyGroups %r>" % (self._groups,)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return self.resolve() == list(other)
+
+    __hash__ = None
+
+    @property
+    def resolved(self):
+        return self._groups is not None
+
+    def add_callback(self, callback):
+        with self._lock:
+            if self._groups is None:
+                self._callbacks.append(callback)
+                return
+        if not self._failed:
+            callback(list(self._groups))
+
+    def resolve(self):
+        with self._lock:
+            callbacks = []
+            if self._groups is None:
+                groups = self._func()
+                self._func = None
+                self._failed = groups is None or isinstance(groups, IncompleteGroups)
+                self._groups = [] if groups is None else list(groups)
+                if not self._failed:
+                    callbacks = self._callbacks
+                self._callbacks = []
+        for callback in callbacks:
+            callback(list(self._groups))
+        return self._groups
+
+    def __getitem__(self, index):
+        return self.resolve()[index]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key.
+
+    While a call for a key is running, other callers with the same key
+    wait for it and get its result or exception instead of doing the
+    same work again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,72 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+
+# format of LDAP GeneralizedTime values like modifyTimestamp
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%SZ"
+USN_ATTRIBUTES = ("uSNChanged",)
+
+
+class ChangeWatermark:
+    """Tracks the newest change seen by polling for entries with an
+    ``attribute`` like ``modifyTimestamp`` or ``uSNChanged`` newer than the
+    watermark.
+
+    Timestamps only have a resolution of seconds, so the search includes
+    the watermark itself and entries already seen with it are skipped.
+    """
+
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = self.normalize(value)
+        self._seen = set()
+
+    @classmethod
+    def from_time(cls, attribute, now=None, skew=300):
+        """Returns a watermark for the given time minus ``skew`` seconds,
+        to allow for differences between the local and the server clock.
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+        return cls(attribute, now - timedelta(seconds=skew))
+
+    @property
+    def is_usn(self):
+        return self.attribute in USN_ATTRIBUTES
+
+    def normalize(self, value):
+        if isinstance(value, list):
+            value = value[0]
+        if self.is_usn:
+            return int(value)
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc)
+            return value.strftime(TIMESTAMP_FORMAT)
+        # strip fractions of seconds and time zone, as the values are
+        # compared as strings
+        return str(value)[:14] + "Z"
+
+    def filter(self):
+        if self.is_usn:
+            return "(%s>=%d)" % (self.attribute, self.value + 1)
+        return "(%s>=%s)" % (self.attribute, self.value)
+
+    def update(self, changes):
+        """Takes a list of tuples of the DN and the attribute value of the
+        changed entries and returns the DNs of the ones not seen before.
+        The watermark is moved to the newest value.
+        """
+        changes = [(dn, self.normalize(value)) for (dn, value) in changes]
+        new = [
+            dn
+            for (dn, value) in changes
+            if value > self.value or (value == self.value and dn not in self._seen)
+        ]
+        newest = max((value for (_dn, value) in changes), default=self.value)
+        if newest > self.value:
+            self.value = newest
+            self._seen = set()
+        self._seen.update(dn for (dn, value) in changes if value == self.value)
+        return new
@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+
+# weight of a new measurement in the moving average of the latency
+LATENCY_SMOOTHING = 0.3
+
+
+class ServerHealth:
+    """Circuit breaker and latency tracking for one LDAP server.
+
+    After ``failure_threshold`` consecutive failures the breaker trips and
+    the server should be skipped. Once ``cooldown`` seconds have passed,
+    one caller gets to probe the server via ``start_probe``. A success
+    closes the breaker again, a failure restarts the cooldown. With a
+    ``failure_threshold`` of ``None`` the breaker never trips.
+
+    The ``latency`` is a moving average of the recorded latencies.
+    """
+
+    def __init__(self, server, failure_threshold=3, cooldown=30, clock=time.monotonic):
+        self.server = server
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.tripped_at = None
+        self.probing = False
+        self.latency = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return str(self.server)
+
+    @property
+    def tripped(self):
+        return self.tripped_at is not None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.tripped_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if (
+                self.failure_threshold is not None
+                and self.failures >= self.failure_threshold
+            ):
+                self.tripped_at = self.clock()
+
+    def record_latency(self, seconds):
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def start_probe(self):
+        """Return ``True`` if the caller should probe the tripped server."""
+        with self._lock:
+            if self.tripped_at is None or self.probing:
+                return False
+            if self.clock() - self.tripped_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+
+def order_by_latency(servers, rand=random.random):
+    """Return the servers in random order weighted by their latency.
+
+    The weight of a server is the inverse of its average latency, so the
+    fastest servers are most likely first, while slower ones still get
+    picked now and then to keep their average current. Servers without a
+    measurement come first.
+    """
+    known = [x.latency for x in servers if x.latency is not None]
+    fastest = max(min(known), 1e-6) if known else None
+
+    def key(health):
+        if health.latency is None:
+            return 2.0
+        weight = fastest / max(health.latency, 1e-6)
+        # weighted random sampling without replacement (Efraimidis-Spirakis)
+        return rand() ** (1.0 / weight)
+
+    return sorted(servers, key=key, reverse=True)
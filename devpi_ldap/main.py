@@ -1,13 +1,39 @@
+from .cache import CredentialHasher
+from .cache import GroupIndex
+from .cache import IncompleteGroups
+from .cache import LazyGroups
+from .cache import SingleFlight
+from .cache import TTLCache
+from .changes import ChangeWatermark
+from .changes import USN_ATTRIBUTES
+from .health import ServerHealth
+from .health import order_by_latency
+from .metrics import Metrics
+from .metrics import metric_name
+from .pool import ConcurrencyLimiter
+from .pool import ConnectionPool
+from .pool import LimitExceededError
+from .pool import PoolTimeoutError
+from .shared import SharedCache
+from .shared import SharedStore
 from devpi_server.auth import AuthException
 from devpi_server.log import threadlog
+from ldap3.core.exceptions import LDAPInvalidDnError
 from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.dn import parse_dn
 from pluggy import HookimplMarker
 import argparse
+import functools
 import getpass
 import ldap3
+import math
 import os
+import queue
+import random
 import socket
 import sys
+import threading
+import time
 import warnings
 import yaml
 
@@ -15,6 +41,28 @@ import yaml
 notset = object()
 server_hookimpl = HookimplMarker("devpiserver")
 DEFAULT_TIMEOUT = 10
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAXSIZE = 1000
+DEFAULT_NEGATIVE_CACHE_TTL = 30
+DEFAULT_FALLBACK_MAX_STALE = 3600
+SHARED_CACHE_FILENAME = '.ldap-cache.sqlite'
+DEFAULT_POOL_MINSIZE = 0
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+SERVER_POOL_STRATEGIES = ('FIRST', 'ROUND_ROBIN', 'RANDOM', 'LATENCY')
+DEFAULT_BREAKER_FAILURES = 3
+DEFAULT_BREAKER_COOLDOWN = 30
+DEFAULT_MAX_CONCURRENT = 10
+DEFAULT_MAX_QUEUE = 50
+DEFAULT_QUEUE_TIMEOUT = 5
+DEFAULT_NESTED_MAX_DEPTH = 5
+DEFAULT_NESTED_MAX_GROUPS = 500
+DEFAULT_GROUP_SYNC_INTERVAL = 3600
+GROUP_SYNC_MEMBER_KEYS = ('userdn', 'username')
+DEFAULT_CHANGE_POLL_INTERVAL = 30
+CHANGE_POLL_ATTRIBUTES = ('modifyTimestamp', *USN_ATTRIBUTES)
+# OID of the simple paged results control (RFC 2696)
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
 
 
 def fatal(msg):
@@ -22,6 +70,20 @@ def fatal(msg):
     sys.exit(1)
 
 
+def copy_result(result):
+    # copy the groups as well, so cached results can't be changed by callers
+    result = dict(result)
+    groups = result.get('groups')
+    if groups is not None and not isinstance(groups, LazyGroups):
+        result['groups'] = list(groups)
+    return result
+
+
+def server_name(server):
+    # the name of ldap3 servers is the URL including the port
+    return getattr(server, 'name', None) or str(server)
+
+
 class LDAP(dict):
     ldap3 = ldap3  # for dependency injection
     LDAPException = ldap3.core.exceptions.LDAPException  # for dependency injection
@@ -46,40 +108,237 @@ class LDAP(dict):
             for server in server_pool:
                 if 'url' not in server:
                     fatal("No 'url' in 'server_pool' server config.")
+        self._validate_server_pool_settings()
         if 'user_template' in self:
             if 'user_search' in self:
                 fatal("The LDAP options 'user_template' and 'user_search' are mutually exclusive.")
         else:
             if 'user_search' not in self:
                 fatal("You need to set either 'user_template' or 'user_search' in LDAP config.")
-            self._validate_search_settings('user_search')
-        if 'group_search' not in self:
+            self._validate_search_settings(
+                'user_search', ('group_attribute_name', 'group_attribute_rdn'))
+        if 'group_attribute_name' in self.get('user_search', {}):
+            if 'group_search' in self:
+                fatal("The LDAP option 'group_search' can't be used with 'group_attribute_name' in 'user_search'.")
+            if not isinstance(self['user_search'].get('group_attribute_rdn', False), bool):
+                fatal("The 'group_attribute_rdn' option in LDAP 'user_search' config needs to be true or false.")
+        elif 'group_search' not in self:
             threadlog.info("No group search setup for LDAP.")
         else:
             self._validate_search_settings('group_search')
+        if 'nested_groups' in self:
+            self._validate_nested_groups_settings()
+        if 'group_sync' in self:
+            self._validate_group_sync_settings()
+        if 'change_poll' in self:
+            self._validate_change_poll_settings()
+        self._validate_reuse_settings()
         known_keys = set((
+            'bind_pool',
+            'change_poll',
+            'circuit_breaker',
+            'coalesce_validations',
+            'concurrency_limit',
+            'connect_stagger',
+            'connect_timeout',
+            'connection_pool',
+            'deadline',
+            'dn_cache',
+            'fallback_cache',
+            'group_cache',
+            'group_sync',
+            'lazy_groups',
             'server_pool',
+            'server_pool_active',
+            'server_pool_exhaust',
+            'server_pool_strategy',
+            'shared_cache',
             'url',
             'user_template',
             'user_search',
             'group_search',
             'referrals',
             'reject_as_unknown',
+            'negative_cache',
+            'nested_groups',
+            'receive_timeout',
+            'timeout',
             'tls',
+            'validation_cache',
         ))
         unknown_keys = set(self.keys()) - known_keys
         if unknown_keys:
             fatal("Unknown option(s) '%s' in LDAP config." % ', '.join(
                 sorted(unknown_keys)))
+        self._setup_state()
+
+    def _setup_state(self):
+        # runtime state shared by all validations
+        self._shared_store = None
+        if 'path' in self.get('shared_cache', {}):
+            self._shared_store = SharedStore(self['shared_cache']['path'])
+        self._setup_caches()
+        self._validations_in_flight = SingleFlight()
+        self._group_refreshes = set()
+        self._group_index = GroupIndex()
+        self._group_sync_thread = None
+        self._stop_background = threading.Event()
+        self._change_poll_thread = None
+        self._change_watermark = None
+        self._group_refreshes_lock = threading.Lock()
+        self._server_pool = None
+        self._server_pool_lock = threading.Lock()
+        self._server_health = None
+        self._server_health_by_server = {}
+        self._server_index = 0
+        self._search_pools = {}
+        self._bind_pool = None
+        if 'bind_pool' in self:
+            config = self['bind_pool']
+            self._bind_pool = ConnectionPool(
+                self._anonymous_conn,
+                minsize=config.get('minsize', DEFAULT_POOL_MINSIZE),
+                maxsize=config.get('maxsize', DEFAULT_POOL_MAXSIZE),
+                idle_timeout=config.get('idle_timeout', DEFAULT_POOL_IDLE_TIMEOUT))
+        self._search_pools_lock = threading.Lock()
+        self._local = threading.local()
+        self._metrics = Metrics()
+        # set by the command line diagnostics to count the received bytes
+        self._collect_usage = False
+        if 'server_pool' in self:
+            self._log_urls = [server['url'] for server in self['server_pool']]
+        else:
+            self._log_urls = self['url']
+        self._limiter = None
+        if 'concurrency_limit' in self:
+            config = self['concurrency_limit']
+            self._limiter = ConcurrencyLimiter(
+                config.get('max_concurrent', DEFAULT_MAX_CONCURRENT),
+                max_queue=config.get('max_queue', DEFAULT_MAX_QUEUE),
+                queue_timeout=config.get('queue_timeout', DEFAULT_QUEUE_TIMEOUT))
+
+    def _setup_caches(self):
+        if self._shared_store is None:
+            self._credential_key = CredentialHasher()
+        else:
+            # all processes need the same salt to find each others entries
+            self._credential_key = CredentialHasher(salt=self._shared_store.salt)
+        self._validation_cache = self._cache(
+            'validation_cache', DEFAULT_CACHE_TTL)
+        self._negative_cache = self._cache(
+            'negative_cache', DEFAULT_NEGATIVE_CACHE_TTL)
+        self._group_cache = self._cache('group_cache', DEFAULT_CACHE_TTL)
+        self._dn_cache = self._cache('dn_cache', DEFAULT_CACHE_TTL)
+        self._fallback_cache = self._cache(
+            'fallback_cache', DEFAULT_FALLBACK_MAX_STALE, ttl_key='max_stale')
+        self._nested_group_cache = self._cache('nested_groups', DEFAULT_CACHE_TTL)
+        self._user_dns = self._user_dns_cache()
+
+    def _user_dns_cache(self):
+        # the DNs of searched users, so the ``change_poll`` finds the cached
+        # validations of changed users without a ``dn_cache``
+        if 'change_poll' not in self or 'user_search' not in self:
+            return None
+        caches = [
+            x for x in (self._validation_cache, self._negative_cache)
+            if x is not None]
+        if not caches:
+            return None
+        maxsize = max(x.maxsize for x in caches)
+        ttl = max(x.ttl for x in caches)
+        if self._shared_store is not None:
+            return SharedCache(self._shared_store, 'user_dns', maxsize, ttl)
+        return TTLCache(maxsize=maxsize, ttl=ttl)
 
-    def _validate_search_settings(self, configname):
+    def use_serverdir(self, serverdir):
+        """ Stores the ``shared_cache`` in the state directory of
+            devpi-server, unless it has its own ``path``.
+        """
+        if 'shared_cache' not in self or self._shared_store is not None:
+            return
+        self._shared_store = SharedStore(
+            os.path.join(str(serverdir), SHARED_CACHE_FILENAME))
+        self._setup_caches()
+
+    def _validate_server_pool_settings(self):
+        if self.get('server_pool_strategy', 'ROUND_ROBIN') not in SERVER_POOL_STRATEGIES:
+            fatal("Unknown LDAP 'server_pool_strategy' '%s', use one of %s." % (
+                self['server_pool_strategy'], ', '.join(SERVER_POOL_STRATEGIES)))
+        for key in ('server_pool_active', 'server_pool_exhaust'):
+            value = self.get(key, True)
+            if isinstance(value, bool):
+                continue
+            if not isinstance(value, int) or value <= 0:
+                fatal("LDAP '%s' needs to be true, false or a positive number." % key)
+        if self.get('server_pool_exhaust', False) and not self.get('server_pool_active', True):
+            fatal("LDAP 'server_pool_exhaust' can only be used with 'server_pool_active'.")
+        if 'circuit_breaker' in self:
+            self._validate_number_settings(
+                'circuit_breaker', ('failures', 'cooldown'))
+        if 'connect_stagger' in self:
+            value = self['connect_stagger']
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                fatal("LDAP 'connect_stagger' needs to be a number of seconds.")
+        for key in ('timeout', 'connect_timeout', 'receive_timeout', 'deadline'):
+            value = self.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                fatal("LDAP '%s' needs to be a positive number of seconds." % key)
+
+    def _validate_reuse_settings(self):
+        for key in ('coalesce_validations', 'lazy_groups'):
+            if not isinstance(self.get(key, False), bool):
+                fatal("LDAP '%s' needs to be true or false." % key)
+        for configname in ('validation_cache', 'negative_cache'):
+            if configname in self:
+                self._validate_cache_settings(configname)
+        if 'dn_cache' in self:
+            if 'user_search' not in self:
+                fatal("The LDAP 'dn_cache' can only be used with 'user_search'.")
+            self._validate_number_settings(
+                'dn_cache', ('ttl', 'maxsize', 'negative_ttl'),
+                allow_zero=('negative_ttl',))
+        if 'fallback_cache' in self:
+            self._validate_number_settings(
+                'fallback_cache', ('max_stale', 'maxsize'))
+        if 'shared_cache' in self:
+            config = self['shared_cache']
+            if not isinstance(config, dict):
+                fatal("LDAP 'shared_cache' needs to be a dictionary.")
+            unknown_keys = set(config.keys()) - {'path'}
+            if unknown_keys:
+                fatal("Unknown option(s) '%s' in LDAP 'shared_cache' config." % (
+                    ', '.join(sorted(unknown_keys))))
+            if not isinstance(config.get('path', ''), str):
+                fatal("The 'path' option in LDAP 'shared_cache' config needs to be a string.")
+        if 'group_cache' in self:
+            self._validate_number_settings(
+                'group_cache', ('ttl', 'maxsize', 'max_stale'),
+                allow_zero=('max_stale',))
+        if 'concurrency_limit' in self:
+            self._validate_number_settings(
+                'concurrency_limit',
+                ('max_concurrent', 'max_queue', 'queue_timeout'),
+                allow_zero=('max_queue', 'queue_timeout'))
+        for configname in ('connection_pool', 'bind_pool'):
+            if configname in self:
+                self._validate_number_settings(
+                    configname, ('minsize', 'maxsize', 'idle_timeout'))
+                pool_config = self[configname]
+                if pool_config.get('minsize', DEFAULT_POOL_MINSIZE) > pool_config.get('maxsize', DEFAULT_POOL_MAXSIZE):
+                    fatal("The 'minsize' option in LDAP '%s' config can't be larger than 'maxsize'." % configname)
+        if 'bind_pool' in self and 'userdn' not in self.get('group_search', {'userdn': None}):
+            # the groups would have to be searched with the pooled connection
+            fatal("The LDAP 'bind_pool' can only be used if 'group_search' has a 'userdn'.")
+
+    def _validate_search_settings(self, configname, extra_keys=()):
         config = self[configname]
         for key in ('base', 'filter', 'attribute_name'):
             if key not in config:
                 fatal("Required option '%s' not in LDAP '%s' config." % (
                     key, configname))
         known_keys = set((
-            'base', 'filter', 'scope', 'attribute_name', 'userdn', 'password'))
+            'base', 'filter', 'scope', 'attribute_name', 'userdn', 'password',
+            'page_size', *extra_keys))
         unknown_keys = set(config.keys()) - known_keys
         if unknown_keys:
             fatal("Unknown option(s) '%s' in LDAP '%s' config." % (
@@ -92,6 +351,137 @@ class LDAP(dict):
         if 'userdn' in config:
             if 'password' not in config:
                 fatal("You have to set a 'password' if you use a 'userdn' in LDAP '%s' config." % configname)
+        if 'page_size' in config:
+            page_size = config['page_size']
+            if isinstance(page_size, bool) or not isinstance(page_size, int) or page_size <= 0:
+                fatal("The 'page_size' option in LDAP '%s' config needs to be a positive number." % configname)
+
+    def _validate_nested_groups_settings(self):
+        if 'group_search' not in self:
+            fatal("The LDAP 'nested_groups' can only be used with 'group_search'.")
+        config = self['nested_groups']
+        if not isinstance(config, dict):
+            fatal("LDAP 'nested_groups' needs to be a dictionary.")
+        if not isinstance(config.get('filter'), str):
+            fatal("Required option 'filter' not in LDAP 'nested_groups' config.")
+        self._validate_number_settings(
+            'nested_groups', ('max_depth', 'max_groups', 'ttl', 'maxsize'),
+            other_keys=('filter',))
+
+    def _validate_group_sync_settings(self):
+        if 'group_search' not in self:
+            fatal("The LDAP 'group_sync' can only be used with 'group_search'.")
+        config = self['group_sync']
+        if not isinstance(config, dict):
+            fatal("LDAP 'group_sync' needs to be a dictionary.")
+        for key in ('filter', 'member_attribute'):
+            if not isinstance(config.get(key, ''), str):
+                fatal("The '%s' option in LDAP 'group_sync' config needs to be a string." % key)
+        if 'filter' not in config:
+            fatal("Required option 'filter' not in LDAP 'group_sync' config.")
+        if config.get('member_key', 'userdn') not in GROUP_SYNC_MEMBER_KEYS:
+            fatal("The 'member_key' option in LDAP 'group_sync' config needs to be one of %s." % (
+                ', '.join(GROUP_SYNC_MEMBER_KEYS)))
+        self._validate_number_settings(
+            'group_sync', ('interval', 'max_age'),
+            other_keys=('filter', 'member_attribute', 'member_key'))
+
+    def _validate_change_poll_settings(self):
+        if 'user_search' not in self and 'group_search' not in self:
+            fatal("The LDAP 'change_poll' needs 'user_search' or 'group_search'.")
+        config = self['change_poll']
+        if not isinstance(config, dict):
+            fatal("LDAP 'change_poll' needs to be a dictionary.")
+        attribute = config.get('attribute', 'modifyTimestamp')
+        if attribute not in CHANGE_POLL_ATTRIBUTES:
+            fatal("The 'attribute' option in LDAP 'change_poll' config needs to be one of %s." % (
+                ', '.join(CHANGE_POLL_ATTRIBUTES)))
+        if attribute in USN_ATTRIBUTES and len(self.get('server_pool', ())) > 1:
+            # the update sequence numbers differ between the servers
+            fatal("The 'attribute' '%s' in LDAP 'change_poll' config can only be used with a single server." % (
+                attribute))
+        if not isinstance(config.get('member_attribute', ''), str):
+            fatal("The 'member_attribute' option in LDAP 'change_poll' config needs to be a string.")
+        self._validate_number_settings(
+            'change_poll', ('interval',),
+            other_keys=('attribute', 'member_attribute'))
+
+    def _validate_cache_settings(self, configname):
+        self._validate_number_settings(configname, ('ttl', 'maxsize'))
+
+    def _validate_number_settings(self, configname, keys, allow_zero=('minsize',), other_keys=()):
+        config = self[configname]
+        if not isinstance(config, dict):
+            fatal("LDAP '%s' needs to be a dictionary." % configname)
+        unknown_keys = set(config.keys()) - set(keys) - set(other_keys)
+        if unknown_keys:
+            fatal("Unknown option(s) '%s' in LDAP '%s' config." % (
+                ', '.join(sorted(unknown_keys)), configname))
+        for key in keys:
+            value = config.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                fatal("The '%s' option in LDAP '%s' config needs to be a number." % (
+                    key, configname))
+            if value < 0 or (value == 0 and key not in allow_zero):
+                fatal("The '%s' option in LDAP '%s' config needs to be a positive number." % (
+                    key, configname))
+
+    def _cache(self, configname, default_ttl, ttl_key='ttl'):
+        config = self.get(configname)
+        if config is None:
+            return None
+        maxsize = config.get('maxsize', DEFAULT_CACHE_MAXSIZE)
+        ttl = config.get(ttl_key, default_ttl)
+        if self._shared_store is not None:
+            return SharedCache(self._shared_store, configname, maxsize, ttl)
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def metrics(self):
+        """ Returns the metrics in the format of the ``devpiserver_metrics``
+            hook, a list of ``(name, type, value)`` tuples.
+
+            The counters of each phase (``dn_search``, ``service_bind``,
+            ``user_bind``, ``group_search``) and of each server have the
+            number of calls, errors, total seconds and latency buckets.
+        """
+        result = self._metrics.counters()
+        caches = (
+            ('validation_cache', self._validation_cache),
+            ('negative_cache', self._negative_cache),
+            ('group_cache', self._group_cache),
+            ('dn_cache', self._dn_cache),
+            ('fallback_cache', self._fallback_cache),
+            ('nested_groups_cache', self._nested_group_cache))
+        for name, cache in caches:
+            if cache is None:
+                continue
+            result.extend([
+                ('devpi_ldap_%s_evictions' % name, 'counter', cache.evictions),
+                ('devpi_ldap_%s_hits' % name, 'counter', cache.hits),
+                ('devpi_ldap_%s_lookups' % name, 'counter', cache.lookups),
+                ('devpi_ldap_%s_misses' % name, 'counter', cache.misses),
+                ('devpi_ldap_%s_size' % name, 'gauge', cache.size)])
+        result.append((
+            'devpi_ldap_coalesced_validations', 'counter',
+            self._validations_in_flight.coalesced))
+        limiter = self._limiter
+        if limiter is not None:
+            result.extend([
+                ('devpi_ldap_concurrency_active', 'gauge', limiter.active),
+                ('devpi_ldap_concurrency_waiting', 'gauge', limiter.waiting),
+                ('devpi_ldap_concurrency_rejected', 'counter', limiter.rejected),
+                ('devpi_ldap_concurrency_wait_seconds', 'counter', limiter.wait_time)])
+        with self._search_pools_lock:
+            search_pools = list(self._search_pools.values())
+        if 'connection_pool' in self:
+            result.extend([
+                ('devpi_ldap_connection_pool_size', 'gauge', sum(x.size for x in search_pools)),
+                ('devpi_ldap_connection_pool_idle', 'gauge', sum(x.idle for x in search_pools))])
+        if self._bind_pool is not None:
+            result.extend([
+                ('devpi_ldap_bind_pool_size', 'gauge', self._bind_pool.size),
+                ('devpi_ldap_bind_pool_idle', 'gauge', self._bind_pool.idle)])
+        return result
 
     def server(self):
         warnings.warn("'server()' is deprecated, please use 'server_pool()'.", category=DeprecationWarning, stacklevel=2)
@@ -99,10 +489,118 @@ class LDAP(dict):
 
     def _server(self, url, cfg):
         tls = cfg and self.ldap3.Tls(**cfg)
-        return self.ldap3.Server(url, tls=tls)
+        return self.ldap3.Server(
+            url, tls=tls,
+            connect_timeout=self.get('connect_timeout', self.get('timeout', DEFAULT_TIMEOUT)))
 
     def server_pool(self):
-        server_pool = self.ldap3.ServerPool()
+        # the pool is shared by all connections, so the state of the
+        # servers and the TLS settings are kept between validations
+        with self._server_pool_lock:
+            if self._server_pool is None:
+                self._server_pool = self._build_server_pool()
+            return self._server_pool
+
+    def server_health(self):
+        """ Returns the health of each server of the pool, which is
+            used to pick the servers for each connection.
+        """
+        server_pool = self.server_pool()
+        with self._server_pool_lock:
+            if self._server_health is None:
+                (failures, cooldown) = self._breaker_settings()
+                self._server_health = [
+                    ServerHealth(
+                        server, failure_threshold=failures, cooldown=cooldown)
+                    for server in server_pool.servers]
+                self._server_health_by_server = {
+                    x.server: x for x in self._server_health}
+            return self._server_health
+
+    def _breaker_settings(self):
+        # the failures after which a server is skipped and for how long,
+        # without any of these options failing servers are never skipped
+        if 'circuit_breaker' in self:
+            config = self['circuit_breaker']
+            return (
+                config.get('failures', DEFAULT_BREAKER_FAILURES),
+                config.get('cooldown', DEFAULT_BREAKER_COOLDOWN))
+        exhaust = self.get('server_pool_exhaust', False)
+        if exhaust:
+            return (1, DEFAULT_BREAKER_COOLDOWN if exhaust is True else exhaust)
+        if 'connect_stagger' in self or self.get('server_pool_strategy') == 'LATENCY':
+            return (DEFAULT_BREAKER_FAILURES, DEFAULT_BREAKER_COOLDOWN)
+        return (None, DEFAULT_BREAKER_COOLDOWN)
+
+    def _record_server(self, conn, phase, start, *, error=False):
+        # connect, bind and search time per server, for the metrics
+        self._metrics.record(
+            metric_name('server', server_name(conn.server), phase),
+            time.monotonic() - start, error=error)
+
+    def _received_bytes(self, conn):
+        # only known with the usage statistics of ldap3
+        usage = getattr(conn, 'usage', None) if self._collect_usage else None
+        return None if usage is None else usage.bytes_received
+
+    def _record_latency(self, conn, start):
+        health = self._server_health_by_server.get(conn.server)
+        if health is not None:
+            health.record_latency(time.monotonic() - start)
+
+    def _candidate_servers(self):
+        """ Returns the servers to try in order according to the
+            ``server_pool_strategy``. Servers with a tripped circuit breaker
+            are skipped, unless all of them have tripped.
+        """
+        servers = list(self.server_health())
+        strategy = self.get('server_pool_strategy', 'ROUND_ROBIN')
+        if strategy == 'ROUND_ROBIN':
+            with self._server_pool_lock:
+                start = self._server_index
+                self._server_index = (start + 1) % len(servers)
+            servers = servers[start:] + servers[:start]
+        elif strategy == 'RANDOM':
+            random.shuffle(servers)
+        elif strategy == 'LATENCY':
+            servers = order_by_latency(servers)
+        for health in servers:
+            if health.start_probe():
+                self._run_in_background(self._probe_server, health)
+        healthy = [x for x in servers if not x.tripped]
+        if not healthy:
+            threadlog.warning("All LDAP servers are marked as failing, trying all of them.")
+            return servers
+        return healthy
+
+    def _run_in_background(self, func, *args):
+        thread = threading.Thread(
+            target=func, args=args, name="devpi-ldap-%s" % func.__name__,
+            daemon=True)
+        thread.start()
+        return thread
+
+    def _probe_server(self, health):
+        conn = self.connection(health.server)
+        try:
+            conn.open()
+        except (socket.timeout, self.LDAPException):
+            threadlog.warning("LDAP server %s is still failing." % health)
+            health.record_failure()
+            return
+        threadlog.info("LDAP server %s is reachable again." % health)
+        health.record_success()
+        self._close(conn)
+
+    def _build_server_pool(self):
+        strategy = self.get('server_pool_strategy', 'ROUND_ROBIN')
+        if strategy == 'LATENCY':
+            # servers are picked by devpi-ldap, see _candidate_servers
+            strategy = 'FIRST'
+        server_pool = self.ldap3.ServerPool(
+            pool_strategy=getattr(self.ldap3, strategy),
+            active=self.get('server_pool_active', True),
+            exhaust=self.get('server_pool_exhaust', False))
         if 'server_pool' in self:
             for server in self['server_pool']:
                 server_pool.add(self._server(server['url'], server.get('tls', None)))
@@ -111,13 +609,65 @@ class LDAP(dict):
         return server_pool
 
     def connection(self, server, userdn=None, password=None):
+        kw = {}
+        if self._collect_usage:
+            kw['collect_usage'] = True
         conn = self.ldap3.Connection(
             server,
             auto_referrals=self.get('referrals', True),
-            receive_timeout=self.get('timeout', DEFAULT_TIMEOUT),
-            read_only=True, user=userdn, password=password)
+            receive_timeout=self._receive_timeout(),
+            read_only=True, user=userdn, password=password, **kw)
         return conn
 
+    def _receive_timeout(self):
+        # ldap3 only supports whole seconds for the receive timeout
+        return math.ceil(self.get('receive_timeout', self.get('timeout', DEFAULT_TIMEOUT)))
+
+    def _new_deadline(self):
+        seconds = self.get('deadline')
+        if seconds is None:
+            return None
+        return time.monotonic() + seconds
+
+    def _with_deadline(self, deadline, func, *args):
+        # the deadline is kept per thread, so it doesn't have to be
+        # passed through all methods
+        self._local.deadline = deadline
+        try:
+            return func(*args)
+        finally:
+            self._local.deadline = None
+
+    def _remaining(self, timeout):
+        """ Returns the timeout limited to the time left until the
+            ``deadline`` of the current validation.
+
+            Raises ``AuthException`` if the deadline has passed.
+        """
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._metrics.count('deadline_exceeded')
+            msg = "LDAP validation took longer than the deadline of %s seconds." % self['deadline']
+            threadlog.error(msg)
+            raise AuthException(msg)
+        return min(timeout, remaining)
+
+    def _limit_receive_timeout(self, conn):
+        """ Limits the receive timeout of the connection to the time left
+            until the ``deadline`` of the current validation.
+        """
+        if 'deadline' not in self:
+            return
+        timeout = self._remaining(self._receive_timeout())
+        conn.receive_timeout = math.ceil(timeout)
+        sock = getattr(conn, 'socket', None)
+        if sock is not None:
+            # already open, the socket supports fractions of seconds
+            sock.settimeout(timeout)
+
     def _search_scope(self, config):
         try:
             scopes = {
@@ -138,6 +688,22 @@ class LDAP(dict):
         and if not, attempt to bind such a connection. Return
         None if no suitable connection can be bound.
 
+        side-effect: always mutates config to mask a password.
+        """
+        (search_userdn, search_password) = self._search_credentials(config)
+        if self._needs_search_conn(conn, search_userdn):
+            with self._metrics.timed('service_bind'):
+                (conn, bound) = self._bind(search_userdn, search_password)
+            if not bound:
+                threadlog.error("Search failed, couldn't bind user %s %s: %s" % (search_userdn, config, conn.result))
+                return
+        return conn
+
+    def _search_credentials(self, config):
+        """
+        Return the userdn and password to use for searching with the
+        given config.
+
         side-effect: always mutates config to mask a password.
         """
         search_userdn = config.get('userdn')
@@ -147,115 +713,1102 @@ class LDAP(dict):
         if 'password' in config:
             # obscure password in logs
             config["password"] = "********"  # noqa: S105
-        needs_conn = (
+        return (search_userdn, search_password)
+
+    def _needs_search_conn(self, conn, search_userdn):
+        return (
             conn is None
-            or (search_userdn is not None and conn.user != search_userdn)
-        )
-        if needs_conn:
-            conn = self.connection(
-                self.server_pool(),
-                userdn=search_userdn, password=search_password)
-            if not self._open_and_bind(conn):
-                threadlog.error("Search failed, couldn't bind user %s %s: %s" % (search_userdn, config, conn.result))
-                return
+            or (search_userdn is not None and conn.user != search_userdn))
+
+    def _search_pool(self, conn, config):
+        """
+        Return the pool of bound connections suitable for the search
+        config, or None if the existing connection should be used or
+        no connection pool is configured.
+
+        side-effect: always mutates config to mask a password.
+        """
+        pool_config = self.get('connection_pool')
+        if pool_config is None:
+            return None
+        search_userdn = config.get('userdn')
+        if not self._needs_search_conn(conn, search_userdn):
+            return None
+        (search_userdn, search_password) = self._search_credentials(config)
+        key = (search_userdn, search_password)
+        with self._search_pools_lock:
+            pool = self._search_pools.get(key)
+            if pool is None:
+                pool = self._search_pools[key] = ConnectionPool(
+                    functools.partial(
+                        self._bound_search_conn, search_userdn, search_password),
+                    minsize=pool_config.get('minsize', DEFAULT_POOL_MINSIZE),
+                    maxsize=pool_config.get('maxsize', DEFAULT_POOL_MAXSIZE),
+                    idle_timeout=pool_config.get(
+                        'idle_timeout', DEFAULT_POOL_IDLE_TIMEOUT))
+        return pool
+
+    def _bound_search_conn(self, userdn, password):
+        with self._metrics.timed('service_bind'):
+            (conn, bound) = self._bind(userdn, password)
+        if not bound:
+            threadlog.error("Search failed, couldn't bind user %s: %s" % (userdn, conn.result))
+            return None
+        return conn
+
+    def _anonymous_conn(self):
+        (conn, bound) = self._bind()
+        if not bound:
+            threadlog.error("Anonymous bind for LDAP 'bind_pool' failed: %s" % conn.result)
+            return None
         return conn
 
+    def _bind_user(self, userdn, password):
+        """ Binds as the user to check the password.
+
+            Returns the connection bound as the user, whether the bind was
+            successful and the result of the bind. With the ``bind_pool``
+            the connection is ``None``, because it goes back to the pool.
+        """
+        with self._metrics.timed('user_bind'):
+            if self._bind_pool is None:
+                (conn, bound) = self._bind(userdn, password)
+                return (conn, bound, getattr(conn, 'result', None))
+            return self._pooled_bind(self._bind_pool, userdn, password)
+
+    def _pooled_bind(self, pool, userdn, password):
+        # like with searches, a pooled connection might have been closed
+        # by the server, in that case retry once with a new connection
+        for retry in (False, True):
+            try:
+                conn = pool.acquire(timeout=self._remaining(self.get('timeout', DEFAULT_TIMEOUT)))
+            except PoolTimeoutError as e:
+                threadlog.error("Bind failed: %s" % e)
+                raise AuthException(str(e))
+            if conn is None:
+                msg = "Couldn't bind LDAP connection for 'bind_pool'."
+                threadlog.error(msg)
+                raise AuthException(msg)
+            start = time.monotonic()
+            try:
+                self._limit_receive_timeout(conn)
+                # the server info was read when the connection was opened,
+                # reading it again would cost more than the pool saves
+                bound = conn.rebind(
+                    user=userdn, password=password, read_server_info=False)
+                self._record_server(conn, 'bind', start)
+                self._record_latency(conn, start)
+                result = getattr(conn, 'result', None)
+                # back to the default identity before anyone else uses it
+                conn.user = None
+                conn.password = None
+                conn.rebind(
+                    authentication=self.ldap3.ANONYMOUS, read_server_info=False)
+            except self.LDAPException:
+                self._record_server(conn, 'bind', start, error=True)
+                pool.release(conn, discard=True)
+                if retry:
+                    msg = "Couldn't bind pooled LDAP connection to %s" % conn.server
+                    threadlog.exception(msg)
+                    raise AuthException(msg)
+                threadlog.info("Pooled LDAP connection to %s failed, reconnecting." % conn.server)
+                continue
+            except BaseException:
+                pool.release(conn, discard=True)
+                raise
+            pool.release(conn)
+            return (None, bound, result)
+
     def _search(self, conn, config, **kw):
+        return self._run_search(conn, config, self._search_with, **kw)
+
+    def _run_search(self, conn, config, func, **kw):
+        """ Calls ``func`` with a connection suitable for the search config,
+            the config and the keyword arguments for the search filter.
+
+            Returns ``None`` if no connection could be bound for the search.
+        """
         config = dict(config)
+        pool = self._search_pool(conn, config)
+        if pool is not None:
+            return self._pooled_search(pool, config, func, **kw)
         conn = self._build_search_conn(conn, config)
         if not conn:
-            return []
+            return None
+        return func(conn, config, **kw)
+
+    def _pooled_search(self, pool, config, func, **kw):
+        # a pooled connection might have been closed by the server since
+        # it was last used, in that case retry once with a new connection
+        for retry in (False, True):
+            try:
+                conn = pool.acquire(timeout=self._remaining(self.get('timeout', DEFAULT_TIMEOUT)))
+            except PoolTimeoutError as e:
+                threadlog.error("Search failed: %s" % e)
+                raise AuthException(str(e))
+            if conn is None:
+                return None
+            try:
+                result = func(conn, config, **kw)
+            except self.LDAPException:
+                pool.release(conn, discard=True)
+                if retry:
+                    raise
+                threadlog.info("Pooled LDAP connection to %s failed, reconnecting." % conn.server)
+                continue
+            except BaseException:
+                pool.release(conn)
+                raise
+            pool.release(conn)
+            return result
+
+    def _search_entries(self, conn, config, attributes, **kw):
+        """ Returns the entries found with the search config or ``None``
+            if the search failed.
+
+            With a ``page_size`` in the config, the entries are fetched in
+            pages with the simple paged results control. If any page fails,
+            the whole search failed, so callers never mistake the pages
+            fetched so far for the complete result.
+        """
         escaped_kw = {k: escape_filter_chars(v) for k, v in kw.items()}
-        search_filter = config['filter'].format(**escaped_kw)
-        search_scope = self._search_scope(config)
+        request = dict(
+            search_base=config['base'],
+            search_filter=config['filter'].format(**escaped_kw),
+            search_scope=self._search_scope(config),
+            attributes=attributes)
+        page_size = config.get('page_size')
+        if page_size is None:
+            return self._search_page(conn, config, request)
+        entries = self._search_page(conn, config, request, paged_size=page_size)
+        if entries is None:
+            return None
+        return self._paged_entries(
+            conn, entries, functools.partial(
+                self._search_page, conn, config, request, paged_size=page_size))
+
+    def _search_page(self, conn, config, request, **paging):
+        self._limit_receive_timeout(conn)
+        received = self._received_bytes(conn)
+        start = time.monotonic()
+        try:
+            found = conn.search(
+                request['search_base'], request['search_filter'],
+                search_scope=request['search_scope'],
+                attributes=request['attributes'], **paging)
+        except self.LDAPException:
+            self._record_server(conn, 'search', start, error=True)
+            raise
+        self._record_latency(conn, start)
+        result = getattr(conn, 'result', None)
+        failed = not found and not (
+            isinstance(result, dict) and result.get('result') == 0)
+        self._record_server(conn, 'search', start, error=failed)
+        if received is not None:
+            self._metrics.count(
+                'server', server_name(conn.server), 'search_bytes',
+                value=self._received_bytes(conn) - received)
+        if failed:
+            threadlog.error("Search failed %s %s: %s" % (request['search_filter'], config, conn.result))
+            return None
+        if not found:
+            threadlog.debug("Nothing found for %s %s." % (request['search_filter'], config))
+            return []
+        return conn.response
+
+    def _paged_entries(self, conn, entries, search_page):
+        result = list(entries)
+        while True:
+            cookie = self._paged_cookie(conn)
+            if not cookie:
+                return result
+            entries = search_page(paged_cookie=cookie)
+            if entries is None:
+                return None
+            result.extend(entries)
+
+    def _paged_cookie(self, conn):
+        result = getattr(conn, 'result', None)
+        if not isinstance(result, dict):
+            return None
+        control = (result.get('controls') or {}).get(PAGED_RESULTS_CONTROL, {})
+        return control.get('value', {}).get('cookie')
+
+    def _entry_values(self, entry, attribute_name):
+        """ Returns the values of the attribute of a search result entry as
+            list or ``None`` if the entry doesn't have the attribute.
+        """
+        if 'attributes' not in entry:
+            # referrals and other non entry results
+            return None
+        if attribute_name in entry['attributes']:
+            values = entry['attributes'][attribute_name]
+        elif attribute_name in ('dn', 'distinguishedName') and attribute_name in entry:
+            # some servers like openLDAP don't return the DN as attribute
+            values = entry[attribute_name]
+        else:
+            return None
+        if not isinstance(values, list):
+            values = [values]
+        return values
+
+    def _search_with(self, conn, config, **kw):
+        """ Returns the values of the ``attribute_name`` of the entries
+            found or ``None`` if the search failed.
+        """
+        attribute_name = config['attribute_name']
+        entries = self._search_entries(conn, config, [attribute_name], **kw)
+        if entries is None:
+            return None
+        # a dictionary keeps the order and removes duplicates in linear time
+        result = {}
+        has_entries = False
+        for entry in entries:
+            has_entries = has_entries or 'attributes' in entry
+            values = self._entry_values(entry, attribute_name)
+            if values is not None:
+                result.update(dict.fromkeys(values))
+        if has_entries and not result:
+            threadlog.error('configured attribute_name {} not found in any search results'.format(attribute_name))
+        return list(result)
+
+    def _search_user_with(self, conn, config, **kw):
+        """ Returns a list with a tuple of the DN and the groups for each
+            entry found with the ``user_search`` config, which has to have
+            a ``group_attribute_name``, or ``None`` if the search failed.
+        """
         attribute_name = config['attribute_name']
-        found = conn.search(
-            config['base'], search_filter,
-            search_scope=search_scope, attributes=[attribute_name])
-        if found:
-            if any(attribute_name in x.get('attributes', {}) for x in conn.response):
-                def extract_search(s):
-                    if 'attributes' in s:
-                        attributes = s['attributes'][attribute_name]
-                        if not isinstance(attributes, list):
-                            attributes = [attributes]
-                        return attributes
-                    else:
-                        return []
-            elif attribute_name in ('dn', 'distinguishedName'):
-                def extract_search(s):
-                    return [s[attribute_name]]
+        group_attribute_name = config['group_attribute_name']
+        entries = self._search_entries(
+            conn, config, [attribute_name, group_attribute_name], **kw)
+        if entries is None:
+            return None
+        result = []
+        for entry in entries:
+            if 'attributes' not in entry:
+                continue
+            userdns = self._entry_values(entry, attribute_name)
+            if userdns is None:
+                threadlog.error('configured attribute_name {} not found in search result'.format(attribute_name))
+                continue
+            groups = self._entry_values(entry, group_attribute_name) or []
+            if config.get('group_attribute_rdn', False):
+                groups = [self._rdn_value(x) for x in groups]
+            result.extend((userdn, list(dict.fromkeys(groups))) for userdn in userdns)
+        return result
+
+    def _search_groups(self, conn, config, username, userdn):
+        """ Returns the groups of the user, as ``IncompleteGroups`` if a
+            search failed, so they are used but not cached.
+        """
+        with self._metrics.timed('group_search'):
+            if self._nested_group_cache is None:
+                groups = self._search(conn, config, username=username, userdn=userdn)
             else:
-                threadlog.error('configured attribute_name {} not found in any search results'.format(attribute_name))
-                return []
+                groups = self._run_search(
+                    conn, config, self._nested_groups_with,
+                    username=username, userdn=userdn)
+        if groups is None:
+            threadlog.error("Searching groups of '%s' failed, using no groups." % userdn)
+            return IncompleteGroups()
+        return groups
 
-            return sum((extract_search(x) for x in conn.response), [])
-        else:
-            threadlog.error("Search failed %s %s: %s" % (search_filter, config, conn.result))
-            return []
+    def _nested_groups_with(self, conn, config, **kw):
+        """ Returns the groups found with the ``group_search`` config and
+            the groups those are members of, breadth first up to
+            ``max_depth`` levels and ``max_groups`` groups in total.
+
+            If searching the parents of a group failed, the groups found
+            so far are returned as ``IncompleteGroups``.
+        """
+        nested = self['nested_groups']
+        max_depth = nested.get('max_depth', DEFAULT_NESTED_MAX_DEPTH)
+        max_groups = nested.get('max_groups', DEFAULT_NESTED_MAX_GROUPS)
+        attribute_name = config['attribute_name']
+        entries = self._search_entries(conn, config, [attribute_name], **kw)
+        if entries is None:
+            return None
+        # the names of each group by DN, in the order they were found
+        found = dict(self._group_entries(entries, attribute_name))
+        level = list(found)
+        depth = 0
+        failed = False
+        while level and depth < max_depth:
+            depth += 1
+            parents = []
+            for groupdn in level:
+                group_parents = self._parent_groups(conn, config, groupdn)
+                if group_parents is None:
+                    threadlog.error("Searching parent groups of '%s' failed." % groupdn)
+                    failed = True
+                    continue
+                parents.extend(group_parents)
+            level = []
+            for (groupdn, names) in parents:
+                if groupdn in found:
+                    continue
+                if len(found) >= max_groups:
+                    threadlog.warning("Stopped nested group search for '%s' after %s groups." % (
+                        kw.get('userdn'), max_groups))
+                    level = []
+                    break
+                found[groupdn] = names
+                level.append(groupdn)
+        groups = dict.fromkeys(
+            name for names in found.values() for name in names)
+        if failed:
+            return IncompleteGroups(groups)
+        return list(groups)
 
-    def _open_and_bind(self, conn):
+    def _parent_groups(self, conn, config, groupdn):
+        """ Returns the DN and names of the groups the group is a direct
+            member of. The result is remembered for the ``ttl`` of the
+            ``nested_groups`` config, so groups shared by many users are
+            only searched once. Returns ``None`` if the search failed.
+        """
+        cache = self._nested_group_cache
+        parents = cache.get(groupdn)
+        if parents is None:
+            attribute_name = config['attribute_name']
+            nested_config = dict(config, filter=self['nested_groups']['filter'])
+            entries = self._search_entries(
+                conn, nested_config, [attribute_name], groupdn=groupdn)
+            if entries is None:
+                return None
+            parents = tuple(self._group_entries(entries, attribute_name))
+            cache.put(groupdn, parents)
+        return parents
+
+    def _group_entries(self, entries, attribute_name):
+        # yields the DN and the names of each group entry
+        for entry in entries:
+            names = self._entry_values(entry, attribute_name)
+            if names is not None:
+                yield (entry.get('dn'), tuple(names))
+
+    def _rdn_value(self, dn):
+        """ Returns the value of the first RDN of the DN, so the group
+            names can be used in ACLs.
+        """
         try:
-            conn.open()
-            if not conn.bind():
-                return False
+            return parse_dn(dn)[0][1]
+        except (LDAPInvalidDnError, IndexError):
+            return dn
+
+    def _server_call(self, conn, phase, func):
+        # calls the open or bind method of the connection, recording the
+        # time per server and turning errors into an AuthException
+        start = time.monotonic()
+        try:
+            result = func()
         except socket.timeout:
+            self._record_server(conn, phase, start, error=True)
+            self._metrics.count('timeouts')
             msg = "Timeout on LDAP connect to %s" % conn.server
             threadlog.exception(msg)
             # TODO: is re-raising an exception here still correct with a pool? Can it still happen?
             raise AuthException(msg)
         except self.LDAPException:
+            self._record_server(conn, phase, start, error=True)
             msg = "Couldn't open LDAP connection to %s" % conn.server
             threadlog.exception(msg)
             # TODO: is re-raising an exception here still correct with a pool? Can it still happen?
             raise AuthException(msg)
-        return True
+        self._record_server(conn, phase, start)
+        return result
+
+    def _bind(self, userdn=None, password=None):
+        """ Opens a connection and binds with the given credentials.
+
+            Returns the connection and whether the bind was successful.
+            Raises ``AuthException`` if no server could be reached.
+        """
+        # the servers are picked here instead of by the ldap3 server pool,
+        # which only keeps its state per connection
+        candidates = self._candidate_servers()
+        if 'connect_stagger' in self and len(candidates) > 1:
+            (health, conn, start) = self._race_open(candidates, userdn, password)
+            (result, error) = self._bind_opened(health, conn, start)
+            if error is not None:
+                raise error
+            return result
+        active = self.get('server_pool_active', True)
+        if active is False:
+            candidates = candidates[:1]
+        elif active is not True:
+            # the number of cycles through the servers
+            candidates = candidates * active
+        for index, health in enumerate(candidates):
+            if index:
+                self._metrics.count('failovers')
+            (result, error) = self._bind_server(health, userdn, password)
+            if error is None:
+                return result
+        raise error
+
+    def _open_server(self, health, userdn, password):
+        """ Returns a tuple of the opened connection and the time the
+            attempt started and ``None`` or ``None`` and the exception
+            raised while trying to open it.
+        """
+        conn = self.connection(
+            health.server, userdn=userdn, password=password)
+        try:
+            # running out of time isn't a failure of the server
+            self._limit_receive_timeout(conn)
+        except AuthException as e:
+            return (None, e)
+        start = time.monotonic()
+        try:
+            self._server_call(conn, 'connect', conn.open)
+        except Exception as e:  # noqa: BLE001 - re-raised by caller
+            health.record_failure()
+            return (None, e)
+        return ((conn, start), None)
+
+    def _bind_opened(self, health, conn, start):
+        """ Returns a tuple of the connection and bind result and ``None``
+            or ``None`` and the exception raised while trying to bind.
+        """
+        try:
+            bound = self._server_call(conn, 'bind', conn.bind)
+        except Exception as e:  # noqa: BLE001 - re-raised by caller
+            health.record_failure()
+            return (None, e)
+        self._record_latency(conn, start)
+        health.record_success()
+        return ((conn, bool(bound)), None)
+
+    def _bind_server(self, health, userdn, password):
+        """ Returns a tuple of the connection and bind result and ``None``
+            or ``None`` and the exception raised while trying to bind.
+        """
+        (opened, error) = self._open_server(health, userdn, password)
+        if error is not None:
+            return (None, error)
+        return self._bind_opened(health, *opened)
+
+    def _race_open(self, candidates, userdn, password):
+        """ Starts connecting to the first server and after
+            ``connect_stagger`` seconds without a result to the next one
+            and so on. A failed attempt starts the next one right away.
+
+            Returns the server health, connection and start time of the
+            first attempt which reaches a server, the connections of the
+            other attempts are closed when they finish. Only the open is
+            raced, so the credentials are bound just once on the returned
+            connection and a wrong password doesn't count several times
+            towards a lockout.
+        """
+        stagger = self['connect_stagger']
+        deadline = getattr(self._local, 'deadline', None)
+        results = queue.Queue()
+        lock = threading.Lock()
+        finished = []
+
+        def attempt(health):
+            (opened, error) = self._with_deadline(
+                deadline, self._open_server, health, userdn, password)
+            with lock:
+                if not finished:
+                    results.put((health, opened, error))
+                    return
+            if opened is not None:
+                self._close(opened[0])
+
+        remaining = list(candidates)
+        pending = 0
+        error = None
+        while True:
+            if remaining:
+                if len(remaining) < len(candidates):
+                    self._metrics.count('failovers')
+                self._run_in_background(attempt, remaining.pop(0))
+                pending += 1
+            try:
+                (health, opened, error) = results.get(
+                    timeout=stagger if remaining else None)
+            except queue.Empty:
+                continue
+            pending -= 1
+            if error is None or (not pending and not remaining):
+                break
+        with lock:
+            finished.append(True)
+        while not results.empty():
+            (_health, other, _error) = results.get()
+            if other is not None:
+                self._close(other[0])
+        if error is not None:
+            raise error
+        return (health, *opened)
+
+    def _close(self, conn):
+        try:
+            conn.unbind()
+        except self.LDAPException:
+            threadlog.debug("Error while closing LDAP connection to %s." % conn.server)
 
     def _userdn(self, username):
+        return self._lookup_user(username)[0]
+
+    def _lookup_user(self, username):
+        """ Returns the DN of the user and the groups if the ``user_search``
+            has a ``group_attribute_name``, otherwise ``None`` for them.
+        """
         if 'user_template' in self:
-            return self['user_template'].format(username=username)
+            return (self['user_template'].format(username=username), None)
+        cache = self._dn_cache
+        user = notset if cache is None else cache.get(username, notset)
+        if user is notset:
+            with self._metrics.timed('dn_search'):
+                user = self._search_user(username)
+            # only reached if the search succeeded
+            if cache is not None:
+                if user[0] is not None:
+                    cache.put(username, user)
+                elif self['dn_cache'].get('negative_ttl', DEFAULT_NEGATIVE_CACHE_TTL):
+                    cache.put(username, user, ttl=self['dn_cache'].get(
+                        'negative_ttl', DEFAULT_NEGATIVE_CACHE_TTL))
+        if self._user_dns is not None and user[0] is not None:
+            self._user_dns.put(username, user[0])
+        return user
+
+    def _search_user(self, username):
+        """ Returns the DN and groups of the user or ``None`` for them if
+            there is no single user with the name.
+
+            Raises ``AuthException`` if the search failed, so it isn't
+            mistaken for an unknown user.
+        """
+        config = self['user_search']
+        if 'group_attribute_name' in config:
+            result = self._run_search(
+                None, config, self._search_user_with, username=username)
         else:
-            result = self._search(None, self['user_search'], username=username)
-            if len(result) == 1:
-                return result[0]
-            elif not result:
-                threadlog.info("No user '%s' found." % username)
-            else:
-                threadlog.error("Multiple results for user '%s' found.")
+            result = self._search(None, config, username=username)
+            if result is not None:
+                result = [(userdn, None) for userdn in result]
+        if result is None:
+            msg = "Searching LDAP user '%s' failed." % username
+            threadlog.error(msg)
+            raise AuthException(msg)
+        if len(result) == 1:
+            return result[0]
+        elif not result:
+            threadlog.info("No user '%s' found." % username)
+        else:
+            threadlog.error("Multiple results for user '%s' found." % username)
+        return (None, None)
+
+    def _is_missing_object(self, result):
+        # whether a failed bind was caused by a DN which doesn't exist
+        if not isinstance(result, dict):
+            return False
+        if result.get('result') == 32:  # noSuchObject
+            return True
+        # Active Directory reports invalidCredentials with sub code 525
+        return result.get('result') == 49 and 'data 525' in (result.get('message') or '')
 
     def _rejection(self):
+        self._metrics.count('rejections')
         reject_as_unknown = self.get('reject_as_unknown', True)
         if reject_as_unknown:
             return dict(status="unknown")
         return dict(status="reject")
 
-    def validate(self, username, password):
+    def validate(self, username, password, *, lazy_groups=False):
         """ Tries to bind the user against the LDAP server using the supplied
             username and password.
 
             Returns a dictionary with status and if configured groups of the
             authenticated user.
+
+            With ``lazy_groups`` the groups are a ``LazyGroups`` sequence,
+            which only searches them when it is first used.
+
+            If a ``validation_cache`` is configured, successful results are
+            remembered for the configured time, keyed by the username and a
+            salted hash of the password. The ``negative_cache`` does the same
+            for failed validations. With ``coalesce_validations`` concurrent
+            calls with the same credentials share one LDAP validation.
         """
-        if 'server_pool' in self:
-            threadlog.debug("Validating user '%s' against LDAP at %s." % (username, [
-                server['url'] for server in self['server_pool']
-            ]))
+        with self._metrics.timed('validation'):
+            result = self._validate_request(username, password, lazy_groups)
+        self._metrics.count('validations', result['status'])
+        return result
+
+    def _validate_request(self, username, password, lazy_groups):
+        self._start_change_poll()
+        caches = [
+            x for x in (
+                self._validation_cache, self._negative_cache,
+                self._fallback_cache)
+            if x is not None]
+        coalesce = self.get('coalesce_validations', False)
+        if not caches and not coalesce:
+            return self._validate(username, password, lazy_groups=lazy_groups)
+        key = self._credential_key(username, password)
+        result = self._cached_validation(
+            key, username, password, lazy_groups=lazy_groups)
+        if result is not None:
+            return result
+        if not coalesce:
+            return self._validate_and_cache(
+                key, username, password, lazy_groups=lazy_groups)
+        # concurrent validations with the same credentials share the result
+        return copy_result(self._validations_in_flight.do(
+            (*key, lazy_groups), functools.partial(
+                self._validate_and_cache, lazy_groups=lazy_groups),
+            key, username, password))
+
+    def _cached_validation(self, key, username, password, *, lazy_groups=False):
+        for cache in (self._validation_cache, self._negative_cache):
+            result = None if cache is None else cache.get(key)
+            if result is None:
+                continue
+            if result.get('groups', notset) is None:
+                # cached before the groups of a lazy validation were used
+                if not lazy_groups:
+                    return None
+                threadlog.debug("Using cached LDAP validation of user '%s' without groups." % username)
+                return dict(status="ok", groups=LazyGroups(functools.partial(
+                    self._validated_groups, key, username, password)))
+            threadlog.debug("Using cached LDAP validation of user '%s'." % username)
+            return copy_result(result)
+        return None
+
+    def _validated_groups(self, key, username, password):
+        # the groups for a cached validation without them, found with a
+        # new validation, which also replaces the cached one
+        try:
+            result = self._validate(username, password)
+        except (AuthException, self.LDAPException):
+            threadlog.exception("Searching groups of '%s' failed, using no groups." % username)
+            return None
+        if result['status'] != "ok" and self._validation_cache is not None:
+            self._validation_cache.invalidate(key)
+        self._cache_validation(key, result)
+        return result.get('groups')
+
+    def _cache_validation(self, key, result):
+        if isinstance(result.get("groups"), IncompleteGroups):
+            # the groups might be complete again with the next validation
+            return
+        if result["status"] == "ok":
+            cache = self._validation_cache
         else:
-            threadlog.debug("Validating user '%s' against LDAP at %s." % (username, self['url']))
-        userdn = self._userdn(username)
+            cache = self._negative_cache
+        if cache is not None:
+            cache.put(key, copy_result(result))
+        fallback = self._fallback_cache
+        if fallback is not None:
+            if result["status"] != "ok":
+                fallback.invalidate(key)
+            elif result.get("groups", notset) is not None or fallback.get(key) is None:
+                # one without groups doesn't replace one with groups
+                fallback.put(key, copy_result(result))
+
+    def _fallback(self, key, username):
+        """ Returns the last successful validation with the same credentials
+            if there is one in the ``fallback_cache``.
+        """
+        if self._fallback_cache is None:
+            return None
+        result = self._fallback_cache.get(key)
+        if result is None:
+            return None
+        threadlog.warning("LDAP not available, using last successful validation of user '%s'." % username)
+        if result.get("groups", notset) is None:
+            # the groups weren't known when it was cached
+            return dict(result, groups=IncompleteGroups())
+        return copy_result(result)
+
+    def _early_fallback(self, key, username):
+        # with all servers failing, don't wait for the connection attempts
+        if self._fallback_cache is None or 'circuit_breaker' not in self:
+            return None
+        if not all(x.tripped for x in self.server_health()):
+            return None
+        return self._fallback(key, username)
+
+    def _validate_and_cache(self, key, username, password, *, lazy_groups=False):
+        result = self._early_fallback(key, username)
+        if result is not None:
+            return result
+        try:
+            result = self._validate(username, password, lazy_groups=lazy_groups)
+        except (AuthException, self.LDAPException):
+            result = self._fallback(key, username)
+            if result is None:
+                raise
+            return result
+        groups = result.get('groups')
+        if isinstance(groups, LazyGroups):
+            # remembered right away without the groups and again with them
+            # once they are known
+            self._cache_validation(key, dict(status="ok", groups=None))
+            groups.add_callback(lambda groups: self._cache_validation(
+                key, dict(status="ok", groups=groups)))
+            return result
+        self._cache_validation(key, result)
+        return result
+
+    def _log_validation(self, username):
+        # only formatted if debug logging is enabled
+        threadlog.debug("Validating user '%s' against LDAP at %s.", username, self._log_urls)
+
+    def _acquire_slot(self):
+        limiter = self._limiter
+        if limiter is None:
+            return
+        try:
+            waited = limiter.acquire()
+        except LimitExceededError as e:
+            msg = "Too many concurrent LDAP validations: %s" % e
+            threadlog.warning(msg)
+            raise AuthException(msg) from e
+        if waited:
+            threadlog.debug("Waited %.3f seconds for LDAP validation slot, %s more waiting." % (
+                waited, limiter.waiting))
+
+    def _release_slot(self):
+        if self._limiter is not None:
+            self._limiter.release()
+
+    def _validate(self, username, password, *, lazy_groups=False):
+        return self._with_deadline(
+            self._new_deadline(), self._validate_limited, username, password,
+            lazy_groups)
+
+    def _validate_limited(self, username, password, lazy_groups):
+        # the number of concurrent validations is limited by the
+        # ``concurrency_limit`` to protect the LDAP server
+        self._acquire_slot()
+        try:
+            return self._validate_user(username, password, lazy_groups=lazy_groups)
+        finally:
+            self._release_slot()
+
+    def _resolve_groups(self, conn, config, username, userdn):
+        # called when the groups of a lazy validation are first used, the
+        # deadline starts then and not with the validation
+        try:
+            return self._with_deadline(
+                self._new_deadline(), self._resolve_groups_limited,
+                conn, config, username, userdn)
+        finally:
+            # the connection bound as the user isn't needed anymore, with
+            # the ``bind_pool`` there is none
+            if conn is not None:
+                self._close(conn)
+
+    def _resolve_groups_limited(self, conn, config, username, userdn):
+        self._acquire_slot()
+        try:
+            return self._groups(conn, config, username, userdn)
+        except (AuthException, self.LDAPException):
+            threadlog.exception("Searching groups of '%s' failed, using no groups." % userdn)
+            return None
+        finally:
+            self._release_slot()
+
+    def _validate_user(self, username, password, *, lazy_groups=False):
+        self._log_validation(username)
+        (userdn, groups) = self._lookup_user(username)
         if not userdn:
             return dict(status="unknown")
         if not password.strip():
             return self._rejection()
-        conn = self.connection(self.server_pool(), userdn=userdn, password=password)
-        if not self._open_and_bind(conn):
+        (conn, bound, result) = self._bind_user(userdn, password)
+        if not bound and self._dn_cache is not None and self._is_missing_object(result):
+            # the cached DN might be outdated
+            threadlog.info("Bind with DN '%s' of user '%s' failed, looking it up again." % (userdn, username))
+            self._dn_cache.invalidate(username)
+            old_userdn = userdn
+            (userdn, groups) = self._lookup_user(username)
+            if not userdn:
+                return dict(status="unknown")
+            if userdn != old_userdn:
+                (conn, bound, result) = self._bind_user(userdn, password)
+        if not bound:
             return self._rejection()
-        config = self.get('group_search', None)
-        if not config:
-            return dict(status="ok")
-        groups = self._search(conn, config, username=username, userdn=userdn)
+        if groups is None:
+            # not already found with the user search
+            config = self.get('group_search', None)
+            if not config:
+                return dict(status="ok")
+            if lazy_groups:
+                groups = LazyGroups(functools.partial(
+                    self._resolve_groups, conn, config, username, userdn))
+            else:
+                groups = self._groups(conn, config, username, userdn)
         return dict(status="ok", groups=groups)
 
+    def _groups(self, conn, config, username, userdn):
+        """ Returns the groups of the user, using the ``group_sync`` snapshot
+            or the ``group_cache`` if configured.
+
+            After the ``ttl`` of a cache entry expired, it is still used for
+            up to ``max_stale`` seconds while it is refreshed in the
+            background.
+        """
+        groups = self._synced_groups(username, userdn)
+        if groups is not None:
+            return groups
+        cache = self._group_cache
+        if cache is None:
+            return self._search_groups(conn, config, username, userdn)
+        key = (username, userdn)
+        max_stale = self['group_cache'].get('max_stale', cache.ttl)
+        (groups, stale) = cache.get_stale(key, max_stale)
+        if groups is None:
+            groups = self._search_groups(conn, config, username, userdn)
+            if not isinstance(groups, IncompleteGroups):
+                cache.put(key, tuple(groups))
+            return groups
+        if stale:
+            with self._group_refreshes_lock:
+                refresh = key not in self._group_refreshes
+                self._group_refreshes.add(key)
+            if refresh:
+                threadlog.debug("Refreshing groups of '%s' in background." % userdn)
+                self._run_in_background(
+                    self._refresh_groups, conn, config, username, userdn)
+        return list(groups)
+
+    def _synced_groups(self, username, userdn):
+        # returns None if the snapshot can't be used (yet)
+        config = self.get('group_sync')
+        if config is None:
+            return None
+        with self._group_refreshes_lock:
+            if self._group_sync_thread is None:
+                self._group_sync_thread = self._run_in_background(
+                    self._group_sync_loop)
+        age = self._group_index.age
+        max_age = config.get(
+            'max_age', 3 * config.get('interval', DEFAULT_GROUP_SYNC_INTERVAL))
+        if age is None or age > max_age:
+            threadlog.debug("No current LDAP group snapshot, searching groups of '%s'." % userdn)
+            return None
+        if config.get('member_key', 'userdn') == 'username':
+            return self._group_index.get(username)
+        return self._group_index.get(userdn)
+
+    def _group_sync_loop(self):
+        interval = self['group_sync'].get('interval', DEFAULT_GROUP_SYNC_INTERVAL)
+        while True:
+            self.sync_groups()
+            if self._stop_background.wait(interval):
+                return
+
+    def sync_groups(self):
+        """ Loads all groups matching the ``filter`` of the ``group_sync``
+            config with their members into the snapshot used for looking up
+            the groups of users.
+
+            Returns whether it succeeded, on failure the old snapshot is kept.
+        """
+        config = dict(self['group_search'], filter=self['group_sync']['filter'])
+        start = time.monotonic()
+        try:
+            members = self._run_search(None, config, self._group_members_with)
+        except (AuthException, self.LDAPException):
+            threadlog.exception("Syncing LDAP groups failed.")
+            return False
+        if not isinstance(members, dict):
+            threadlog.error("Syncing LDAP groups failed.")
+            return False
+        self._group_index.replace(members)
+        threadlog.info("Synced LDAP groups of %s members in %.3f seconds." % (
+            len(members), time.monotonic() - start))
+        return True
+
+    def _group_members_with(self, conn, config):
+        """ Returns a dictionary with the names of the groups of each
+            member or ``None`` if the search failed.
+        """
+        attribute_name = config['attribute_name']
+        member_attribute = self['group_sync'].get('member_attribute', 'member')
+        entries = self._search_entries(
+            conn, config, [attribute_name, member_attribute])
+        if entries is None:
+            return None
+        members = {}
+        for entry in entries:
+            names = self._entry_values(entry, attribute_name)
+            if names is None:
+                continue
+            for member in self._entry_values(entry, member_attribute) or []:
+                members.setdefault(member.lower(), {}).update(dict.fromkeys(names))
+        return members
+
+    def _start_change_poll(self):
+        if 'change_poll' not in self or self._change_poll_thread is not None:
+            return
+        with self._group_refreshes_lock:
+            if self._change_poll_thread is None:
+                self._change_poll_thread = self._run_in_background(
+                    self._change_poll_loop)
+
+    def _change_poll_loop(self):
+        interval = self['change_poll'].get('interval', DEFAULT_CHANGE_POLL_INTERVAL)
+        while True:
+            self.poll_changes()
+            if self._stop_background.wait(interval):
+                return
+
+    def _poll_configs(self):
+        # the search configs for the distinct bases of users and groups
+        configs = {}
+        for configname in ('user_search', 'group_search'):
+            if configname in self:
+                configs.setdefault(self[configname]['base'], self[configname])
+        return list(configs.values())
+
+    def poll_changes(self):
+        """ Searches the entries below the bases of the ``user_search`` and
+            ``group_search`` which changed since the last poll according to
+            the ``attribute`` of the ``change_poll`` config and removes the
+            cache entries affected by them.
+
+            The first poll only determines the starting point.
+            Returns whether it succeeded.
+        """
+        try:
+            if self._change_watermark is None:
+                self._change_watermark = self._initial_watermark()
+                return self._change_watermark is not None
+            watermark = self._change_watermark
+            changed = []
+            for config in self._poll_configs():
+                entries = self._run_search(
+                    None, dict(config, filter=watermark.filter()),
+                    self._changed_entries_with)
+                if entries is None:
+                    return False
+                changed.extend(entries)
+        except (AuthException, self.LDAPException):
+            threadlog.exception("Polling LDAP changes failed.")
+            return False
+        new = set(watermark.update([(x[0], x[1]) for x in changed]))
+        changed = [x for x in changed if x[0] in new]
+        if changed:
+            evicted = self._evict_changed(changed)
+            threadlog.info("Removed %s cache entries affected by %s changed LDAP entries." % (
+                evicted, len(changed)))
+        return True
+
+    def _initial_watermark(self):
+        attribute = self['change_poll'].get('attribute', 'modifyTimestamp')
+        if attribute not in USN_ATTRIBUTES:
+            return ChangeWatermark.from_time(attribute)
+        # the update sequence number is specific to each server
+        config = dict(
+            self._poll_configs()[0],
+            base='', filter='(objectClass=*)', scope='base-object')
+        config.pop('page_size', None)
+        usn = self._run_search(None, config, self._highest_usn_with)
+        if not isinstance(usn, int):
+            threadlog.error("Couldn't get the highestCommittedUSN of the LDAP server.")
+            return None
+        return ChangeWatermark(attribute, usn)
+
+    def _highest_usn_with(self, conn, config):
+        for entry in self._search_entries(conn, config, ['highestCommittedUSN']) or []:
+            values = self._entry_values(entry, 'highestCommittedUSN')
+            if values:
+                return int(values[0])
+        return None
+
+    def _changed_entries_with(self, conn, config):
+        """ Returns a list of tuples of the DN, the change attribute, the
+            group names and the members of each changed entry or ``None`` if
+            the search failed.
+        """
+        attribute = self['change_poll'].get('attribute', 'modifyTimestamp')
+        member_attribute = self['change_poll'].get('member_attribute', 'member')
+        attributes = [attribute, member_attribute]
+        group_attribute = self.get('group_search', {}).get('attribute_name')
+        if group_attribute is not None:
+            attributes.append(group_attribute)
+        entries = self._search_entries(conn, config, attributes)
+        if entries is None:
+            return None
+        result = []
+        for entry in entries:
+            values = self._entry_values(entry, attribute)
+            if not values or not entry.get('dn'):
+                continue
+            names = []
+            if group_attribute is not None:
+                names = self._entry_values(entry, group_attribute) or []
+            members = self._entry_values(entry, member_attribute) or []
+            result.append((entry['dn'], values[0], names, members))
+        return result
+
+    def _evict_changed(self, changed):
+        """ Removes the cache entries of changed users and of users which
+            are or were members of changed groups. Returns their number.
+        """
+        changed_dns = {x[0].lower() for x in changed}
+        group_names = {name for x in changed for name in x[2]}
+        # users whose entry or group membership changed
+        affected = changed_dns | {m.lower() for x in changed for m in x[3]}
+        usernames = set()
+
+        def user_changed(username, userdn):
+            if userdn is not None and userdn.lower() in affected:
+                usernames.add(username)
+                return True
+            return False
+
+        def groups_changed(groups):
+            return not group_names.isdisjoint(groups or ())
+
+        def template_userdn(username):
+            if 'user_template' in self:
+                return self['user_template'].format(username=username)
+            return None
+
+        evicted = 0
+        if self._user_dns is not None:
+            # not counted, it only tells the usernames of changed users
+            self._user_dns.evict(user_changed)
+        # the DN and group caches first, to learn the usernames
+        if self._dn_cache is not None:
+            evicted += self._dn_cache.evict(
+                lambda k, v: user_changed(k, v[0]) or groups_changed(v[1]))
+        if self._group_cache is not None:
+            evicted += self._group_cache.evict(
+                lambda k, v: user_changed(*k) or groups_changed(v))
+        if self._nested_group_cache is not None:
+            evicted += self._nested_group_cache.evict(
+                lambda k, v: k.lower() in affected or any(
+                    dn is not None and dn.lower() in changed_dns for (dn, _names) in v))
+        for cache in (self._validation_cache, self._negative_cache):
+            if cache is not None:
+                evicted += cache.evict(
+                    lambda k, v: k[0] in usernames
+                    or user_changed(k[0], template_userdn(k[0]))
+                    or groups_changed(v.get('groups')))
+        return evicted
+
+    def _refresh_groups(self, conn, config, username, userdn):
+        # the connection of the validation is handed over to this thread
+        key = (username, userdn)
+        try:
+            groups = self._search_groups(conn, config, username, userdn)
+        except (AuthException, self.LDAPException):
+            threadlog.exception("Refreshing groups of '%s' failed." % userdn)
+        else:
+            if not isinstance(groups, IncompleteGroups):
+                self._group_cache.put(key, tuple(groups))
+        finally:
+            with self._group_refreshes_lock:
+                self._group_refreshes.discard(key)
+
 
 class LDAPConfigAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -271,6 +1824,31 @@ def devpiserver_add_parser_options(parser):
         help="LDAP configuration file")
 
 
+def groups_used_lazily(ldap, request):
+    """ Whether the groups of the user can be searched only when an ACL
+        check uses them.
+
+        Logins and the ``+api`` view serialize the groups, so they always
+        get them right away, as do all requests changing something.
+    """
+    if not ldap.get('lazy_groups', False) or request is None:
+        return False
+    if getattr(request, 'method', None) not in ('GET', 'HEAD'):
+        return False
+    route = getattr(request, 'matched_route', None)
+    return route is None or not (
+        route.name.endswith('/+api') or route.name == '/+login')
+
+
+@server_hookimpl
+def devpiserver_metrics(request):
+    # the LDAP config is only loaded with the first authentication
+    ldap = request.registry.get("devpi_ldap")
+    if ldap is None:
+        return []
+    return ldap.metrics()
+
+
 # because we are making network requests this plugin should run
 # last, so other plugins which don't require network requests are
 # running first and can possibly shortcut the authentication
@@ -289,6 +1867,12 @@ def devpiserver_auth_request(
             ldap_config = LDAP(configfile)
         if isinstance(ldap_config, dict) and not isinstance(ldap_config, LDAP):
             ldap_config = LDAP(ldap_config)
+        if ldap_config is not None:
+            # server_path replaced the deprecated serverdir in devpi-server 6.x
+            serverdir = getattr(xom.config, 'server_path', None)
+            if serverdir is None:
+                serverdir = xom.config.serverdir
+            ldap_config.use_serverdir(serverdir)
         request.registry["devpi_ldap"] = ldap_config
     ldap = request.registry["devpi_ldap"]
     if ldap is None:
@@ -297,7 +1881,16 @@ def devpiserver_auth_request(
     # check for cached result
     result = getattr(request, "__devpi_ldap_validate_result", notset)
     if result is notset:
-        result = ldap.validate(username, password)
+        try:
+            if groups_used_lazily(ldap, request):
+                result = ldap.validate(username, password, lazy_groups=True)
+            else:
+                result = ldap.validate(username, password)
+        except (AuthException, ldap.LDAPException) as e:
+            # devpi-server only handles exceptions of the legacy hook
+            threadlog.error(
+                "Validation of user named '%s' failed: %s" % (username, e))
+            result = dict(status="reject")
         # cache result on request if available
         if request is not None:
             # we have to use setattr to avoid name mangling of prefix dunder
@@ -307,22 +1900,118 @@ def devpiserver_auth_request(
     return result
 
 
+def _run_validations(ldap, username, password, repeat, concurrency):
+    """ Validates the user ``repeat`` times with ``concurrency`` threads.
+
+        Returns the number of validations by status and the elapsed time.
+    """
+    from collections import Counter
+    from concurrent.futures import ThreadPoolExecutor
+
+    def validate(_index):
+        try:
+            return ldap.validate(username, password)["status"]
+        except (AuthException, ldap.LDAPException):
+            return "error"
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        statuses = Counter(executor.map(validate, range(repeat)))
+    return (statuses, time.monotonic() - start)
+
+
+def _timing_lines(ldap):
+    """ Returns lines with the time spent per phase of the validations and
+        per server, from the metrics of the LDAP instance.
+    """
+    counters = {name: value for (name, _kind, value) in ldap.metrics()}
+
+    def line(label, *name, received=None):
+        name = metric_name('devpi_ldap', *name)
+        count = counters.get(name + '_count', 0)
+        seconds = counters.get(name + '_seconds', 0)
+        return "%-50s %7d %7d %10.3f %9.2f %12s" % (
+            label, count, counters.get(name + '_errors', 0), seconds,
+            seconds * 1000 / count, '' if received is None else received)
+
+    header = "%-50s %7s %7s %10s %9s %12s"
+    columns = ('count', 'errors', 'total s', 'mean ms', 'bytes')
+    lines = [header % ('phase', *columns)]
+    lines.extend(
+        line(phase, phase)
+        for phase in ('validation', 'dn_search', 'service_bind', 'user_bind', 'group_search')
+        if counters.get(metric_name('devpi_ldap', phase, 'count')))
+    lines.extend(('', header % ('server', *columns)))
+    for server in ldap.server_pool().servers:
+        name = server_name(server)
+        for phase in ('connect', 'bind', 'search'):
+            if not counters.get(metric_name('devpi_ldap', 'server', name, phase, 'count')):
+                continue
+            label = '%s %s' % (name, phase)
+            if phase == 'connect' and getattr(server, 'ssl', False):
+                # ldap3 does the TLS handshake while opening the socket
+                label += ' + TLS'
+            received = None
+            if phase == 'search':
+                received = counters.get(
+                    metric_name('devpi_ldap', 'server', name, 'search_bytes'))
+            lines.append(line(label, 'server', name, phase, received=received))
+    return lines
+
+
 def main(argv=None):
     import json
     import logging
 
-    logging.basicConfig(
-        level=logging.DEBUG, format='%(asctime)s %(levelname)-5.5s %(message)s')
     parser = argparse.ArgumentParser()
     parser.add_argument(action='store', dest='config')
     parser.add_argument(nargs='?', action='store', dest='username')
+    parser.add_argument(
+        '--repeat', type=int, metavar='N',
+        help="Validate the user N times and print the time spent per phase and per server.")
+    parser.add_argument(
+        '--concurrency', type=int, default=1, metavar='K',
+        help="Number of concurrent validations with --repeat.")
+    parser.add_argument(
+        '--password-env', metavar='NAME',
+        help="Read the password from this environment variable instead of asking for it.")
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Ignore the caches, group sync and coalescing of the config, so each validation uses the LDAP servers.")
     args = parser.parse_args(argv)
+    for option in ('repeat', 'concurrency'):
+        value = getattr(args, option)
+        if value is not None and value < 1:
+            parser.error("--%s needs to be a positive number." % option)
+    logging.basicConfig(
+        level=logging.DEBUG if args.repeat is None else logging.WARNING,
+        format='%(asctime)s %(levelname)-5.5s %(message)s')
     ldap = LDAP(args.config)
+    if args.no_cache:
+        for key in ('coalesce_validations', 'dn_cache', 'fallback_cache', 'group_cache',
+                    'group_sync', 'negative_cache', 'shared_cache', 'validation_cache'):
+            ldap.pop(key, None)
+        ldap._setup_state()
+        if ldap._nested_group_cache is not None:
+            # still search the parent groups, but don't remember them
+            ldap._nested_group_cache = TTLCache(maxsize=0, ttl=0)
     username = args.username
     if not username:
         username = input("Username: ")
-    password = getpass.getpass("Password: ")
-    result = ldap.validate(username, password)
+    if args.password_env:
+        password = os.environ.get(args.password_env)
+        if password is None:
+            parser.error("The environment variable '%s' is not set." % args.password_env)
+    else:
+        password = getpass.getpass("Password: ")
+    if args.repeat is not None:
+        _main_timing(ldap, username, password, args.repeat, args.concurrency)
+        return
+    try:
+        result = ldap.validate(username, password)
+    except AuthException as e:
+        print("Validation of user named '%s' failed: %s" % (username, e))
+        raise SystemExit(3)
     print("Result: %s" % json.dumps(result, sort_keys=True))
 
     if result["status"] == "unknown":
@@ -334,3 +2023,19 @@ def main(argv=None):
         raise SystemExit(2)
 
     print("Authentication successful, the user is member of the following groups: %s" % ', '.join(result.get("groups", [])))
+
+
+def _main_timing(ldap, username, password, repeat, concurrency):
+    # the number of received bytes is only counted for the diagnostics
+    ldap._collect_usage = True
+    (statuses, elapsed) = _run_validations(
+        ldap, username, password, repeat, concurrency)
+    print("Ran %d validations of user '%s' with a concurrency of %d in %.3f seconds, %.1f per second." % (
+        repeat, username, concurrency, elapsed, repeat / elapsed if elapsed else 0))
+    print("Results: %s" % ', '.join(
+        '%s %d' % (status, count) for (status, count) in sorted(statuses.items())))
+    print()
+    print('\n'.join(_timing_lines(ldap)))
+    for (status, code) in (('error', 3), ('unknown', 1), ('reject', 2)):
+        if statuses.get(status):
+            raise SystemExit(code)
@@ -0,0 +1,74 @@
+from collections import defaultdict
+import contextlib
+import re
+import threading
+import time
+
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.025, 0.1, 0.5, 2.5, 10)
+
+
+def metric_name(*parts):
+    """Joins the parts to a metric name with only lowercase letters,
+    numbers and underscores, as devpi-server requires.
+    """
+    name = "_".join(str(x) for x in parts if x is not None)
+    return re.sub("[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+class Metrics:
+    """Thread safe counters with the number, errors and latency of LDAP
+    operations, in the format of the ``devpiserver_metrics`` hook.
+
+    For each operation there are counters for the number of calls, the
+    number of errors, the total number of seconds and cumulative
+    histogram buckets of the latency.
+    """
+
+    def __init__(self, prefix="devpi_ldap", clock=time.monotonic):
+        self.prefix = prefix
+        self.clock = clock
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def count(self, *name, value=1):
+        name = metric_name(self.prefix, *name)
+        with self._lock:
+            self._counters[name] += value
+
+    def record(self, name, seconds, *, error=False):
+        bucket_names = [
+            metric_name(self.prefix, name, "seconds_bucket", bound)
+            for bound in LATENCY_BUCKETS
+            if seconds <= bound
+        ]
+        name = metric_name(self.prefix, name)
+        with self._lock:
+            self._counters[name + "_count"] += 1
+            self._counters[name + "_seconds"] += seconds
+            if error:
+                self._counters[name + "_errors"] += 1
+            for bucket_name in bucket_names:
+                self._counters[bucket_name] += 1
+
+    @contextlib.contextmanager
+    def timed(self, *name):
+        """Records the time spent in the block, exceptions count as
+        errors.
+        """
+        start = self.clock()
+        try:
+            yield
+        except BaseException:
+            self.record(metric_name(*name), self.clock() - start, error=True)
+            raise
+        self.record(metric_name(*name), self.clock() - start)
+
+    def get(self, *name):
+        return self._counters.get(metric_name(self.prefix, *name), 0)
+
+    def counters(self):
+        """Returns ``(name, 'counter', value)`` tuples for all counters."""
+        with self._lock:
+            return [(k, "counter", v) for k, v in sorted(self._counters.items())]
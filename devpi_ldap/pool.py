@@ -0,0 +1,182 @@
+from collections import deque
+from ldap3.core.exceptions import LDAPException
+import contextlib
+import threading
+import time
+
+
+class PoolTimeoutError(Exception):
+    """No connection became available in time."""
+
+
+class LimitExceededError(Exception):
+    """The concurrency limit is reached and the caller can't wait."""
+
+
+class ConnectionPool:
+    """A thread safe pool of bound LDAP connections.
+
+    New connections are created on demand with ``factory``, which returns
+    a bound connection or ``None`` if binding failed. At most ``maxsize``
+    connections exist at the same time. Connections which have been idle
+    for more than ``idle_timeout`` seconds are closed, but at least
+    ``minsize`` idle connections are kept.
+    """
+
+    def __init__(
+        self, factory, minsize=0, maxsize=10, idle_timeout=300, clock=time.monotonic
+    ):
+        self.factory = factory
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._cond = threading.Condition()
+        # (last used, connection) tuples, most recently used last
+        self._idle = deque()
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def is_alive(self, conn):
+        return not getattr(conn, "closed", False) and getattr(conn, "bound", True)
+
+    def close(self, conn):
+        with contextlib.suppress(LDAPException):
+            conn.unbind()
+
+    def _reap(self):
+        threshold = self.clock() - self.idle_timeout
+        reaped = []
+        while len(self._idle) > self.minsize and self._idle[0][0] < threshold:
+            reaped.append(self._idle.popleft()[1])
+        self._size -= len(reaped)
+        return reaped
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else self.clock() + timeout
+        conn = None
+        dead = []
+        with self._cond:
+            dead.extend(self._reap())
+            while conn is None:
+                while self._idle:
+                    (_last_used, candidate) = self._idle.pop()
+                    if self.is_alive(candidate):
+                        conn = candidate
+                        break
+                    self._size -= 1
+                    dead.append(candidate)
+                if conn is not None or self._size < self.maxsize:
+                    break
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeoutError(
+                        "No LDAP connection available after %s seconds." % timeout
+                    )
+                self._cond.wait(remaining)
+            if conn is None:
+                # reserve the slot for the new connection
+                self._size += 1
+        for candidate in dead:
+            self.close(candidate)
+        if conn is not None:
+            return conn
+        try:
+            conn = self.factory()
+        except BaseException:
+            self._forget()
+            raise
+        if conn is None:
+            self._forget()
+        return conn
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, conn, *, discard=False):
+        if discard or not self.is_alive(conn):
+            self._forget()
+            self.close(conn)
+            return
+        with self._cond:
+            self._idle.append((self.clock(), conn))
+            reaped = self._reap()
+            self._cond.notify()
+        for candidate in reaped:
+            self.close(candidate)
+
+    def clear(self):
+        with self._cond:
+            idle = [x[1] for x in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self.close(conn)
+
+
+class ConcurrencyLimiter:
+    """Limits the number of operations running at the same time.
+
+    Up to ``maxsize`` callers get a slot right away, up to ``max_queue``
+    more wait at most ``queue_timeout`` seconds for one. All others fail
+    right away with ``LimitExceededError``.
+    """
+
+    def __init__(self, maxsize, max_queue=50, queue_timeout=5, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        # total number of seconds callers waited for a slot
+        self.wait_time = 0.0
+
+    def acquire(self):
+        """Returns the number of seconds waited for the slot."""
+        with self._cond:
+            if self.active < self.maxsize and not self.waiting:
+                self.active += 1
+                return 0.0
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise LimitExceededError(
+                    "%s LDAP operations running and %s waiting."
+                    % (self.active, self.waiting)
+                )
+            start = self.clock()
+            deadline = start + self.queue_timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.maxsize:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise LimitExceededError(
+                            "No free slot for LDAP operation after %s seconds."
+                            % self.queue_timeout
+                        )
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            waited = self.clock() - start
+            self.wait_time += waited
+            return waited
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
@@ -0,0 +1,201 @@
+from devpi_server.log import threadlog
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)",
+    (
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " namespace TEXT, key TEXT, expires REAL, value TEXT,"
+        " PRIMARY KEY (namespace, key))"
+    ),
+)
+
+
+class SharedStore:
+    """A SQLite database in WAL mode for caches shared by all processes
+    on the host.
+
+    Each thread uses its own connection. The salt for hashing credentials
+    is stored in the database as well, so all processes derive the same
+    cache keys.
+    """
+
+    def __init__(self, path, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._salt = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if not os.path.exists(self.path):
+                # the cache contains password hashes, so only the owner
+                # may read it
+                os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+            conn = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    @property
+    def salt(self):
+        with self._lock:
+            if self._salt is None:
+                conn = self.connection()
+                conn.execute(
+                    "INSERT OR IGNORE INTO meta (name, value) VALUES ('salt', ?)",
+                    (os.urandom(16),),
+                )
+                (self._salt,) = conn.execute(
+                    "SELECT value FROM meta WHERE name = 'salt'"
+                ).fetchone()
+            return self._salt
+
+
+def _encode_key(key):
+    return json.dumps(key, default=bytes.hex)
+
+
+def _tuples(value):
+    if isinstance(value, list):
+        return tuple(_tuples(x) for x in value)
+    return value
+
+
+def _decode(data):
+    # JSON has no tuples, but the cached keys and values use them
+    return _tuples(json.loads(data))
+
+
+class SharedCache:
+    """A cache with the interface of ``TTLCache`` stored in a
+    ``SharedStore``.
+
+    Keys and values need to be serializable as JSON. Lists, which aren't
+    inside a dictionary, come back as tuples. Errors of the database are
+    logged and handled like a missing entry, so the cache never breaks a
+    login.
+    """
+
+    def __init__(self, store, namespace, maxsize, ttl, clock=time.time):
+        self.store = store
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self.hits = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def size(self):
+        row = self._execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+        )
+        return 0 if row is None else row.fetchone()[0]
+
+    def _execute(self, sql, args=()):
+        try:
+            return self.store.connection().execute(sql, args)
+        except sqlite3.Error:
+            threadlog.exception(
+                "Error using shared LDAP cache at %s." % self.store.path
+            )
+            return None
+
+    def _lookup(self, key):
+        self.lookups += 1
+        cursor = self._execute(
+            "SELECT expires, value FROM cache WHERE namespace = ? AND key = ?",
+            (self.namespace, _encode_key(key)),
+        )
+        row = None if cursor is None else cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        return (row[0], _decode(row[1]))
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+        (expires, value) = entry
+        if expires <= self.clock():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def get_stale(self, key, max_stale, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            return (default, False)
+        (expires, value) = entry
+        now = self.clock()
+        if expires + max_stale <= now:
+            self.misses += 1
+            return (default, False)
+        self.hits += 1
+        return (value, expires <= now)
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, expires, value)"
+            " VALUES (?, ?, ?, ?)",
+            (self.namespace, _encode_key(key), self.clock() + ttl, json.dumps(value)),
+        )
+        size = self.size
+        if size > self.maxsize:
+            # drop the entries which expire first
+            self._execute(
+                "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                " SELECT key FROM cache WHERE namespace = ?"
+                " ORDER BY expires LIMIT ?)",
+                (self.namespace, self.namespace, size - self.maxsize),
+            )
+            self.evictions += size - self.maxsize
+
+    def invalidate(self, key):
+        self._execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ?",
+            (self.namespace, _encode_key(key)),
+        )
+
+    def evict(self, predicate):
+        cursor = self._execute(
+            "SELECT key, value FROM cache WHERE namespace = ?", (self.namespace,)
+        )
+        if cursor is None:
+            return 0
+        keys = [
+            key
+            for (key, value) in cursor.fetchall()
+            if predicate(_decode(key), _decode(value))
+        ]
+        for key in keys:
+            self._execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            )
+        return len(keys)
+
+    def clear(self):
+        self._execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
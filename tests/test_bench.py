@@ -0,0 +1,186 @@
+from types import SimpleNamespace
+import math
+import os
+import pytest
+import sys
+
+
+# tox runs the tests against the installed package, the benchmarks are
+# only available from the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+bench = pytest.importorskip("benchmarks.bench")
+standin = pytest.importorskip("benchmarks.standin")
+
+
+def make_args(**kw):
+    args = dict(
+        users=5,
+        groups=2,
+        groups_per_user=1,
+        logins=10,
+        server=["ldap://standin"],
+        server_faults=[],
+        config=None,
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        timeout_rate=0.0,
+        wrong_rate=0.0,
+    )
+    args.update(kw)
+    return SimpleNamespace(**args)
+
+
+@pytest.fixture
+def make_bench():
+    benches = []
+
+    def make_bench(**kw):
+        result = bench.Bench(make_args(**kw))
+        benches.append(result)
+        return result
+
+    yield make_bench
+    for result in benches:
+        result.close()
+
+
+@pytest.mark.parametrize(
+    ("search_filter", "expected"),
+    [
+        ("(uid=user1)", ["uid=user1,ou=people,dc=example,dc=com"]),
+        ("(UID=USER1)", []),
+        (
+            "(&(objectClass=person)(uid=user1))",
+            ["uid=user1,ou=people,dc=example,dc=com"],
+        ),
+        (
+            "(|(uid=user0)(uid=user1))",
+            [
+                "uid=user0,ou=people,dc=example,dc=com",
+                "uid=user1,ou=people,dc=example,dc=com",
+            ],
+        ),
+        (
+            "(&(objectClass=person)(!(uid=user0)))",
+            [
+                "uid=user1,ou=people,dc=example,dc=com",
+            ],
+        ),
+        (
+            "(cn=*)",
+            [
+                "uid=user0,ou=people,dc=example,dc=com",
+                "uid=user1,ou=people,dc=example,dc=com",
+            ],
+        ),
+    ],
+)
+def test_parse_filter(search_filter, expected):
+    directory = standin.Directory(users=2, groups=1, groups_per_user=1)
+    match = standin.parse_filter(search_filter)
+    entries = directory.search(standin.PEOPLE_DN, search_filter)
+    assert sorted(e["dn"].lower() for e in entries) == expected
+    assert all(match(e) for e in entries)
+
+
+@pytest.mark.parametrize("search_filter", ["uid=user1", "(uid=user1))"])
+def test_parse_filter_unsupported(search_filter):
+    with pytest.raises(ValueError, match="Unsupported filter"):
+        standin.parse_filter(search_filter)
+
+
+def test_compare():
+    baseline = dict(
+        results=[
+            dict(target="hook", concurrency=1, logins_per_sec=100.0, p99_ms=10.0),
+            dict(target="hook", concurrency=2, logins_per_sec=200.0, p99_ms=10.0),
+        ]
+    )
+    results = [
+        dict(target="hook", concurrency=1, logins_per_sec=95.0, p99_ms=10.5),
+        dict(target="hook", concurrency=2, logins_per_sec=100.0, p99_ms=10.0),
+        dict(target="hook", concurrency=4, logins_per_sec=1.0, p99_ms=100.0),
+    ]
+    (lines, regressed) = bench.compare(results, baseline, 0.1)
+    assert regressed
+    assert len(lines) == 2
+    assert "REGRESSION" not in lines[0]
+    assert "-50.0%" in lines[1]
+    assert "REGRESSION" in lines[1]
+    (lines, regressed) = bench.compare(results[:1], baseline, 0.1)
+    assert not regressed
+
+
+def test_compare_zero_baseline():
+    baseline = dict(
+        results=[
+            dict(target="hook", concurrency=1, logins_per_sec=0.0, p99_ms=0.0),
+            dict(target="hook", concurrency=2, logins_per_sec=0.0, p99_ms=0.0),
+        ]
+    )
+    results = [
+        dict(target="hook", concurrency=1, logins_per_sec=0.0, p99_ms=0.0),
+        dict(target="hook", concurrency=2, logins_per_sec=10.0, p99_ms=1.0),
+    ]
+    (lines, regressed) = bench.compare(results[:1], baseline, 0.1)
+    assert not regressed
+    (lines, regressed) = bench.compare(results, baseline, 0.1)
+    assert regressed
+    assert "inf" in lines[1]
+    assert bench.change(1.0, 0.0) == math.inf
+    assert bench.change(0.0, 0.0) == 0.0
+
+
+@pytest.mark.parametrize("target", bench.TARGETS)
+def test_run(make_bench, target):
+    result = make_bench(logins=100, wrong_rate=0.2).run(target, 2)
+    assert result["logins"] == 100
+    assert result["errors"] == 0
+    assert result["rejected"] == 20
+    assert result["p50_ms"] <= result["p99_ms"]
+    assert result["logins_per_sec"] > 0
+
+
+def test_run_bind_pool(make_bench, tmp_path):
+    config = tmp_path / "bench.yaml"
+    config.write_text(
+        "devpi-ldap:\n"
+        "  bind_pool: {}\n"
+        "  group_search:\n"
+        "    base: %s\n"
+        "    filter: (member={userdn})\n"
+        "    attribute_name: cn\n"
+        "    userdn: uid=user0,%s\n"
+        "    password: secret\n" % (standin.GROUPS_DN, standin.PEOPLE_DN)
+    )
+    result = make_bench(config=str(config)).run("validate", 2)
+    assert result["logins"] == 10
+    assert result["errors"] == 0
+    assert result["rejected"] == 0
+
+
+@pytest.mark.parametrize("target", bench.TARGETS)
+def test_run_failures(make_bench, target):
+    # the hook rejects failed validations, they are still errors
+    result = make_bench(failure_rate=1.0).run(target, 2)
+    assert result["logins"] == 10
+    assert result["errors"] == 10
+    assert result["rejected"] == 0
+
+
+def test_close(make_bench):
+    b = make_bench()
+    path = b._tmpdir.name
+    b.make_ldap()
+    assert os.path.exists(path)
+    b.close()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize(
+    "argv", [["--logins", "0"], ["--concurrency", "1,0"], ["--concurrency", "x"]]
+)
+def test_main_invalid(argv):
+    with pytest.raises(SystemExit, match="2"):
+        bench.main(argv)
@@ -0,0 +1,204 @@
+from devpi_ldap.cache import CredentialHasher
+from devpi_ldap.cache import GroupIndex
+from devpi_ldap.cache import IncompleteGroups
+from devpi_ldap.cache import LazyGroups
+from devpi_ldap.cache import SingleFlight
+from devpi_ldap.cache import TTLCache
+import pytest
+import threading
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttlcache_expiry():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=10, clock=clock)
+    cache.put("foo", 1)
+    cache.put("bar", 2, ttl=20)
+    assert cache.get("foo") == 1
+    clock.now = 10
+    assert cache.get("foo") is None
+    assert cache.get("bar") == 2
+    assert len(cache) == 1
+    assert (cache.lookups, cache.hits, cache.misses) == (3, 2, 1)
+
+
+def test_ttlcache_lru():
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.put("foo", 1)
+    cache.put("bar", 2)
+    assert cache.get("foo") == 1
+    cache.put("ham", 3)
+    assert cache.get("bar") is None
+    assert cache.get("foo") == 1
+    assert cache.get("ham") == 3
+    assert cache.evictions == 1
+
+
+def test_ttlcache_invalidate():
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.put("foo", 1)
+    cache.invalidate("foo")
+    cache.invalidate("bar")
+    assert cache.get("foo") is None
+
+
+def test_ttlcache_get_stale():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=10, clock=clock)
+    cache.put("foo", 1)
+    assert cache.get_stale("foo", 5) == (1, False)
+    clock.now = 10
+    assert cache.get_stale("foo", 5) == (1, True)
+    clock.now = 15
+    assert cache.get_stale("foo", 5) == (None, False)
+    assert len(cache) == 0
+
+
+def test_credential_hasher():
+    hasher = CredentialHasher(iterations=1)
+    key = hasher("user", "password")
+    assert key == hasher("user", "password")
+    assert key != hasher("user", "Password")
+    assert key != hasher("other", "password")
+    assert b"password" not in key[1]
+    assert key != CredentialHasher(iterations=1)("user", "password")
+
+
+def _run_concurrently(flight, func, count):
+    results = []
+    errors = []
+
+    def call():
+        try:
+            results.append(flight.do("key", func))
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _i in range(count)]
+    for thread in threads:
+        thread.start()
+    return (threads, results, errors)
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        started.set()
+        assert release.wait(10)
+        return len(calls)
+
+    (threads, results, _errors) = _run_concurrently(flight, func, 1)
+    assert started.wait(10)
+    (others, other_results, _) = _run_concurrently(flight, func, 4)
+    while flight.coalesced < 4:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads + others:
+        thread.join()
+    assert results + other_results == [1] * 5
+    assert calls == [1]
+    # the next call runs again
+    assert flight.do("key", func) == 2
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        started.set()
+        assert release.wait(10)
+        msg = "fail"
+        raise ValueError(msg)
+
+    (threads, _results, errors) = _run_concurrently(flight, func, 1)
+    assert started.wait(10)
+    (others, _other_results, other_errors) = _run_concurrently(flight, func, 2)
+    while flight.coalesced < 2:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads + others:
+        thread.join()
+    assert len(errors + other_errors) == 3
+    with pytest.raises(ValueError, match="fail"):
+        flight.do("key", func)
+
+
+def test_group_index():
+    now = [0]
+    index = GroupIndex(clock=lambda: now[0])
+    assert index.age is None
+    assert index.get("cn=user") == []
+    index.replace({"CN=User": ["a", "b"]})
+    now[0] = 5
+    assert index.age == 5
+    assert index.get("cn=user") == ["a", "b"]
+    assert len(index) == 1
+    index.replace({})
+    assert index.get("cn=user") == []
+
+
+def test_ttlcache_evict():
+    cache = TTLCache(maxsize=10, ttl=10)
+    for i in range(5):
+        cache.put(i, i * 2)
+    assert cache.evict(lambda k, v: k == 1 or v == 6) == 2
+    assert [cache.get(i) for i in range(5)] == [0, None, 4, None, 8]
+
+
+def test_lazygroups():
+    calls = []
+    resolved = []
+
+    def func():
+        calls.append(True)
+        return ("users", "admins")
+
+    groups = LazyGroups(func)
+    groups.add_callback(resolved.append)
+    assert not groups.resolved
+    assert calls == []
+    assert "admins" in groups
+    assert groups == ["users", "admins"]
+    assert list(groups) == ["users", "admins"]
+    assert groups[0] == "users"
+    assert len(groups) == 2
+    assert groups.resolved
+    assert calls == [True]
+    assert resolved == [["users", "admins"]]
+    # callbacks added later are called right away
+    groups.add_callback(resolved.append)
+    assert len(resolved) == 2
+
+
+def test_lazygroups_failed():
+    resolved = []
+    groups = LazyGroups(lambda: None)
+    groups.add_callback(resolved.append)
+    assert groups == []
+    assert groups.resolved
+    assert resolved == []
+    groups.add_callback(resolved.append)
+    assert resolved == []
+
+
+def test_lazygroups_incomplete():
+    resolved = []
+    groups = LazyGroups(lambda: IncompleteGroups(["users"]))
+    groups.add_callback(resolved.append)
+    # the groups found are used, but not passed on for caching
+    assert groups == ["users"]
+    assert resolved == []
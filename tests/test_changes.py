@@ -0,0 +1,42 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from devpi_ldap.changes import ChangeWatermark
+
+
+def test_timestamp_normalize():
+    watermark = ChangeWatermark("modifyTimestamp", "20260101000000.0Z")
+    assert watermark.value == "20260101000000Z"
+    tz = timezone(timedelta(hours=2))
+    assert watermark.normalize(datetime(2026, 1, 1, 2, tzinfo=tz)) == "20260101000000Z"
+    assert watermark.normalize(["20260101000001Z"]) == "20260101000001Z"
+    assert watermark.filter() == "(modifyTimestamp>=20260101000000Z)"
+
+
+def test_from_time():
+    now = datetime(2026, 1, 1, 0, 10, tzinfo=timezone.utc)
+    watermark = ChangeWatermark.from_time("modifyTimestamp", now=now)
+    assert watermark.value == "20260101000500Z"
+
+
+def test_timestamp_update():
+    watermark = ChangeWatermark("modifyTimestamp", "20260101000000Z")
+    assert watermark.update([("a", "20260101000000Z"), ("b", "20251231000000Z")]) == [
+        "a"
+    ]
+    # entries with the same timestamp are only reported once
+    assert watermark.update([("a", "20260101000000Z"), ("c", "20260101000000Z")]) == [
+        "c"
+    ]
+    assert watermark.update([("a", "20260101000001Z")]) == ["a"]
+    assert watermark.value == "20260101000001Z"
+    assert watermark.update([]) == []
+    assert watermark.value == "20260101000001Z"
+
+
+def test_usn():
+    watermark = ChangeWatermark("uSNChanged", "10")
+    assert watermark.value == 10
+    assert watermark.filter() == "(uSNChanged>=11)"
+    assert watermark.update([("a", 12), ("b", 11)]) == ["a", "b"]
+    assert watermark.filter() == "(uSNChanged>=13)"
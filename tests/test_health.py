@@ -0,0 +1,40 @@
+from devpi_ldap.health import ServerHealth
+from devpi_ldap.health import order_by_latency
+
+
+def test_record_latency():
+    health = ServerHealth("server")
+    assert health.latency is None
+    health.record_latency(1.0)
+    assert health.latency == 1.0
+    health.record_latency(2.0)
+    assert 1.0 < health.latency < 2.0
+    for _i in range(50):
+        health.record_latency(2.0)
+    assert round(health.latency, 6) == 2.0
+
+
+def test_order_by_latency():
+    (fast, slow, unknown) = servers = [
+        ServerHealth("fast"),
+        ServerHealth("slow"),
+        ServerHealth("unknown"),
+    ]
+    fast.latency = 0.01
+    slow.latency = 0.1
+    assert order_by_latency(servers, rand=lambda: 0.5) == [unknown, fast, slow]
+    # a slow server can still come first
+    rands = iter([0.01, 0.99])
+    assert order_by_latency([fast, slow], rand=lambda: next(rands)) == [slow, fast]
+
+
+def test_order_by_latency_weights():
+    (fast, slow) = servers = [ServerHealth("fast"), ServerHealth("slow")]
+    fast.latency = 0.01
+    slow.latency = 0.03
+    rands = iter([x / 100 for x in range(1, 100)] * 2)
+    firsts = [
+        order_by_latency(servers, rand=lambda: next(rands))[0] for _i in range(99)
+    ]
+    # with a third of the weight the slow server is picked a lot less often
+    assert firsts.count(fast) > 3 * firsts.count(slow)
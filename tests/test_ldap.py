@@ -176,11 +176,78 @@ def reject_as_unknown_config(ldap_config):
     return ldap_config
 
 
+@pytest.fixture
+def validation_cache_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "validation_cache": {
+            "ttl": 60,
+            "maxsize": 10}}})
+    return ldap_config
+
+
+@pytest.fixture
+def negative_cache_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"},
+        "negative_cache": {
+            "ttl": 10,
+            "maxsize": 10}}})
+    return ldap_config
+
+
+@pytest.fixture
+def connection_pool_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "userdn": "search",
+            "password": "foo",
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"},
+        "group_search": {
+            "userdn": "search",
+            "password": "foo",
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "connection_pool": {
+            "maxsize": 2}}})
+    return ldap_config
+
+
+@pytest.fixture
+def circuit_breaker_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"}],
+        "server_pool_strategy": "FIRST",
+        "circuit_breaker": {
+            "failures": 2,
+            "cooldown": 30},
+        "user_template": "{username}"}})
+    return ldap_config
+
+
 @pytest.fixture
 def MockServerPool():
     class MockServerPool:
-        def __init__(self):
+        def __init__(self, pool_strategy=ldap3.ROUND_ROBIN, *, active=True, exhaust=False):
             self.servers = list()
+            self.pool_strategy = pool_strategy
+            self.active = active
+            self.exhaust = exhaust
 
         def add(self, server):
             self.servers.append(server)
@@ -191,9 +258,19 @@ def MockServerPool():
 def MockServer():
     class MockServer:
         users = {}
-
-        def __init__(self, url, tls=None):
+        # parent groups by group DN
+        groups = {}
+        # all groups with their members for group_sync
+        all_groups = []
+        # entries returned by change polling
+        changed = []
+        highest_usn = 0
+        # number of times the server info is read again by a rebind
+        info_reads = 0
+
+        def __init__(self, url, tls=None, connect_timeout=None):
             self.url = url
+            self.connect_timeout = connect_timeout
 
         def __str__(self):
             return self.url
@@ -202,64 +279,133 @@ def MockServer():
 
 class MockConnection:
     def __init__(self, server_pool, **kw):
+        # either a server pool or a single server
         self.server_pool = server_pool
-        self.server = self.server_pool.servers[0]
+        self.server = getattr(server_pool, 'servers', [server_pool])[0]
         self.user = kw.get('user')
         self.password = kw.get('password')
+        self.receive_timeout = kw.get('receive_timeout')
+        self.closed = True
+        self.bound = False
 
     def open(self):
-        pass
+        self.closed = False
 
     def bind(self):
+        self.bound = self._bind()
+        return self.bound
+
+    def _bind(self):
         if self.user is None:
             return True
-        user = self.server_pool.servers[0].users.get(escape_filter_chars(self.user))
+        user = self.server.users.get(escape_filter_chars(self.user))
         if user is None:
-            self.result = "Bind failed, user not found"
+            self.result = dict(
+                result=32, description="noSuchObject",
+                message="Bind failed, user not found")
             return False
         if self.password == '' or user['pw'] == self.password:
             return True
         self.result = "Bind failed, invalid credentials"
         return False
 
-    def search(self, base, search_filter, search_scope, attributes):
-        # We have some hariness here to simulate the handling for openLDAP
-        # servers that dont return dn as an attribute which we also do in
-        # LDAP._search() in devpi_ldap/main.py
-        class dnplaceholder(object):
-            triggered = False
-
-        def fixDn(user, k):
-            if k in ('dn', 'distinguishedName'):
-                dnplaceholder.triggered = k
-                return dnplaceholder
-            else:
-                raise KeyError()
-
+    def rebind(self, user=None, password=None, authentication=None, *, read_server_info=True):
+        # like ldap3, keeps the previous user if none is given
+        if read_server_info:
+            self.server.info_reads += 1
+        if user:
+            self.user = user
+        if password is not None:
+            self.password = password
+        return self.bind()
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+    def search(self, base, search_filter, search_scope, attributes, **paging):
+        if paging:
+            return self._paged_search(
+                base, search_filter, search_scope, attributes, **paging)
+        return self._search(base, search_filter, search_scope, attributes)
+
+    def _search(self, base, search_filter, search_scope, attributes):
         search_filter = search_filter.split(":")
         if search_filter[0] == 'user':
-            user = self.server_pool.servers[0].users.get(search_filter[1])
+            user = self.server.users.get(search_filter[1])
             if user is not None:
-                self.response = [dict(attributes=dict(
-                    (k, [user.get(k, fixDn(user, k))]) for k in attributes if fixDn(user, k) is not dnplaceholder))]
-                if dnplaceholder.triggered:
-                    self.response[0][dnplaceholder.triggered] = user.get(
-                        dnplaceholder.triggered, search_filter[1])
+                entry = dict(attributes={})
+                for k in attributes:
+                    if k in ('dn', 'distinguishedName'):
+                        # simulate openLDAP servers which don't return the
+                        # dn as an attribute, which LDAP._search() handles
+                        entry[k] = user.get(k, search_filter[1])
+                    else:
+                        value = user[k]
+                        if not isinstance(value, list):
+                            value = [value]
+                        entry['attributes'][k] = value
+                self.response = [entry]
                 return True
         elif search_filter[0] == 'group':
-            user = self.server_pool.servers[0].users.get(search_filter[1])
+            user = self.server.users.get(search_filter[1])
             if user is not None and 'groups' in user:
                 self.response = [
-                    dict(attributes=dict(
+                    dict(dn=g.get('dn'), attributes=dict(
                         (k, [g[k]]) for k in attributes))
                     for g in user['groups']]
                 return True
-        self.result = "Search failed"
+        else:
+            self.response = self._directory_entries(
+                ':'.join(search_filter), attributes)
+            if self.response:
+                return True
+            self.result = dict(result=0, description="success")
+            return False
+        # like ldap3, a search without results succeeds
+        self.result = dict(result=0, description="success")
         return False
 
+    def _directory_entries(self, search_filter, attributes):
+        # entries for group sync, nested groups and change polling
+        if search_filter == '(objectClass=*)':
+            return [dict(dn='', attributes=dict(
+                highestCommittedUSN=[self.server.highest_usn]))]
+        if search_filter == 'allgroups':
+            entries = self.server.all_groups
+        elif search_filter.startswith('parent:'):
+            entries = self.server.groups.get(search_filter[7:], [])
+        else:
+            (attribute, value) = search_filter[1:-1].split('>=')
+            entries = [
+                e for e in self.server.changed
+                if e[attribute] >= type(e[attribute])(value)]
+        return [
+            dict(dn=e['dn'], attributes=dict(
+                (k, e[k] if isinstance(e[k], list) else [e[k]])
+                for k in attributes if k in e))
+            for e in entries]
+
+    def _paged_search(self, base, search_filter, search_scope, attributes, *, paged_size, paged_cookie=None):
+        # returns the full result in pages of paged_size entries
+        if not self._search(base, search_filter, search_scope, attributes):
+            return False
+        start = int(paged_cookie or 0)
+        end = start + paged_size
+        response = self.response
+        self.response = response[start:end]
+        self.result = dict(result=0, controls={
+            '1.2.840.113556.1.4.319': dict(value=dict(
+                size=0, cookie=str(end) if end < len(response) else ''))})
+        return True
+
 
 class MockLDAP3:
+    ANONYMOUS = ldap3.ANONYMOUS
     Connection = MockConnection
+    FIRST = ldap3.FIRST
+    RANDOM = ldap3.RANDOM
+    ROUND_ROBIN = ldap3.ROUND_ROBIN
     try:
         BASE = ldap3.BASE
         LEVEL = ldap3.LEVEL
@@ -279,6 +425,39 @@ def LDAP(MockServer, MockServerPool):
     return LDAP
 
 
+@pytest.fixture
+def bind_calls(LDAP, monkeypatch):
+    calls = []
+    original_bind = LDAP.ldap3.Connection.bind
+
+    def bind(self):
+        calls.append(self.user)
+        return original_bind(self)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'bind', bind)
+    return calls
+
+
+@pytest.fixture
+def open_calls(LDAP, monkeypatch):
+    # records the servers connections are opened to and fails for
+    # the servers in the 'failing' set
+    class Calls(list):
+        failing = set()
+
+    calls = Calls()
+    original_open = LDAP.ldap3.Connection.open
+
+    def recording_open(self):
+        calls.append(str(self.server))
+        if str(self.server) in calls.failing:
+            raise LDAP.LDAPException()
+        return original_open(self)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'open', recording_open)
+    return calls
+
+
 @pytest.fixture
 def getpass(mock, monkeypatch):
     gp = mock.Mock()
@@ -326,6 +505,78 @@ def test_server_pool(LDAP, config_server_pool):
     assert len(ldap['server_pool']) == 1
 
 
+def test_server_pool_reused(LDAP, config_server_pool):
+    ldap = LDAP(config_server_pool.strpath)
+    server_pool = ldap.server_pool()
+    assert server_pool is ldap.server_pool()
+    assert [str(x) for x in server_pool.servers] == ["ldap://localhost"]
+    assert server_pool.pool_strategy == ldap3.ROUND_ROBIN
+    assert server_pool.active is True
+    assert server_pool.exhaust is False
+
+
+def test_server_pool_options(LDAP, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"}],
+        "server_pool_strategy": "FIRST",
+        "server_pool_active": 3,
+        "server_pool_exhaust": 60,
+        "user_template": "{username}"}})
+    ldap = LDAP(ldap_config.strpath)
+    server_pool = ldap.server_pool()
+    assert [str(x) for x in server_pool.servers] == ["ldap://server1", "ldap://server2"]
+    assert server_pool.pool_strategy == ldap3.FIRST
+    assert server_pool.active == 3
+    assert server_pool.exhaust == 60
+
+
+def test_server_pool_inactive(LDAP, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "server_pool_active": False,
+        "user_template": "{username}"}})
+    ldap = LDAP(ldap_config.strpath)
+    assert ldap.server_pool().active is False
+
+
+@pytest.mark.parametrize("options", [
+    {"server_pool_strategy": "FASTEST"},
+    {"server_pool_active": "yes"},
+    {"server_pool_exhaust": -1},
+    {"server_pool_active": False, "server_pool_exhaust": True}])
+def test_server_pool_invalid_options(LDAP, ldap_config, options):
+    config = {
+        "server_pool": [{"url": "ldap://localhost"}],
+        "user_template": "{username}"}
+    config.update(options)
+    ldap_config.dump({"devpi-ldap": config})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+def test_real_server_pool_shared(config_server_pool, mock, monkeypatch):
+    from devpi_ldap.main import AuthException
+    import devpi_ldap.main
+
+    class LDAP(devpi_ldap.main.LDAP):
+        ldap3 = ldap3
+
+    ldap = LDAP(config_server_pool.strpath)
+    server_pool = ldap.server_pool()
+    assert isinstance(server_pool, ldap3.ServerPool)
+    assert ldap.server_pool() is server_pool
+    # connections use the servers directly, so ldap3 keeps no state for them
+    monkeypatch.setattr(
+        ldap3.strategy.sync.SyncStrategy, 'open',
+        mock.Mock(side_effect=ldap3.core.exceptions.LDAPException()))
+    with pytest.raises(AuthException, match="Couldn't open LDAP connection"):
+        ldap.validate('user', 'password')
+    assert server_pool.pool_states == {}
+
+
 def test_server_pool_and_url(LDAP, config_server_pool_and_url):
     with pytest.raises(SystemExit) as e:
         _ = LDAP(config_server_pool_and_url.strpath)
@@ -484,6 +735,101 @@ def test_main_user_parentheses_with_search_userdn_with_group(MockServer, capsys,
         "Authentication successful, the user is member of the following groups: users"]
 
 
+def test_main_repeat(MockServer, capsys, main, monkeypatch, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    monkeypatch.setenv("LDAP_PASSWORD", "password")
+    main([
+        validation_cache_config.strpath, 'user', '--repeat', '3',
+        '--concurrency', '2', '--password-env', 'LDAP_PASSWORD'])
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0].startswith("Ran 3 validations of user 'user' with a concurrency of 2 in ")
+    assert lines[1] == "Results: ok 3"
+    rows = {line[:50].strip(): line[50:].split() for line in lines[3:]}
+    assert rows['validation'][:2] == ['3', '0']
+    assert rows['ldap://localhost connect'][:2] == ['1', '0']
+    assert rows['ldap://localhost bind'][:2] == ['1', '0']
+    assert rows['ldap://localhost search'][:2] == ['1', '0']
+    assert 'dn_search' not in rows
+
+
+def test_main_repeat_no_cache(MockServer, capsys, main, monkeypatch, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    monkeypatch.setenv("LDAP_PASSWORD", "password")
+    main([
+        validation_cache_config.strpath, 'user', '--repeat', '3',
+        '--password-env', 'LDAP_PASSWORD', '--no-cache'])
+    out, err = capsys.readouterr()
+    rows = {line[:50].strip(): line[50:].split() for line in out.splitlines()[3:]}
+    assert rows['user_bind'][:2] == ['3', '0']
+
+
+@pytest.mark.usefixtures("nested_groups")
+def test_main_repeat_no_cache_nested(capsys, main, monkeypatch, nested_groups_config):
+    monkeypatch.setenv("LDAP_PASSWORD", "password")
+    main([
+        nested_groups_config.strpath, 'user', '--repeat', '2',
+        '--password-env', 'LDAP_PASSWORD', '--no-cache'])
+    out, err = capsys.readouterr()
+    rows = {line[:50].strip(): line[50:].split() for line in out.splitlines()[3:]}
+    # the group and its parents are searched for each validation
+    assert rows['ldap://localhost search'][:2] == ['10', '0']
+
+
+def test_main_repeat_ldap_error(MockServer, capsys, main, monkeypatch, group_user_template_config):
+    from devpi_ldap.main import LDAP
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    monkeypatch.setenv("LDAP_PASSWORD", "password")
+    monkeypatch.setattr(MockConnection, 'search', mock_raise(LDAP.LDAPException))
+    with pytest.raises(SystemExit) as e:
+        main([
+            group_user_template_config.strpath, 'user', '--repeat', '2',
+            '--password-env', 'LDAP_PASSWORD'])
+    assert e.value.code == 3
+    out, err = capsys.readouterr()
+    assert out.splitlines()[1] == "Results: error 2"
+
+
+def test_main_repeat_reject(MockServer, capsys, main, monkeypatch, reject_as_unknown_config):
+    monkeypatch.setenv("LDAP_PASSWORD", "password")
+    with pytest.raises(SystemExit) as e:
+        main([
+            reject_as_unknown_config.strpath, 'user', '--repeat', '2',
+            '--password-env', 'LDAP_PASSWORD'])
+    assert e.value.code == 2
+    out, err = capsys.readouterr()
+    assert out.splitlines()[1] == "Results: reject 2"
+
+
+def test_main_password_env_missing(capsys, main, monkeypatch, user_template_config):
+    monkeypatch.delenv("LDAP_PASSWORD", raising=False)
+    with pytest.raises(SystemExit) as e:
+        main([user_template_config.strpath, 'user', '--password-env', 'LDAP_PASSWORD'])
+    assert e.value.code == 2
+    out, err = capsys.readouterr()
+    assert "The environment variable 'LDAP_PASSWORD' is not set." in err
+
+
+@pytest.mark.parametrize("option", ["--repeat", "--concurrency"])
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_main_repeat_invalid(capsys, main, option, user_template_config, value):
+    with pytest.raises(SystemExit) as e:
+        main([user_template_config.strpath, 'user', '--repeat', '2', option, value])
+    assert e.value.code == 2
+    out, err = capsys.readouterr()
+    assert "%s needs to be a positive number." % option in err
+
+
+def test_main_search_failed(capsys, main, user_search_config, failing_searches):
+    failing_searches.add('user')
+    with pytest.raises(SystemExit) as e:
+        main([user_search_config.strpath, 'user'])
+    assert e.value.code == 3
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        "Validation of user named 'user' failed: Searching LDAP user 'user' failed."]
+
+
 def test_reject_as_unknown(LDAP, reject_as_unknown_config):
     ldap = LDAP(reject_as_unknown_config.strpath)
     assert ldap._rejection() == dict(status="reject")
@@ -526,6 +872,1367 @@ def test_extra_result_data(LDAP, MockServer, group_user_template_config):
     assert ldap.validate('user', 'password') == dict(status="ok", groups=[u'users'])
 
 
+def test_validation_cache(LDAP, MockServer, bind_calls, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    result = ldap.validate('user', 'password')
+    assert result == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user']
+    # changing the returned result doesn't affect the cache
+    result['groups'].append('admins')
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user']
+
+
+def test_validation_cache_password_mismatch(LDAP, MockServer, bind_calls, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(validation_cache_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert bind_calls == ['user', 'user', 'user']
+
+
+def test_validation_cache_expires(LDAP, MockServer, bind_calls, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(validation_cache_config.strpath)
+    now = [0]
+    ldap._validation_cache.clock = lambda: now[0]
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    now[0] = 59
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    assert bind_calls == ['user']
+    now[0] = 60
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    assert bind_calls == ['user', 'user']
+
+
+def test_negative_cache(LDAP, MockServer, bind_calls, negative_cache_config):
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(negative_cache_config.strpath)
+    now = [0]
+    ldap._negative_cache.clock = lambda: now[0]
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert bind_calls == [None, 'user', None]
+    # successful validations are not cached without 'validation_cache'
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert bind_calls == [None, 'user', None, None, 'user', None, 'user']
+    now[0] = 10
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert bind_calls[-2:] == [None, 'user']
+
+
+def test_negative_cache_reject(LDAP, MockServer, bind_calls, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "reject_as_unknown": False,
+        "negative_cache": {}}})
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(ldap_config.strpath)
+    assert ldap.validate('user', 'wrong') == dict(status="reject")
+    assert ldap.validate('user', 'wrong') == dict(status="reject")
+    assert bind_calls == ['user']
+    assert ldap._negative_cache.ttl == 30
+
+
+def test_connection_pool(LDAP, MockServer, bind_calls, connection_pool_config):
+    MockServer.users['search'] = dict(pw="foo", dn="search")
+    MockServer.users['user'] = dict(pw="password", dn="user", groups=[dict(cn='users')])
+    ldap = LDAP(connection_pool_config.strpath)
+    for _i in range(3):
+        assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert bind_calls == ['search', 'user', 'user', 'user']
+    (pool,) = ldap._search_pools.values()
+    assert (pool.size, pool.idle) == (1, 1)
+
+
+def test_connection_pool_reconnect(LDAP, MockServer, bind_calls, connection_pool_config, monkeypatch):
+    MockServer.users['search'] = dict(pw="foo", dn="search")
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(connection_pool_config.strpath)
+    assert ldap.validate('user', 'password')["status"] == "ok"
+    (pool,) = ldap._search_pools.values()
+    ((_, conn),) = pool._idle
+    original_search = LDAP.ldap3.Connection.search
+
+    def search(self, *args, **kw):
+        if self is conn:
+            raise LDAP.LDAPException()
+        return original_search(self, *args, **kw)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'search', search)
+    assert ldap.validate('user', 'password')["status"] == "ok"
+    assert bind_calls == ['search', 'user', 'search', 'user']
+    assert conn.closed
+    assert (pool.size, pool.idle) == (1, 1)
+
+
+def test_connection_pool_bind_failure(LDAP, MockServer, connection_pool_config):
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    from devpi_ldap.main import AuthException
+    ldap = LDAP(connection_pool_config.strpath)
+    # without a bound connection the user can't be searched
+    with pytest.raises(AuthException, match="Searching LDAP user 'user' failed"):
+        ldap.validate('user', 'password')
+    (pool,) = ldap._search_pools.values()
+    assert (pool.size, pool.idle) == (0, 0)
+
+
+@pytest.mark.parametrize("pool_config", [
+    {"minsize": -1},
+    {"maxsize": 0},
+    {"minsize": 3, "maxsize": 2},
+    {"foo": 1}])
+def test_connection_pool_invalid(LDAP, ldap_config, pool_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "connection_pool": pool_config}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+def test_circuit_breaker(LDAP, MockServer, circuit_breaker_config, monkeypatch, open_calls):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(circuit_breaker_config.strpath)
+    probes = []
+    monkeypatch.setattr(ldap, "_run_in_background", lambda *args: probes.append(args[1:]))
+    (server1, server2) = ldap.server_health()
+    now = [0]
+    server1.clock = lambda: now[0]
+    open_calls.failing.add("ldap://server1")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server1", "ldap://server2"] * 2
+    assert server1.tripped
+    assert not server2.tripped
+    # the tripped server is skipped during the cooldown
+    del open_calls[:]
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server2"]
+    assert probes == []
+    # after the cooldown the server is probed once in the background
+    now[0] = 30
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert probes == [(server1,)]
+    assert open_calls == ["ldap://server2"] * 3
+    open_calls.failing.clear()
+    ldap._probe_server(server1)
+    assert not server1.tripped
+    del open_calls[:]
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server1"]
+
+
+def test_circuit_breaker_probe_fails(LDAP, circuit_breaker_config, open_calls):
+    ldap = LDAP(circuit_breaker_config.strpath)
+    (server1, server2) = ldap.server_health()
+    now = [0]
+    server1.clock = lambda: now[0]
+    open_calls.failing.add("ldap://server1")
+    server1.record_failure()
+    server1.record_failure()
+    now[0] = 30
+    assert server1.start_probe()
+    assert not server1.start_probe()
+    ldap._probe_server(server1)
+    assert server1.tripped
+    # the cooldown starts again
+    assert not server1.start_probe()
+    now[0] = 60
+    assert server1.start_probe()
+
+
+def test_circuit_breaker_all_tripped(LDAP, MockServer, circuit_breaker_config, monkeypatch, open_calls):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(circuit_breaker_config.strpath)
+    monkeypatch.setattr(ldap, "_run_in_background", lambda *_args: None)
+    open_calls.failing.update(["ldap://server1", "ldap://server2"])
+    for _i in range(2):
+        with pytest.raises(AuthException):
+            ldap.validate('user', 'password')
+    assert all(x.tripped for x in ldap.server_health())
+    # when all servers tripped, they are all tried again
+    open_calls.failing.remove("ldap://server2")
+    del open_calls[:]
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server1", "ldap://server2"]
+    assert [x.tripped for x in ldap.server_health()] == [True, False]
+
+
+def test_circuit_breaker_round_robin(LDAP, MockServer, ldap_config, open_calls):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"}],
+        "circuit_breaker": {},
+        "user_template": "{username}"}})
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(ldap_config.strpath)
+    for _i in range(3):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server1", "ldap://server2", "ldap://server1"]
+
+
+@pytest.fixture
+def server_pool_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"}],
+        "user_template": "{username}"}})
+    return ldap_config
+
+
+def test_server_pool_round_robin(LDAP, MockServer, open_calls, server_pool_config):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(server_pool_config.strpath)
+    # the position is kept between validations
+    for _i in range(3):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server1", "ldap://server2", "ldap://server1"]
+    # failing servers aren't skipped without circuit_breaker or exhaust
+    open_calls.failing.add("ldap://server1")
+    del open_calls[:]
+    for _i in range(4):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == [
+        "ldap://server2", "ldap://server1", "ldap://server2",
+        "ldap://server2", "ldap://server1", "ldap://server2"]
+
+
+def test_server_pool_exhaust(LDAP, MockServer, open_calls, server_pool_config):
+    config = yaml.safe_load(server_pool_config.read())
+    config['devpi-ldap']['server_pool_exhaust'] = 60
+    server_pool_config.dump(config)
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(server_pool_config.strpath)
+    now = [0]
+    for health in ldap.server_health():
+        health.clock = lambda: now[0]
+    open_calls.failing.add("ldap://server1")
+    for _i in range(3):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    # the unreachable server is ignored after the first failure
+    assert open_calls == ["ldap://server1", "ldap://server2", "ldap://server2", "ldap://server2"]
+    ldap._run_in_background = lambda *_args: True
+    now[0] = 60
+    assert [x.start_probe() for x in ldap.server_health()] == [True, False]
+
+
+@pytest.mark.parametrize(("active", "expected"), [
+    (False, ["ldap://server1"]),
+    (True, ["ldap://server1", "ldap://server2"]),
+    (2, ["ldap://server1", "ldap://server2"] * 2)])
+def test_server_pool_active(LDAP, active, expected, open_calls, server_pool_config):
+    from devpi_ldap.main import AuthException
+    config = yaml.safe_load(server_pool_config.read())
+    config['devpi-ldap']['server_pool_active'] = active
+    server_pool_config.dump(config)
+    ldap = LDAP(server_pool_config.strpath)
+    open_calls.failing.update(["ldap://server1", "ldap://server2"])
+    with pytest.raises(AuthException, match="Couldn't open LDAP connection"):
+        ldap.validate('user', 'password')
+    assert open_calls == expected
+
+
+def test_latency_strategy(LDAP, MockServer, ldap_config, open_calls):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"}],
+        "server_pool_strategy": "LATENCY",
+        "user_template": "{username}"}})
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(ldap_config.strpath)
+    assert ldap.server_pool().pool_strategy == ldap3.FIRST
+    (server1, server2) = ldap.server_health()
+    # servers without measurements are tried first
+    server1.latency = 0.1
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server2"]
+    assert server2.latency is not None
+    # then the faster one is preferred
+    server1.latency = 0.001
+    server2.latency = 1000.0
+    for _i in range(5):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls == ["ldap://server2"] + ["ldap://server1"] * 5
+    # and if the latency changes, the other one
+    server1.latency = 1000.0
+    server2.latency = 0.001
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert open_calls[-1] == "ldap://server2"
+
+
+def test_latency_recorded_for_search(LDAP, MockServer, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "server_pool_strategy": "LATENCY",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"}}})
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(ldap_config.strpath)
+    (server,) = ldap.server_health()
+    latencies = []
+    server.record_latency = latencies.append
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # anonymous bind, search and user bind
+    assert len(latencies) == 3
+
+
+@pytest.fixture
+def connect_stagger_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "server_pool": [
+            {"url": "ldap://server1"},
+            {"url": "ldap://server2"},
+            {"url": "ldap://server3"}],
+        "server_pool_strategy": "FIRST",
+        "connect_stagger": 0.01,
+        "user_template": "{username}"}})
+    return ldap_config
+
+
+def test_connect_stagger(LDAP, MockServer, connect_stagger_config, monkeypatch):
+    import threading
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(connect_stagger_config.strpath)
+    hanging = threading.Event()
+    conns = []
+    original_open = LDAP.ldap3.Connection.open
+
+    def hanging_open(self):
+        conns.append(self)
+        if str(self.server) == "ldap://server1":
+            assert hanging.wait(10)
+        return original_open(self)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'open', hanging_open)
+    threads = []
+    original_run_in_background = ldap._run_in_background
+
+    def run_in_background(func, *args):
+        threads.append(original_run_in_background(func, *args))
+
+    monkeypatch.setattr(ldap, "_run_in_background", run_in_background)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # the second server won, the third wasn't needed
+    assert [str(x.server) for x in conns] == ["ldap://server1", "ldap://server2"]
+    assert conns[1].bound
+    # the slow attempt is closed when it finishes
+    hanging.set()
+    for thread in threads:
+        thread.join()
+    assert conns[0].closed
+    assert not conns[1].closed
+
+
+def test_connect_stagger_binds_once(LDAP, MockServer, connect_stagger_config, monkeypatch):
+    import threading
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(connect_stagger_config.strpath)
+    hanging = threading.Event()
+    binds = []
+    original_open = LDAP.ldap3.Connection.open
+    original_bind = LDAP.ldap3.Connection.bind
+
+    def slow_open(self):
+        if str(self.server) == "ldap://server1":
+            assert hanging.wait(10)
+        return original_open(self)
+
+    def recording_bind(self):
+        binds.append((str(self.server), self.user))
+        return original_bind(self)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'open', slow_open)
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'bind', recording_bind)
+    threads = []
+    original_run_in_background = ldap._run_in_background
+
+    def run_in_background(func, *args):
+        threads.append(original_run_in_background(func, *args))
+
+    monkeypatch.setattr(ldap, "_run_in_background", run_in_background)
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    hanging.set()
+    for thread in threads:
+        thread.join()
+    # the password is only tried on the connection which won the race
+    assert binds == [("ldap://server2", "user")]
+
+
+def test_connect_stagger_failures(LDAP, MockServer, connect_stagger_config, open_calls):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(connect_stagger_config.strpath)
+    open_calls.failing.update(["ldap://server1", "ldap://server2"])
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert sorted(open_calls) == ["ldap://server1", "ldap://server2", "ldap://server3"]
+    open_calls.failing.add("ldap://server3")
+    with pytest.raises(AuthException):
+        ldap.validate('user', 'password')
+
+
+def test_connect_stagger_reject(LDAP, MockServer, connect_stagger_config, open_calls):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(connect_stagger_config.strpath)
+    # a failed bind is a result, no other server is tried
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert open_calls == ["ldap://server1"]
+
+
+def test_coalesce_validations(LDAP, MockServer, ldap_config, monkeypatch):
+    import threading
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "coalesce_validations": True}})
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(ldap_config.strpath)
+    started = threading.Event()
+    release = threading.Event()
+    original_validate = ldap._validate
+    calls = []
+
+    def _validate(username, password, **kw):
+        calls.append((username, password))
+        started.set()
+        assert release.wait(10)
+        return original_validate(username, password, **kw)
+
+    monkeypatch.setattr(ldap, "_validate", _validate)
+    results = []
+
+    def validate(password):
+        results.append(ldap.validate('user', password))
+
+    threads = [threading.Thread(target=validate, args=('password',))]
+    threads[0].start()
+    assert started.wait(10)
+    threads.extend(threading.Thread(target=validate, args=('password',)) for _i in range(3))
+    threads.append(threading.Thread(target=validate, args=('wrong',)))
+    for thread in threads[1:]:
+        thread.start()
+    while ldap._validations_in_flight.coalesced < 3:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    # other credentials are validated separately
+    assert sorted(calls) == [('user', 'password'), ('user', 'wrong')]
+    assert results.count(dict(status="ok", groups=['users'])) == 4
+    assert results.count(dict(status="unknown")) == 1
+    # every caller gets its own copy
+    assert len({id(x) for x in results}) == 5
+
+
+@pytest.fixture
+def group_cache_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "group_cache": {
+            "ttl": 60,
+            "max_stale": 30}}})
+    return ldap_config
+
+
+@pytest.fixture
+def search_calls(LDAP, monkeypatch):
+    calls = []
+    original_search = LDAP.ldap3.Connection.search
+
+    def search(self, base, search_filter, search_scope, attributes, **kw):
+        calls.append(search_filter)
+        return original_search(self, base, search_filter, search_scope, attributes, **kw)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'search', search)
+    return calls
+
+
+def test_group_cache(LDAP, MockServer, bind_calls, group_cache_config, search_calls):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(group_cache_config.strpath)
+    now = [0]
+    ldap._group_cache.clock = lambda: now[0]
+    refreshes = []
+    ldap._run_in_background = lambda *args: refreshes.append(args)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    MockServer.users['user']['groups'] = [dict(cn='users'), dict(cn='admins')]
+    now[0] = 59
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    # the password is still checked every time
+    assert bind_calls == ['user', 'user']
+    assert search_calls == ['group:user']
+    # after the ttl the stale groups are returned and refreshed in background
+    now[0] = 60
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert len(refreshes) == 1
+    assert search_calls == ['group:user']
+    (func, *args) = refreshes.pop()
+    func(*args)
+    assert search_calls == ['group:user', 'group:user']
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users', 'admins'])
+    assert ldap._group_refreshes == set()
+    # beyond max_stale the groups are searched right away
+    MockServer.users['user']['groups'] = [dict(cn='admins')]
+    now[0] = 150
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['admins'])
+    assert refreshes == []
+    assert search_calls == ['group:user'] * 3
+
+
+@pytest.fixture
+def failing_searches(LDAP, monkeypatch):
+    # searches fail while the prefix of their filter is in the set
+    failing = set()
+    original_search = LDAP.ldap3.Connection.search
+
+    def search(self, base, search_filter, search_scope, attributes, **kw):
+        if search_filter.split(':')[0] in failing:
+            self.result = dict(result=1, description="operationsError")
+            return False
+        return original_search(self, base, search_filter, search_scope, attributes, **kw)
+
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'search', search)
+    return failing
+
+
+def test_dn_cache_search_failed(LDAP, MockServer, dn_cache_config, failing_searches):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(dn_cache_config.strpath)
+    failing_searches.add('user')
+    with pytest.raises(AuthException, match="Searching LDAP user 'user' failed"):
+        ldap.validate('user', 'password')
+    # a failed search isn't remembered as unknown user
+    assert len(ldap._dn_cache) == 0
+    failing_searches.clear()
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # a search without result is
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert len(ldap._dn_cache) == 2
+
+
+def test_negative_cache_search_failed(LDAP, MockServer, failing_searches, negative_cache_config):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(negative_cache_config.strpath)
+    failing_searches.add('user')
+    with pytest.raises(AuthException, match="Searching LDAP user 'user' failed"):
+        ldap.validate('user', 'password')
+    assert len(ldap._negative_cache) == 0
+    failing_searches.clear()
+    assert ldap.validate('user', 'password') == dict(status="ok")
+
+
+def test_group_cache_search_failed(LDAP, MockServer, group_cache_config, failing_searches):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(group_cache_config.strpath)
+    failing_searches.add('group')
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    # a failed search isn't remembered as no groups
+    assert len(ldap._group_cache) == 0
+    failing_searches.clear()
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert len(ldap._group_cache) == 1
+
+
+def test_validation_cache_group_search_failed(LDAP, MockServer, failing_searches, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    failing_searches.add('group')
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    assert len(ldap._validation_cache) == 0
+    failing_searches.clear()
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert len(ldap._validation_cache) == 1
+
+
+def test_group_cache_refresh_error(LDAP, MockServer, group_cache_config, monkeypatch):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(group_cache_config.strpath)
+    key = ('user', 'user')
+    ldap._group_refreshes.add(key)
+    monkeypatch.setattr(LDAP.ldap3.Connection, 'search', mock_raise(LDAP.LDAPException))
+    conn = LDAP.ldap3.Connection(ldap.server_pool())
+    ldap._refresh_groups(conn, ldap['group_search'], 'user', 'user')
+    assert ldap._group_refreshes == set()
+    assert ldap._group_cache.get(key) is None
+
+
+def mock_raise(exc):
+    def func(*args, **kw):
+        raise exc()
+    return func
+
+
+@pytest.fixture
+def dn_cache_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"},
+        "dn_cache": {
+            "ttl": 600,
+            "negative_ttl": 10}}})
+    return ldap_config
+
+
+def test_dn_cache(LDAP, MockServer, bind_calls, dn_cache_config, search_calls):
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(dn_cache_config.strpath)
+    now = [0]
+    ldap._dn_cache.clock = lambda: now[0]
+    for _i in range(3):
+        assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert search_calls == ['user:user']
+    assert bind_calls == [None, 'user', 'user', 'user', 'user']
+    # unknown users are remembered for a shorter time
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert search_calls == ['user:user', 'user:other']
+    now[0] = 10
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+    assert search_calls == ['user:user', 'user:other', 'user:other']
+
+
+def test_dn_cache_moved_user(LDAP, MockServer, bind_calls, dn_cache_config, search_calls):
+    # users are looked up by name and bound by DN
+    MockServer.users['user'] = dict(dn="cn=user")
+    MockServer.users['cn=user'] = dict(pw="password")
+    ldap = LDAP(dn_cache_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # the DN of the user changed
+    MockServer.users['user']['dn'] = 'cn=moved'
+    MockServer.users['cn=moved'] = MockServer.users.pop('cn=user')
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert search_calls == ['user:user', 'user:user']
+    assert bind_calls == [None, 'cn=user', 'cn=user', None, 'cn=moved']
+    assert ldap._dn_cache.get('user') == ('cn=moved', None)
+    # a wrong password doesn't cause a new lookup
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert search_calls == ['user:user', 'user:user']
+
+
+def test_dn_cache_requires_user_search(LDAP, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "dn_cache": {}}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.fixture
+def group_attribute_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn",
+            "group_attribute_name": "memberOf"}}})
+    return ldap_config
+
+
+def test_group_attribute(LDAP, MockServer, bind_calls, group_attribute_config, search_calls):
+    MockServer.users['user'] = dict(
+        pw="password", memberOf=["cn=foo,dc=example", "cn=bar,dc=example"])
+    ldap = LDAP(group_attribute_config.strpath)
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=["cn=foo,dc=example", "cn=bar,dc=example"])
+    # the user search is the only search
+    assert search_calls == ['user:user']
+    assert bind_calls == [None, 'user']
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+
+
+def test_group_attribute_rdn(LDAP, MockServer, group_attribute_config):
+    MockServer.users['user'] = dict(
+        pw="password", memberOf=["cn=foo,dc=example", "invalid"])
+    ldap = LDAP(group_attribute_config.strpath)
+    ldap['user_search']['group_attribute_rdn'] = True
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=["foo", "invalid"])
+
+
+def test_group_attribute_no_groups(LDAP, MockServer, group_attribute_config):
+    MockServer.users['user'] = dict(pw="password", memberOf=[])
+    ldap = LDAP(group_attribute_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+
+
+def test_group_attribute_dn_cache(LDAP, MockServer, group_attribute_config, search_calls):
+    config = yaml.safe_load(group_attribute_config.read())
+    config['devpi-ldap']['dn_cache'] = {}
+    group_attribute_config.dump(config)
+    MockServer.users['user'] = dict(pw="password", memberOf="cn=foo")
+    ldap = LDAP(group_attribute_config.strpath)
+    for _i in range(2):
+        assert ldap.validate('user', 'password') == dict(
+            status="ok", groups=["cn=foo"])
+    assert search_calls == ['user:user']
+
+
+@pytest.mark.parametrize("extra", [
+    {"group_search": {"base": "", "filter": "group:{userdn}", "attribute_name": "cn"}},
+    {"user_search": {"group_attribute_rdn": "yes"}}])
+def test_group_attribute_invalid(LDAP, extra, group_attribute_config):
+    config = yaml.safe_load(group_attribute_config.read())
+    for key, value in extra.items():
+        config['devpi-ldap'].setdefault(key, {}).update(value)
+    group_attribute_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(group_attribute_config.strpath)
+    assert e.value.code == 1
+
+
+def test_concurrency_limit(LDAP, MockServer, user_template_config):
+    from devpi_ldap.main import AuthException
+
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(user_template_config.strpath)
+    ldap['concurrency_limit'] = dict(max_concurrent=1, max_queue=0)
+    ldap._setup_state()
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap._limiter.active == 0
+    # simulate a running validation
+    ldap._limiter.acquire()
+    with pytest.raises(AuthException, match="Too many concurrent"):
+        ldap.validate('user', 'password')
+    assert ldap._limiter.rejected == 1
+    ldap._limiter.release()
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap._limiter.active == 0
+
+
+@pytest.mark.parametrize("limit_config", [
+    "foo",
+    {"max_concurrent": 0},
+    {"max_queue": -1},
+    {"queue_timeout": "1"},
+    {"max_concurrent": 10, "foo": 1}])
+def test_concurrency_limit_invalid(LDAP, ldap_config, limit_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "concurrency_limit": limit_config}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+def test_timeouts(LDAP, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "timeout": 3,
+        "connect_timeout": 2}})
+    ldap = LDAP(ldap_config.strpath)
+    (server,) = ldap.server_pool().servers
+    assert server.connect_timeout == 2
+    assert ldap.connection(server).receive_timeout == 3
+    # ldap3 only supports whole seconds
+    ldap['receive_timeout'] = 0.5
+    assert ldap.connection(server).receive_timeout == 1
+
+
+def test_deadline(LDAP, MockServer, ldap_config):
+    from devpi_ldap.main import AuthException
+    import time
+
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"},
+        "deadline": 1.5}})
+    MockServer.users['user'] = dict(pw="password", dn="user")
+    ldap = LDAP(ldap_config.strpath)
+    conns = []
+    orig_connection = ldap.connection
+
+    def connection(*args, **kw):
+        conns.append(orig_connection(*args, **kw))
+        return conns[-1]
+
+    ldap.connection = connection
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # the receive timeout is limited to the remaining time
+    assert [x.receive_timeout for x in conns] == [2, 2]
+    # the deadline passed before the validation is done
+    ldap._new_deadline = lambda: time.monotonic() - 1
+    with pytest.raises(AuthException, match="deadline"):
+        ldap.validate('user', 'password')
+
+
+def test_deadline_server_pool(LDAP, MockServer, circuit_breaker_config, open_calls):
+    from devpi_ldap.main import AuthException
+    import time
+
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(circuit_breaker_config.strpath)
+    ldap['deadline'] = 5
+    ldap._new_deadline = lambda: time.monotonic() - 1
+    with pytest.raises(AuthException, match="deadline"):
+        ldap.validate('user', 'password')
+    assert open_calls == []
+    # running out of time isn't counted as failure of the servers
+    assert [x.failures for x in ldap.server_health()] == [0, 0]
+
+
+@pytest.mark.parametrize("key", [
+    "timeout", "connect_timeout", "receive_timeout", "deadline"])
+@pytest.mark.parametrize("value", [0, -1, "10", True])
+def test_timeouts_invalid(LDAP, key, ldap_config, value):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        key: value}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.fixture
+def nested_groups_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "nested_groups": {
+            "filter": "parent:{groupdn}"}}})
+    return ldap_config
+
+
+@pytest.fixture
+def nested_groups(MockServer):
+    MockServer.users['user'] = dict(pw="password", groups=[
+        dict(cn='a', dn='cn=a'), dict(cn='b', dn='cn=b')])
+    MockServer.users['other'] = dict(pw="password", groups=[
+        dict(cn='a', dn='cn=a')])
+    MockServer.groups['cn=a'] = [dict(cn='c', dn='cn=c')]
+    MockServer.groups['cn=b'] = [dict(cn='c', dn='cn=c')]
+    MockServer.groups['cn=c'] = [dict(cn='d', dn='cn=d')]
+    # a cycle
+    MockServer.groups['cn=d'] = [dict(cn='a', dn='cn=a')]
+
+
+@pytest.mark.usefixtures("nested_groups")
+def test_nested_groups(LDAP, nested_groups_config, search_calls):
+    ldap = LDAP(nested_groups_config.strpath)
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=["a", "b", "c", "d"])
+    assert search_calls == [
+        'group:user', 'parent:cn=a', 'parent:cn=b', 'parent:cn=c', 'parent:cn=d']
+    # the parents of shared groups are remembered
+    assert ldap.validate('other', 'password') == dict(
+        status="ok", groups=["a", "c", "d"])
+    assert search_calls[5:] == ['group:other']
+
+
+@pytest.mark.usefixtures("nested_groups")
+@pytest.mark.parametrize(("limits", "groups"), [
+    ({"max_depth": 1}, ["a", "b", "c"]),
+    ({"max_groups": 3}, ["a", "b", "c"]),
+    ({"max_groups": 1}, ["a", "b"])])
+def test_nested_groups_limits(LDAP, groups, limits, nested_groups_config):
+    ldap = LDAP(nested_groups_config.strpath)
+    ldap['nested_groups'].update(limits)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=groups)
+
+
+@pytest.mark.usefixtures("nested_groups")
+def test_nested_groups_search_failed(LDAP, failing_searches, nested_groups_config):
+    from devpi_ldap.cache import IncompleteGroups
+    ldap = LDAP(nested_groups_config.strpath)
+    failing_searches.add('parent')
+    result = ldap.validate('user', 'password')
+    assert result == dict(status="ok", groups=["a", "b"])
+    assert isinstance(result['groups'], IncompleteGroups)
+    # a failed search isn't remembered as group without parents
+    assert len(ldap._nested_group_cache) == 0
+    failing_searches.clear()
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=["a", "b", "c", "d"])
+    assert len(ldap._nested_group_cache) == 4
+
+
+@pytest.mark.parametrize("nested_config", [
+    "foo",
+    {},
+    {"filter": "parent:{groupdn}", "max_depth": 0},
+    {"filter": "parent:{groupdn}", "foo": 1}])
+def test_nested_groups_invalid(LDAP, nested_config, nested_groups_config):
+    config = yaml.safe_load(nested_groups_config.read())
+    config['devpi-ldap']['nested_groups'] = nested_config
+    nested_groups_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(nested_groups_config.strpath)
+    assert e.value.code == 1
+
+
+def test_nested_groups_requires_group_search(LDAP, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "nested_groups": {"filter": "parent:{groupdn}"}}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+def test_paged_search(LDAP, MockServer, group_user_search_config, search_calls):
+    config = yaml.safe_load(group_user_search_config.read())
+    config['devpi-ldap']['user_search']['page_size'] = 2
+    config['devpi-ldap']['group_search']['page_size'] = 2
+    group_user_search_config.dump(config)
+    MockServer.users['user'] = dict(pw="password", dn="user", groups=[
+        dict(cn=x) for x in ('a', 'b', 'a', 'c', 'd')])
+    ldap = LDAP(group_user_search_config.strpath)
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=['a', 'b', 'c', 'd'])
+    # one page for the user, three for the groups
+    assert search_calls == ['user:user'] + ['group:user'] * 3
+    assert ldap.validate('other', 'password') == dict(status="unknown")
+
+
+@pytest.fixture
+def failing_pages(monkeypatch):
+    # follow-up pages of paged searches fail while set
+    failing = []
+    original_paged_search = MockConnection._paged_search
+
+    def _paged_search(self, *args, paged_cookie=None, **kw):
+        if paged_cookie and failing:
+            self.result = dict(result=1, description="operationsError")
+            return False
+        return original_paged_search(self, *args, paged_cookie=paged_cookie, **kw)
+
+    monkeypatch.setattr(MockConnection, '_paged_search', _paged_search)
+    return failing
+
+
+def test_paged_search_page_failed(LDAP, MockServer, failing_pages, group_user_search_config):
+    config = yaml.safe_load(group_user_search_config.read())
+    config['devpi-ldap']['group_search']['page_size'] = 2
+    config['devpi-ldap']['validation_cache'] = {}
+    group_user_search_config.dump(config)
+    MockServer.users['user'] = dict(pw="password", dn="user", groups=[
+        dict(cn='g%d' % x) for x in range(5)])
+    ldap = LDAP(group_user_search_config.strpath)
+    failing_pages.append(True)
+    # the groups of the first page aren't used as complete result
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=[])
+    assert len(ldap._validation_cache) == 0
+    failing_pages.clear()
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=['g0', 'g1', 'g2', 'g3', 'g4'])
+
+
+def test_group_sync_page_failed(LDAP, MockServer, failing_pages, group_sync_config):
+    config = yaml.safe_load(group_sync_config.read())
+    config['devpi-ldap']['group_search']['page_size'] = 2
+    group_sync_config.dump(config)
+    MockServer.users['CN=user'] = dict(pw="password")
+    MockServer.all_groups = [
+        dict(dn='cn=g%d' % x, cn='g%d' % x, member=['cn=user']) for x in range(5)]
+    ldap = LDAP(group_sync_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    assert ldap.sync_groups()
+    failing_pages.append(True)
+    # the full snapshot isn't replaced by a partial one
+    assert not ldap.sync_groups()
+    assert ldap.validate('user', 'password') == dict(
+        status="ok", groups=['g0', 'g1', 'g2', 'g3', 'g4'])
+
+
+@pytest.mark.parametrize("page_size", [0, "10", True])
+def test_paged_search_invalid(LDAP, group_user_search_config, page_size):
+    config = yaml.safe_load(group_user_search_config.read())
+    config['devpi-ldap']['group_search']['page_size'] = page_size
+    group_user_search_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(group_user_search_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.fixture
+def group_sync_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "CN={username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "group_sync": {
+            "filter": "allgroups",
+            "interval": 60}}})
+    return ldap_config
+
+
+def test_group_sync(LDAP, MockServer, group_sync_config, search_calls):
+    MockServer.users['CN=user'] = dict(pw="password", groups=[dict(cn='searched')])
+    MockServer.users['CN=other'] = dict(pw="password")
+    MockServer.all_groups = [
+        dict(dn='cn=a', cn='a', member=['cn=user', 'cn=other']),
+        dict(dn='cn=b', cn='b', member=['CN=user']),
+        dict(dn='cn=empty', cn='empty')]
+    ldap = LDAP(group_sync_config.strpath)
+    started = []
+
+    def run_in_background(*args):
+        started.append(args)
+        return args
+
+    ldap._run_in_background = run_in_background
+    # without a snapshot the groups are searched
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['searched'])
+    assert started == [(ldap._group_sync_loop,)]
+    assert ldap.sync_groups()
+    assert search_calls == ['group:CN=user', 'allgroups']
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['a', 'b'])
+    assert ldap.validate('other', 'password') == dict(status="ok", groups=['a'])
+    assert search_calls == ['group:CN=user', 'allgroups']
+    # the sync is only started once
+    assert len(started) == 1
+
+
+def test_group_sync_failure(LDAP, MockServer, group_sync_config, monkeypatch):
+    MockServer.users['CN=user'] = dict(pw="password", groups=[dict(cn='searched')])
+    MockServer.all_groups = [dict(dn='cn=a', cn='a', member=['cn=user'])]
+    ldap = LDAP(group_sync_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    now = [0]
+    ldap._group_index.clock = lambda: now[0]
+    assert ldap.sync_groups()
+    monkeypatch.setattr(MockConnection, 'search', mock_raise(ldap.LDAPException))
+    assert not ldap.sync_groups()
+    monkeypatch.undo()
+    # the old snapshot is still used
+    now[0] = 180
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['a'])
+    # until it is too old
+    now[0] = 181
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['searched'])
+
+
+def test_group_sync_username(LDAP, MockServer, group_sync_config):
+    config = yaml.safe_load(group_sync_config.read())
+    config['devpi-ldap']['group_sync'].update(
+        member_attribute='memberUid', member_key='username')
+    group_sync_config.dump(config)
+    MockServer.users['CN=user'] = dict(pw="password")
+    MockServer.all_groups = [dict(dn='cn=a', cn='a', memberUid='user')]
+    ldap = LDAP(group_sync_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    assert ldap.sync_groups()
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['a'])
+
+
+@pytest.mark.parametrize("sync_config", [
+    "foo",
+    {},
+    {"filter": "allgroups", "member_key": "uid"},
+    {"filter": "allgroups", "member_attribute": 1},
+    {"filter": "allgroups", "interval": 0},
+    {"filter": "allgroups", "foo": 1}])
+def test_group_sync_invalid(LDAP, group_sync_config, sync_config):
+    config = yaml.safe_load(group_sync_config.read())
+    config['devpi-ldap']['group_sync'] = sync_config
+    group_sync_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(group_sync_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.fixture
+def change_poll_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_search": {
+            "base": "",
+            "filter": "user:{username}",
+            "attribute_name": "dn"},
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "dn_cache": {},
+        "group_cache": {},
+        "validation_cache": {},
+        "change_poll": {"interval": 10}}})
+    return ldap_config
+
+
+@pytest.fixture
+def change_poll_users(MockServer):
+    for name in ('user', 'other'):
+        MockServer.users[name] = dict(dn='cn=%s' % name)
+        MockServer.users['cn=%s' % name] = dict(
+            pw="password", groups=[dict(cn='g_%s' % name)])
+
+
+@pytest.mark.usefixtures("change_poll_users")
+def test_change_poll(LDAP, MockServer, change_poll_config, search_calls):
+    from devpi_ldap.changes import ChangeWatermark
+
+    ldap = LDAP(change_poll_config.strpath)
+    started = []
+
+    def run_in_background(*args):
+        started.append(args)
+        return args
+
+    ldap._run_in_background = run_in_background
+    for name in ('user', 'other'):
+        assert ldap.validate(name, 'password') == dict(
+            status="ok", groups=['g_%s' % name])
+    assert started == [(ldap._change_poll_loop,)]
+    ldap._change_watermark = ChangeWatermark('modifyTimestamp', '20260101000000Z')
+    # the group of the user changed
+    MockServer.changed = [dict(
+        dn='cn=g_user', modifyTimestamp='20260101000100.0Z', cn='g_user',
+        member=['CN=user'])]
+    del search_calls[:]
+    assert ldap.poll_changes()
+    assert search_calls == ['(modifyTimestamp>=20260101000000Z)']
+    assert ldap._change_watermark.value == '20260101000100Z'
+    assert [len(x) for x in (ldap._dn_cache, ldap._group_cache, ldap._validation_cache)] == [1, 1, 1]
+    assert ldap._dn_cache.get('other') == ('cn=other', None)
+    for name in ('user', 'other'):
+        assert ldap.validate(name, 'password') == dict(
+            status="ok", groups=['g_%s' % name])
+    assert search_calls[1:] == ['user:user', 'group:cn=user']
+    # the same change isn't applied again
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 2
+    # a change of the user entry
+    MockServer.changed.append(dict(
+        dn='cn=other', modifyTimestamp='20260101000200Z'))
+    assert ldap.poll_changes()
+    assert ldap._dn_cache.get('other') is None
+    assert ldap._dn_cache.get('user') == ('cn=user', None)
+
+
+@pytest.mark.usefixtures("change_poll_users")
+def test_change_poll_usn(LDAP, MockServer, change_poll_config):
+    config = yaml.safe_load(change_poll_config.read())
+    config['devpi-ldap']['change_poll']['attribute'] = 'uSNChanged'
+    change_poll_config.dump(config)
+    MockServer.highest_usn = 5
+    MockServer.changed = [dict(dn='cn=user', uSNChanged=5)]
+    ldap = LDAP(change_poll_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    assert ldap.poll_changes()
+    assert ldap._change_watermark.filter() == '(uSNChanged>=6)'
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['g_user'])
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 1
+    MockServer.changed.append(dict(dn='cn=user', uSNChanged=7))
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 0
+    assert ldap._change_watermark.value == 7
+
+
+@pytest.mark.usefixtures("change_poll_users")
+def test_change_poll_validation_cache_only(LDAP, MockServer, change_poll_config):
+    from devpi_ldap.changes import ChangeWatermark
+
+    config = yaml.safe_load(change_poll_config.read())
+    del config['devpi-ldap']['dn_cache']
+    del config['devpi-ldap']['group_cache']
+    change_poll_config.dump(config)
+    ldap = LDAP(change_poll_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    ldap._change_watermark = ChangeWatermark('modifyTimestamp', '20260101000000Z')
+    for name in ('user', 'other'):
+        assert ldap.validate(name, 'password') == dict(
+            status="ok", groups=['g_%s' % name])
+    # a change of the user entry
+    MockServer.changed = [dict(dn='cn=user', modifyTimestamp='20260101000100Z')]
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 1
+    # a new member of a group the user isn't cached with
+    MockServer.changed.append(dict(
+        dn='cn=g_new', modifyTimestamp='20260101000200Z', cn='g_new',
+        member=['cn=other']))
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 0
+
+
+def test_change_poll_user_template(LDAP, MockServer, ldap_config):
+    from devpi_ldap.changes import ChangeWatermark
+
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "cn={username}",
+        "group_search": {
+            "base": "",
+            "filter": "group:{userdn}",
+            "attribute_name": "cn"},
+        "validation_cache": {},
+        "change_poll": {}}})
+    MockServer.users['cn=user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(ldap_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    ldap._change_watermark = ChangeWatermark('modifyTimestamp', '20260101000000Z')
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    MockServer.changed = [dict(dn='cn=user', modifyTimestamp='20260101000100Z')]
+    assert ldap.poll_changes()
+    assert len(ldap._validation_cache) == 0
+
+
+@pytest.mark.parametrize("poll_config", [
+    "foo",
+    {"attribute": "whenChanged"},
+    {"member_attribute": 1},
+    {"interval": 0},
+    {"foo": 1}])
+def test_change_poll_invalid(LDAP, change_poll_config, poll_config):
+    config = yaml.safe_load(change_poll_config.read())
+    config['devpi-ldap']['change_poll'] = poll_config
+    change_poll_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(change_poll_config.strpath)
+    assert e.value.code == 1
+
+
+def test_change_poll_usn_server_pool(LDAP, change_poll_config):
+    config = yaml.safe_load(change_poll_config.read())
+    config['devpi-ldap']['change_poll']['attribute'] = 'uSNChanged'
+    del config['devpi-ldap']['url']
+    config['devpi-ldap']['server_pool'] = [
+        {"url": "ldap://server1"}, {"url": "ldap://server2"}]
+    change_poll_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(change_poll_config.strpath)
+    assert e.value.code == 1
+    # a single server is fine
+    del config['devpi-ldap']['server_pool'][1]
+    change_poll_config.dump(config)
+    assert LDAP(change_poll_config.strpath)['change_poll']['attribute'] == 'uSNChanged'
+
+
+@pytest.fixture
+def fallback_ldap(LDAP, MockServer, circuit_breaker_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(circuit_breaker_config.strpath)
+    ldap['group_search'] = dict(base="", filter="group:{userdn}", attribute_name="cn")
+    ldap['fallback_cache'] = dict(max_stale=600)
+    ldap._setup_state()
+    ldap._run_in_background = lambda *_args: True
+    return ldap
+
+
+def test_fallback_cache(fallback_ldap, open_calls):
+    from devpi_ldap.main import AuthException
+
+    ldap = fallback_ldap
+    now = [0]
+    ldap._fallback_cache.clock = lambda: now[0]
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    open_calls.failing.update(["ldap://server1", "ldap://server2"])
+    del open_calls[:]
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert open_calls == ["ldap://server1", "ldap://server2"]
+    # only for known credentials
+    with pytest.raises(AuthException):
+        ldap.validate('user', 'wrong')
+    # with all servers failing, they aren't tried
+    del open_calls[:]
+    assert all(x.tripped for x in ldap.server_health())
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert open_calls == []
+    # up to max_stale seconds after the last successful validation
+    now[0] = 600
+    with pytest.raises(AuthException):
+        ldap.validate('user', 'password')
+
+
+def test_fallback_cache_rejected(fallback_ldap, open_calls):
+    from devpi_ldap.main import AuthException
+
+    ldap = fallback_ldap
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    open_calls.failing.add("ldap://server1")
+    open_calls.failing.add("ldap://server2")
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    open_calls.failing.clear()
+    for health in ldap.server_health():
+        health.record_success()
+    # the password isn't valid anymore
+    ldap.ldap3.Server.users['user']['pw'] = 'changed'
+    assert ldap.validate('user', 'password') == dict(status="unknown")
+    open_calls.failing.add("ldap://server1")
+    open_calls.failing.add("ldap://server2")
+    with pytest.raises(AuthException):
+        ldap.validate('user', 'password')
+
+
+@pytest.mark.parametrize("fallback_config", [
+    "foo",
+    {"max_stale": 0},
+    {"ttl": 10}])
+def test_fallback_cache_invalid(LDAP, fallback_config, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "fallback_cache": fallback_config}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.mark.parametrize("configname", ["validation_cache", "negative_cache"])
+@pytest.mark.parametrize("cache_config", [
+    "foo",
+    {"ttl": 0},
+    {"maxsize": "10"},
+    {"ttl": 10, "foo": 1}])
+def test_cache_invalid(LDAP, cache_config, configname, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        configname: cache_config}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
 class TestAuthPlugin:
     @pytest.fixture(params=["--configfile", "--ldap-config"])
     def xom(self, makexom, request, user_template_config):
@@ -555,3 +2262,380 @@ class TestAuthPlugin:
             api.login, {"user": 'user', "password": 'password'})
         assert r.json['message'] == 'login successful'
         assert validate_called
+
+    @pytest.mark.usefixtures("LDAP")
+    def test_plugin_call_error(self, caplog, MockServer, mapp, monkeypatch, testapp):
+        import devpi_ldap.main
+
+        MockServer.users['user'] = dict(pw="password")
+
+        def validate(self, username, password, **kw):
+            msg = "Too many concurrent LDAP validations."
+            raise devpi_ldap.main.AuthException(msg)
+
+        monkeypatch.setattr(devpi_ldap.main.LDAP, "validate", validate)
+        api = mapp.getapi()
+        r = testapp.post_json(
+            api.login, {"user": 'user', "password": 'password'},
+            expect_errors=True)
+        assert r.status_code == 401
+        assert "Too many concurrent LDAP validations." in caplog.text
+
+
+class TestAuthPluginSearchError:
+    @pytest.fixture
+    def xom(self, makexom, group_user_template_config):
+        import devpi_ldap.main
+
+        return makexom(
+            opts=["--configfile", group_user_template_config.strpath],
+            plugins=[(devpi_ldap.main, None)],
+        )
+
+    @pytest.mark.usefixtures("LDAP")
+    def test_plugin_call_search_error(self, caplog, MockServer, mapp, monkeypatch, testapp):
+        import devpi_ldap.main
+
+        MockServer.users['user'] = dict(pw="password")
+        monkeypatch.setattr(
+            MockConnection, 'search', mock_raise(devpi_ldap.main.LDAP.LDAPException))
+        api = mapp.getapi()
+        r = testapp.post_json(
+            api.login, {"user": 'user', "password": 'password'},
+            expect_errors=True)
+        assert r.status_code == 401
+        assert "Validation of user named 'user' failed" in caplog.text
+
+
+def test_shared_cache(LDAP, MockServer, bind_calls, validation_cache_config, tmp_path):
+    from devpi_ldap.shared import SharedCache
+    config = yaml.safe_load(validation_cache_config.read())
+    config['devpi-ldap']['shared_cache'] = {'path': str(tmp_path / 'cache.sqlite')}
+    config['devpi-ldap']['negative_cache'] = {'ttl': 10}
+    validation_cache_config.dump(config)
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    assert isinstance(ldap._validation_cache, SharedCache)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert bind_calls == ['user', 'user']
+    # another process uses the results
+    other = LDAP(validation_cache_config.strpath)
+    assert other.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert other.validate('user', 'wrong') == dict(status="unknown")
+    assert bind_calls == ['user', 'user']
+
+
+def test_shared_cache_serverdir(LDAP, validation_cache_config, tmp_path):
+    from devpi_ldap.cache import TTLCache
+    from devpi_ldap.main import SHARED_CACHE_FILENAME
+    from devpi_ldap.shared import SharedCache
+    config = yaml.safe_load(validation_cache_config.read())
+    config['devpi-ldap']['shared_cache'] = {}
+    validation_cache_config.dump(config)
+    ldap = LDAP(validation_cache_config.strpath)
+    # without devpi-server there is no place for the file
+    assert isinstance(ldap._validation_cache, TTLCache)
+    ldap.use_serverdir(tmp_path)
+    assert isinstance(ldap._validation_cache, SharedCache)
+    assert ldap._validation_cache.store.path == str(tmp_path / SHARED_CACHE_FILENAME)
+    assert ldap._credential_key.salt == ldap._shared_store.salt
+
+
+@pytest.mark.parametrize("shared_config", [
+    "foo",
+    {"path": 1},
+    {"path": "foo", "ttl": 10}])
+def test_shared_cache_invalid(LDAP, shared_config, ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "shared_cache": shared_config}})
+    with pytest.raises(SystemExit) as e:
+        LDAP(ldap_config.strpath)
+    assert e.value.code == 1
+
+
+@pytest.fixture
+def bind_pool_config(ldap_config):
+    ldap_config.dump({"devpi-ldap": {
+        "url": "ldap://localhost",
+        "user_template": "{username}",
+        "bind_pool": {"maxsize": 2}}})
+    return ldap_config
+
+
+def test_bind_pool(LDAP, MockServer, bind_calls, open_calls, bind_pool_config):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(bind_pool_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # one connection, which goes back to anonymous after each check
+    assert open_calls == ["ldap://localhost"]
+    assert bind_calls == [None, 'user', None, 'user', None, 'user', None]
+    assert (ldap._bind_pool.size, ldap._bind_pool.idle) == (1, 1)
+    (_last_used, conn) = ldap._bind_pool._idle[0]
+    assert (conn.user, conn.password, conn.bound) == (None, None, True)
+    assert MockServer.info_reads == 0
+    metrics = {name: value for (name, _kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_server_ldap_localhost_bind_count'] == 4
+
+
+def test_bind_pool_failure(LDAP, MockServer, bind_pool_config, mock, monkeypatch):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(bind_pool_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    monkeypatch.setattr(
+        MockConnection, 'rebind', mock.Mock(side_effect=LDAP.LDAPException()))
+    with pytest.raises(AuthException, match="Couldn't bind pooled LDAP connection"):
+        ldap.validate('user', 'password')
+    metrics = {name: value for (name, _kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_server_ldap_localhost_bind_errors'] == 2
+
+
+def test_bind_pool_reconnect(LDAP, MockServer, bind_calls, bind_pool_config, mock):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(bind_pool_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    (_last_used, conn) = ldap._bind_pool._idle[0]
+    conn.rebind = mock.Mock(side_effect=LDAP.LDAPException())
+    del bind_calls[:]
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert bind_calls == [None, 'user', None]
+    assert ldap._bind_pool.size == 1
+    assert ldap._bind_pool._idle[0][1] is not conn
+
+
+def test_bind_pool_moved_user(LDAP, MockServer, bind_calls, dn_cache_config):
+    config = yaml.safe_load(dn_cache_config.read())
+    config['devpi-ldap']['bind_pool'] = {}
+    dn_cache_config.dump(config)
+    # users are looked up by name and bound by DN
+    MockServer.users['user'] = dict(dn="cn=user")
+    MockServer.users['cn=user'] = dict(pw="password")
+    ldap = LDAP(dn_cache_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    # the DN of the user changed, the pooled bind reports it
+    MockServer.users['user']['dn'] = 'cn=moved'
+    MockServer.users['cn=moved'] = MockServer.users.pop('cn=user')
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    assert ldap._dn_cache.get('user') == ('cn=moved', None)
+    assert bind_calls[-2:] == ['cn=moved', None]
+
+
+def test_bind_pool_requires_group_search_userdn(LDAP, bind_pool_config):
+    config = yaml.safe_load(bind_pool_config.read())
+    config['devpi-ldap']['group_search'] = {
+        "base": "", "filter": "group:{userdn}", "attribute_name": "cn"}
+    bind_pool_config.dump(config)
+    with pytest.raises(SystemExit) as e:
+        LDAP(bind_pool_config.strpath)
+    assert e.value.code == 1
+    config['devpi-ldap']['group_search'].update({
+        "userdn": "cn=search", "password": "secret"})
+    bind_pool_config.dump(config)
+    LDAP(bind_pool_config.strpath)
+
+
+def test_lazy_groups(LDAP, MockServer, bind_calls, validation_cache_config, search_calls):
+    from devpi_ldap.cache import LazyGroups
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    result = ldap.validate('user', 'password', lazy_groups=True)
+    assert isinstance(result['groups'], LazyGroups)
+    assert search_calls == []
+    # cached right away, without the groups until they are known
+    key = ldap._credential_key('user', 'password')
+    assert ldap._validation_cache.get(key) == dict(status="ok", groups=None)
+    assert result == dict(status="ok", groups=['users'])
+    assert ldap._validation_cache.get(key) == dict(status="ok", groups=['users'])
+    assert search_calls == ['group:user']
+    assert list(result['groups']) == ['users']
+    assert search_calls == ['group:user']
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user']
+
+
+def test_lazy_groups_error(LDAP, MockServer, validation_cache_config, mock, monkeypatch):
+    from devpi_ldap.main import AuthException
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    result = ldap.validate('user', 'password', lazy_groups=True)
+    monkeypatch.setattr(ldap, "_search_groups", mock.Mock(side_effect=AuthException("failed")))
+    # no groups, which are not remembered
+    assert list(result['groups']) == []
+    key = ldap._credential_key('user', 'password')
+    assert ldap._validation_cache.get(key) == dict(status="ok", groups=None)
+
+
+def test_lazy_groups_deadline(LDAP, MockServer, validation_cache_config, monkeypatch):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    # stands in for the time at which a deadline is calculated
+    phase = ['validation']
+    monkeypatch.setattr(ldap, "_new_deadline", lambda: phase[0])
+    conns = []
+    orig_connection = ldap.connection
+
+    def connection(*args, **kw):
+        conns.append(orig_connection(*args, **kw))
+        return conns[-1]
+
+    ldap.connection = connection
+    used = []
+    orig_search_groups = ldap._search_groups
+
+    def search_groups(*args):
+        used.append(ldap._local.deadline)
+        return orig_search_groups(*args)
+
+    monkeypatch.setattr(ldap, "_search_groups", search_groups)
+    result = ldap.validate('user', 'password', lazy_groups=True)
+    assert [x.closed for x in conns] == [False]
+    phase[0] = 'resolution'
+    # the deadline of the group search starts when it is resolved
+    assert list(result['groups']) == ['users']
+    assert used == ['resolution']
+    assert ldap._local.deadline is None
+    # the connection bound as the user is closed afterwards
+    assert [x.closed for x in conns] == [True]
+
+
+def test_lazy_groups_cached(LDAP, MockServer, bind_calls, validation_cache_config, search_calls):
+    from devpi_ldap.cache import LazyGroups
+    for name in ('user', 'other'):
+        MockServer.users[name] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    ldap.validate('user', 'password', lazy_groups=True)
+    # later requests which don't use the groups don't need LDAP
+    result = ldap.validate('user', 'password', lazy_groups=True)
+    assert isinstance(result['groups'], LazyGroups)
+    assert bind_calls == ['user']
+    assert search_calls == []
+    # using the groups validates again and remembers them
+    assert result == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user', 'user']
+    assert search_calls == ['group:user']
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user', 'user']
+    # requests which need the groups right away validate again
+    ldap.validate('other', 'password', lazy_groups=True)
+    assert ldap.validate('other', 'password') == dict(status="ok", groups=['users'])
+    assert bind_calls == ['user', 'user', 'other', 'other']
+    assert ldap.validate('other', 'password', lazy_groups=True) == dict(
+        status="ok", groups=['users'])
+    assert bind_calls == ['user', 'user', 'other', 'other']
+
+
+def test_lazy_groups_fallback(fallback_ldap, open_calls):
+    from devpi_ldap.cache import IncompleteGroups
+
+    ldap = fallback_ldap
+    ldap.ldap3.Server.users['other'] = dict(pw="password", groups=[dict(cn='users')])
+    assert ldap.validate('other', 'password') == dict(status="ok", groups=['users'])
+    for name in ('user', 'other'):
+        assert ldap.validate(name, 'password', lazy_groups=True)['status'] == "ok"
+    open_calls.failing.update(["ldap://server1", "ldap://server2"])
+    # the groups weren't known, so there are none
+    result = ldap.validate('user', 'password')
+    assert result == dict(status="ok", groups=[])
+    assert isinstance(result['groups'], IncompleteGroups)
+    # known groups aren't replaced by unknown ones
+    assert ldap.validate('other', 'password') == dict(status="ok", groups=['users'])
+
+
+@pytest.mark.parametrize(("method", "route", "expected"), [
+    ("GET", "/{user}/{index}/+simple/", True),
+    ("HEAD", None, True),
+    ("POST", "/{user}/{index}/", False),
+    ("GET", "/+api", False),
+    ("GET", "/{user}/{index}/+api", False),
+    ("POST", "/+login", False)])
+def test_groups_used_lazily(method, route, expected):
+    from devpi_ldap.main import groups_used_lazily
+    from types import SimpleNamespace
+    request = SimpleNamespace(
+        method=method,
+        matched_route=None if route is None else SimpleNamespace(name=route))
+    assert groups_used_lazily(dict(lazy_groups=True), request) is expected
+    assert groups_used_lazily(dict(), request) is False
+
+
+def test_metrics(LDAP, MockServer, validation_cache_config):
+    MockServer.users['user'] = dict(pw="password", groups=[dict(cn='users')])
+    ldap = LDAP(validation_cache_config.strpath)
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert ldap.validate('user', 'password') == dict(status="ok", groups=['users'])
+    assert ldap.validate('user', 'wrong') == dict(status="unknown")
+    metrics = {name: (kind, value) for (name, kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_validations_ok'] == ('counter', 2)
+    assert metrics['devpi_ldap_validations_unknown'] == ('counter', 1)
+    assert metrics['devpi_ldap_rejections'] == ('counter', 1)
+    assert metrics['devpi_ldap_validation_count'] == ('counter', 3)
+    assert metrics['devpi_ldap_user_bind_count'] == ('counter', 2)
+    assert metrics['devpi_ldap_group_search_count'] == ('counter', 1)
+    assert metrics['devpi_ldap_server_ldap_localhost_bind_count'] == ('counter', 2)
+    assert metrics['devpi_ldap_server_ldap_localhost_search_count'] == ('counter', 1)
+    assert 'devpi_ldap_server_ldap_localhost_search_bytes' not in metrics
+    assert metrics['devpi_ldap_validation_cache_hits'] == ('counter', 1)
+    assert metrics['devpi_ldap_validation_cache_lookups'] == ('counter', 3)
+    assert metrics['devpi_ldap_validation_cache_size'] == ('gauge', 1)
+    assert 'devpi_ldap_dn_search_count' not in metrics
+
+
+def test_metrics_failover(LDAP, MockServer, circuit_breaker_config, open_calls):
+    MockServer.users['user'] = dict(pw="password")
+    ldap = LDAP(circuit_breaker_config.strpath)
+    ldap._run_in_background = lambda *_args: True
+    open_calls.failing.add("ldap://server1")
+    assert ldap.validate('user', 'password') == dict(status="ok")
+    metrics = {name: value for (name, _kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_failovers'] == 1
+    assert metrics['devpi_ldap_server_ldap_server1_connect_errors'] == 1
+    assert 'devpi_ldap_server_ldap_server1_bind_count' not in metrics
+    assert metrics['devpi_ldap_server_ldap_server2_connect_count'] == 1
+    assert metrics['devpi_ldap_server_ldap_server2_bind_count'] == 1
+
+
+def test_metrics_hook(LDAP, user_template_config):
+    from devpi_ldap.main import devpiserver_metrics
+    from types import SimpleNamespace
+    request = SimpleNamespace(registry={})
+    assert devpiserver_metrics(request) == []
+    request.registry['devpi_ldap'] = LDAP(user_template_config.strpath)
+    assert devpiserver_metrics(request) == [
+        ('devpi_ldap_coalesced_validations', 'counter', 0)]
+
+
+def test_metrics_search_bytes(LDAP, user_template_config):
+    from types import SimpleNamespace
+    ldap = LDAP(user_template_config.strpath)
+    conn = SimpleNamespace(
+        server='ldap://localhost', result=None,
+        usage=SimpleNamespace(bytes_received=10))
+
+    def search(*args, **kw):
+        conn.usage.bytes_received += 90
+        conn.response = [dict(dn='user', attributes={})]
+        return True
+
+    conn.search = search
+    request = dict(search_base='', search_filter='', search_scope=None, attributes=[])
+    ldap._search_page(conn, {}, request)
+    metrics = {name: value for (name, _kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_server_ldap_localhost_search_count'] == 1
+    assert 'devpi_ldap_server_ldap_localhost_search_bytes' not in metrics
+    ldap._collect_usage = True
+    ldap._search_page(conn, {}, request)
+    metrics = {name: value for (name, _kind, value) in ldap.metrics()}
+    assert metrics['devpi_ldap_server_ldap_localhost_search_bytes'] == 90
+
+
+def test_log_validation_lazy(LDAP, caplog, circuit_breaker_config):
+    import logging
+    ldap = LDAP(circuit_breaker_config.strpath)
+    with caplog.at_level(logging.DEBUG):
+        ldap._log_validation('user')
+    assert "Validating user 'user' against LDAP at ['ldap://server1', 'ldap://server2']." in caplog.text
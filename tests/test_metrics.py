@@ -0,0 +1,61 @@
+from devpi_ldap.metrics import Metrics
+from devpi_ldap.metrics import metric_name
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_metric_name():
+    assert metric_name("server", "ldaps://LDAP.example.com:636", "bind") == (
+        "server_ldaps_ldap_example_com_636_bind"
+    )
+    assert metric_name("foo", None, "bar") == "foo_bar"
+
+
+def test_record():
+    metrics = Metrics()
+    metrics.record("user_bind", 0.05)
+    metrics.record("user_bind", 1, error=True)
+    assert metrics.get("user_bind_count") == 2
+    assert metrics.get("user_bind_errors") == 1
+    assert metrics.get("user_bind_seconds") == 1.05
+    assert metrics.get("user_bind_seconds_bucket_0_025") == 0
+    assert metrics.get("user_bind_seconds_bucket_0_1") == 1
+    assert metrics.get("user_bind_seconds_bucket_2_5") == 2
+    assert metrics.get("user_bind_seconds_bucket_10") == 2
+
+
+def test_timed():
+    clock = Clock()
+    metrics = Metrics(clock=clock)
+    with metrics.timed("group_search"):
+        clock.now = 2
+
+    def fail():
+        with metrics.timed("group_search"):
+            clock.now = 5
+            msg = "failed"
+            raise RuntimeError(msg)
+
+    with pytest.raises(RuntimeError, match="failed"):
+        fail()
+    assert metrics.get("group_search_count") == 2
+    assert metrics.get("group_search_errors") == 1
+    assert metrics.get("group_search_seconds") == 5
+
+
+def test_counters():
+    metrics = Metrics()
+    metrics.count("validations", "ok")
+    metrics.count("validations", "ok")
+    metrics.count("failovers", value=3)
+    assert metrics.counters() == [
+        ("devpi_ldap_failovers", "counter", 3),
+        ("devpi_ldap_validations_ok", "counter", 2),
+    ]
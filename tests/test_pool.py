@@ -0,0 +1,141 @@
+from devpi_ldap.pool import ConcurrencyLimiter
+from devpi_ldap.pool import ConnectionPool
+from devpi_ldap.pool import LimitExceededError
+from devpi_ldap.pool import PoolTimeoutError
+import pytest
+import threading
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Connection:
+    def __init__(self):
+        self.closed = False
+        self.bound = True
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def pool(clock):
+    return ConnectionPool(Connection, maxsize=2, idle_timeout=10, clock=clock)
+
+
+def test_reuse(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert pool.size == 1
+
+
+def test_dead_connection_replaced(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.closed = True
+    new_conn = pool.acquire()
+    assert new_conn is not conn
+    assert pool.size == 1
+
+
+def test_discard(pool):
+    conn = pool.acquire()
+    pool.release(conn, discard=True)
+    assert conn.closed
+    assert (pool.size, pool.idle) == (0, 0)
+
+
+def test_factory_failure():
+    pool = ConnectionPool(lambda: None, maxsize=1)
+    assert pool.acquire() is None
+    assert pool.size == 0
+
+
+def test_maxsize(pool):
+    conn1 = pool.acquire()
+    conn2 = pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire(timeout=0)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.acquire()))
+    thread.start()
+    pool.release(conn2)
+    thread.join()
+    assert result == [conn2]
+    assert pool.size == 2
+    pool.release(conn1)
+
+
+def test_idle_reaping(clock):
+    pool = ConnectionPool(
+        Connection, minsize=1, maxsize=3, idle_timeout=10, clock=clock
+    )
+    conns = [pool.acquire() for i in range(3)]
+    for conn in conns:
+        pool.release(conn)
+    clock.now = 11
+    conn = pool.acquire()
+    # the oldest two were closed, one is kept because of minsize
+    assert pool.size == 1
+    assert conn is conns[2]
+    assert [x.closed for x in conns] == [True, True, False]
+
+
+def test_clear(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    pool.clear()
+    assert conn.closed
+    assert pool.size == 0
+
+
+def test_limiter_fail_fast():
+    limiter = ConcurrencyLimiter(2, max_queue=0)
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+    with pytest.raises(LimitExceededError):
+        limiter.acquire()
+    assert (limiter.active, limiter.rejected) == (2, 1)
+    limiter.release()
+    assert limiter.acquire() == 0
+
+
+def test_limiter_queue_timeout(clock):
+    limiter = ConcurrencyLimiter(1, max_queue=1, queue_timeout=0, clock=clock)
+    limiter.acquire()
+    with pytest.raises(LimitExceededError):
+        limiter.acquire()
+    assert (limiter.active, limiter.waiting, limiter.rejected) == (1, 0, 1)
+
+
+def test_limiter_queue():
+    limiter = ConcurrencyLimiter(1, max_queue=1, queue_timeout=5)
+    limiter.acquire()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(limiter.acquire()))
+    thread.start()
+    for _i in range(500):
+        if limiter.waiting:
+            break
+        threading.Event().wait(0.01)
+    assert limiter.waiting == 1
+    # the queue is full
+    with pytest.raises(LimitExceededError):
+        limiter.acquire()
+    limiter.release()
+    thread.join(5)
+    assert result[0] > 0
+    assert (limiter.active, limiter.waiting) == (1, 0)
+    assert limiter.wait_time == result[0]
@@ -0,0 +1,94 @@
+from devpi_ldap.shared import SharedCache
+from devpi_ldap.shared import SharedStore
+import os
+import pytest
+import stat
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SharedStore(str(tmp_path / "cache.sqlite"))
+
+
+def test_store_permissions(store):
+    assert store.connection().execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert stat.S_IMODE(os.stat(store.path).st_mode) == 0o600
+
+
+def test_store_salt(store):
+    salt = store.salt
+    assert len(salt) == 16
+    assert SharedStore(store.path).salt == salt
+
+
+def test_sharedcache_expiry(store):
+    clock = Clock()
+    cache = SharedCache(store, "foo", maxsize=10, ttl=10, clock=clock)
+    cache.put("foo", 1)
+    cache.put("bar", 2, ttl=20)
+    assert cache.get("foo") == 1
+    clock.now = 10
+    assert cache.get("foo") is None
+    assert cache.get("bar") == 2
+    assert (cache.lookups, cache.hits, cache.misses) == (3, 2, 1)
+    assert cache.get_stale("foo", 5) == (1, True)
+    clock.now = 15
+    assert cache.get_stale("foo", 5) == (None, False)
+
+
+def test_sharedcache_processes(store):
+    cache = SharedCache(store, "foo", maxsize=10, ttl=10)
+    other = SharedCache(SharedStore(store.path), "foo", maxsize=10, ttl=10)
+    cache.put(("user", b"\x00\xff"), {"status": "ok", "groups": ["users"]})
+    assert other.get(("user", b"\x00\xff")) == {"status": "ok", "groups": ["users"]}
+    other.invalidate(("user", b"\x00\xff"))
+    assert cache.get(("user", b"\x00\xff")) is None
+
+
+def test_sharedcache_namespaces(store):
+    cache = SharedCache(store, "foo", maxsize=10, ttl=10)
+    other = SharedCache(store, "bar", maxsize=10, ttl=10)
+    cache.put("user", ("cn=user", None))
+    assert cache.get("user") == ("cn=user", None)
+    assert other.get("user") is None
+    other.put("user", 1)
+    cache.clear()
+    assert len(cache) == 0
+    assert len(other) == 1
+
+
+def test_sharedcache_maxsize(store):
+    cache = SharedCache(store, "foo", maxsize=2, ttl=10)
+    cache.put("foo", 1, ttl=30)
+    cache.put("bar", 2, ttl=10)
+    cache.put("ham", 3, ttl=20)
+    assert cache.get("bar") is None
+    assert cache.get("foo") == 1
+    assert cache.get("ham") == 3
+    assert cache.evictions == 1
+
+
+def test_sharedcache_evict(store):
+    cache = SharedCache(store, "foo", maxsize=10, ttl=10)
+    cache.put(("foo", "cn=foo"), ["users"])
+    cache.put(("bar", "cn=bar"), ["admins"])
+    assert cache.evict(lambda k, v: k[0] == "foo" or "users" in v) == 1
+    assert cache.get(("foo", "cn=foo")) is None
+    assert cache.get(("bar", "cn=bar")) == ("admins",)
+
+
+def test_sharedcache_error(store, caplog):
+    cache = SharedCache(store, "foo", maxsize=10, ttl=10)
+    cache.put("foo", 1)
+    store.connection().execute("DROP TABLE cache")
+    assert cache.get("foo") is None
+    cache.put("foo", 1)
+    assert "Error using shared LDAP cache" in caplog.text